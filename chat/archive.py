@@ -0,0 +1,129 @@
+import functools
+import gzip
+import logging # 導入 logging 模組
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from . import wire # JSON 編碼 (orjson 可用時自動使用)
+from .models import ArchiveSegment
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+# ArchiveSegment.blocks 中每個區塊的欄位位置
+OFFSET, LENGTH, COUNT, FIRST_TIMESTAMP, FIRST_ID, LAST_TIMESTAMP, LAST_ID = range(7)
+
+
+def _key(message):
+    return parse_datetime(message['timestamp']), message['id']
+
+
+def segment_path(room_name, day):
+    """
+    分段檔相對於 CHAT_ARCHIVE_DIR 的路徑；聊天室名稱只包含字母、數字與底線，可直接作為目錄名稱。
+    """
+    return f'{room_name}/{day.isoformat()}.jsonl.gz'
+
+
+def append_block(room_name, day, messages):
+    """
+    把同一天、依 (timestamp, id) 由舊到新排列的已序列化消息追加為分段檔中的一個 gzip 區塊，
+    並更新分段索引。返回實際寫入的消息數。
+
+    上次執行已歸檔但尚未刪除的消息 (不晚於分段的最新消息) 會被略過，重複執行不會寫入重複的消息。
+    """
+    segment = ArchiveSegment.objects.filter(room_name=room_name, day=day).first()
+    if segment is not None:
+        archived_until = (segment.last_timestamp, segment.last_id)
+        messages = [m for m in messages if _key(m) > archived_until]
+    if not messages:
+        return 0
+
+    relative_path = segment_path(room_name, day)
+    path = Path(settings.CHAT_ARCHIVE_DIR) / relative_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = gzip.compress(''.join(wire.dumps(m) + '\n' for m in messages).encode('utf-8'))
+    # gzip 允許多個 member 直接串接，追加區塊不需要改寫已存在的內容
+    with open(path, 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno()) # 確保檔案落盤後才刪除資料庫中的行
+
+    first, last = messages[0], messages[-1]
+    block = [offset, len(data), len(messages), first['timestamp'], first['id'], last['timestamp'], last['id']]
+    if segment is None:
+        ArchiveSegment.objects.create(
+            room_name=room_name,
+            day=day,
+            path=relative_path,
+            message_count=len(messages),
+            first_timestamp=parse_datetime(first['timestamp']),
+            first_id=first['id'],
+            last_timestamp=parse_datetime(last['timestamp']),
+            last_id=last['id'],
+            blocks=[block],
+        )
+    else:
+        segment.blocks.append(block)
+        segment.message_count += len(messages)
+        segment.last_timestamp = parse_datetime(last['timestamp'])
+        segment.last_id = last['id']
+        segment.save(update_fields=['blocks', 'message_count', 'last_timestamp', 'last_id'])
+    return len(messages)
+
+
+@functools.lru_cache(maxsize=256)
+def _read_block(path, offset, length):
+    # 區塊寫入後不再改變，向前捲動時相鄰的頁面通常落在同一個區塊
+    with open(Path(settings.CHAT_ARCHIVE_DIR) / path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    return tuple(wire.loads(line) for line in gzip.decompress(data).splitlines() if line)
+
+
+def _block_messages(segment, block):
+    try:
+        return _read_block(segment.path, block[OFFSET], block[LENGTH])
+    except (OSError, EOFError, ValueError) as e:
+        logger.error(f"讀取歸檔 {segment.path} 的區塊 (位移 {block[OFFSET]}) 時發生錯誤: {e}")
+        return ()
+
+
+def fetch_archived_before(room_name, bound, limit):
+    """
+    返回歸檔中早於 bound=(timestamp, id) 的最新 limit 條消息 (由舊到新)；bound 為 None 時從最新的歸檔開始。
+    依分段與區塊索引由新到舊只解壓需要的區塊。
+    """
+    segments = ArchiveSegment.objects.filter(room_name=room_name)
+    if bound is not None:
+        segments = segments.filter(first_timestamp__lte=bound[0])
+    collected = []
+    for segment in segments.order_by('-day').only('path', 'blocks').iterator():
+        for block in reversed(segment.blocks):
+            if bound is not None and (parse_datetime(block[FIRST_TIMESTAMP]), block[FIRST_ID]) >= bound:
+                continue
+            messages = [m for m in _block_messages(segment, block) if bound is None or _key(m) < bound]
+            collected[:0] = messages
+            if len(collected) >= limit:
+                return collected[-limit:]
+    return collected
+
+
+def fetch_archived_after(room_name, bound, limit):
+    """
+    返回歸檔中晚於 bound=(timestamp, id) 的最早 limit 條消息 (由舊到新)。
+    """
+    segments = ArchiveSegment.objects.filter(room_name=room_name, last_timestamp__gte=bound[0])
+    collected = []
+    for segment in segments.order_by('day').only('path', 'blocks').iterator():
+        for block in segment.blocks:
+            if (parse_datetime(block[LAST_TIMESTAMP]), block[LAST_ID]) <= bound:
+                continue
+            collected.extend(m for m in _block_messages(segment, block) if _key(m) > bound)
+            if len(collected) >= limit:
+                return collected[:limit]
+    return collected
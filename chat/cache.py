@@ -0,0 +1,269 @@
+import asyncio
+import logging # 導入 logging 模組
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from . import metrics # Prometheus 指標
+from . import wire # JSON 編碼 (orjson 可用時自動使用)
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+
+class RecentMessageCache:
+    """
+    每個聊天室最近 N 條已序列化消息的環形緩衝區。
+
+    緩衝區只會由 fill() 以資料庫中的最新消息建立，append() 只更新已存在的聊天室，
+    因此快取中的內容永遠是該聊天室「最新的連續 N 條」消息。
+
+    讀取資料庫前先以 fill_token() 取得聊天室的寫入版本；fill() 只在快取中沒有該聊天室、
+    且期間沒有任何 append() 時寫入。否則查詢結果可能早於剛寫入的消息，
+    覆蓋後該消息會在整個 TTL 內從歷史中消失。
+    """
+
+    shared = False # 是否在所有 worker 之間共用 (每條消息都會寫入)
+
+    def __init__(self, size=100, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, room_name):
+        """
+        返回快取的消息 (由舊到新)；未命中時返回 None。
+        """
+        messages = self._get(room_name)
+        if messages is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return messages
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get(self, room_name):
+        raise NotImplementedError
+
+    def fill_token(self, room_name):
+        raise NotImplementedError
+
+    def fill(self, room_name, messages, token):
+        """
+        以資料庫查詢結果建立快取；已有快取或 token 已過時 (期間有新消息) 時不寫入，返回 False。
+        """
+        raise NotImplementedError
+
+    def append(self, room_name, message):
+        raise NotImplementedError
+
+    async def aappend(self, room_name, message):
+        self.append(room_name, message)
+
+
+class LocalRecentMessageCache(RecentMessageCache):
+    """
+    進程內 LRU 快取，超過 max_rooms 個聊天室時淘汰最久未使用的聊天室。
+    """
+
+    def __init__(self, size=100, ttl=3600, max_rooms=1000):
+        super().__init__(size=size, ttl=ttl)
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict() # room_name -> (過期時間, deque)
+        self._fill_tokens = {} # room_name -> 進行中的回填 token，append() 時移除
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return dict(super().stats(), rooms=len(self._rooms))
+
+    def _get(self, room_name):
+        with self._lock:
+            entry = self._rooms.get(room_name)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._rooms[room_name]
+                return None
+            self._rooms.move_to_end(room_name)
+            return list(entry[1])
+
+    def fill_token(self, room_name):
+        token = object()
+        with self._lock:
+            self._fill_tokens[room_name] = token
+        return token
+
+    def fill(self, room_name, messages, token):
+        with self._lock:
+            if self._fill_tokens.get(room_name) is not token:
+                return False
+            del self._fill_tokens[room_name]
+            entry = self._rooms.get(room_name)
+            if entry is not None and entry[0] >= time.monotonic():
+                return False
+            self._rooms[room_name] = (time.monotonic() + self.ttl, deque(messages, maxlen=self.size))
+            self._rooms.move_to_end(room_name)
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+            return True
+
+    def append(self, room_name, message):
+        with self._lock:
+            self._fill_tokens.pop(room_name, None)
+            entry = self._rooms.get(room_name)
+            if entry is not None:
+                entry[1].append(message)
+
+
+# KEYS: 消息 list、寫入版本；ARGV: fill_token() 讀到的版本、TTL (秒)、消息...
+# 只在 list 不存在且版本未變 (期間沒有 append) 時寫入
+_FILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+if #ARGV > 2 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+class RedisRecentMessageCache(RecentMessageCache):
+    """
+    以 Redis list 儲存的快取，多個 daphne worker 共用同一份最近消息。
+
+    每次 append 同時遞增聊天室的寫入版本 (與 list 使用相同的 hash tag)，
+    回填以 Lua 腳本比對版本，與 append 之間不會互相覆蓋。
+    """
+
+    key_prefix = 'chat:recent:'
+    shared = True
+
+    def __init__(self, url, size=100, ttl=3600):
+        super().__init__(size=size, ttl=ttl)
+        import redis # channels_redis 的依賴，已隨 requirements.txt 安裝
+        self._client = redis.Redis.from_url(url)
+        self._url = url
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._fill_script = self._client.register_script(_FILL_SCRIPT)
+
+    def _key(self, room_name):
+        return f'{self.key_prefix}{{{room_name}}}'
+
+    def _version_key(self, room_name):
+        return f'{self.key_prefix}{{{room_name}}}:version'
+
+    def _get(self, room_name):
+        items = self._client.lrange(self._key(room_name), 0, -1)
+        if not items:
+            return None
+        return [wire.loads(item) for item in items]
+
+    def fill_token(self, room_name):
+        return self._client.get(self._version_key(room_name)) or b'0'
+
+    def fill(self, room_name, messages, token):
+        args = [token, self.ttl] + [wire.dumps(m) for m in messages[-self.size:]]
+        return bool(self._fill_script(keys=[self._key(room_name), self._version_key(room_name)], args=args))
+
+    def _queue_append(self, pipe, room_name, message):
+        key = self._key(room_name)
+        version_key = self._version_key(room_name)
+        # RPUSHX 只在聊天室已被快取時寫入，避免產生不完整的緩衝區；版本無論是否快取都遞增
+        pipe.rpushx(key, wire.dumps(message))
+        pipe.ltrim(key, -self.size, -1)
+        pipe.incr(version_key)
+        pipe.expire(version_key, self.ttl)
+
+    def append(self, room_name, message):
+        pipe = self._client.pipeline()
+        self._queue_append(pipe, room_name, message)
+        pipe.execute()
+
+    async def aappend(self, room_name, message):
+        from redis import asyncio as aioredis
+        # redis.asyncio 連線綁定事件循環，每個事件循環各自建立客戶端
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = aioredis.Redis.from_url(self._url)
+        async with client.pipeline() as pipe:
+            self._queue_append(pipe, room_name, message)
+            await pipe.execute()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_recent_cache():
+    """
+    取得本進程共用的最近消息快取；CHAT_RECENT_CACHE_BACKEND 為 'none' 時返回 None。
+    """
+    global _cache
+    backend = settings.CHAT_RECENT_CACHE_BACKEND
+    if backend == 'none':
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if backend == 'redis':
+                    _cache = RedisRecentMessageCache(
+                        settings.CHAT_RECENT_CACHE_REDIS_URL,
+                        size=settings.CHAT_RECENT_CACHE_SIZE,
+                        ttl=settings.CHAT_RECENT_CACHE_TTL,
+                    )
+                else:
+                    _cache = LocalRecentMessageCache(
+                        size=settings.CHAT_RECENT_CACHE_SIZE,
+                        ttl=settings.CHAT_RECENT_CACHE_TTL,
+                        max_rooms=settings.CHAT_RECENT_CACHE_MAX_ROOMS,
+                    )
+    return _cache
+
+
+def append_recent(room_name, message):
+    """
+    在寫入路徑上把新消息加入快取；快取故障不影響消息發送。
+    """
+    cache = get_recent_cache()
+    if cache is None:
+        return
+    try:
+        cache.append(room_name, message)
+    except Exception as e:
+        logger.error(f"更新最近消息快取時發生錯誤: {e}")
+
+
+async def aappend_recent(room_name, message):
+    """
+    append_recent 的異步版本，供 Consumer 使用。
+    """
+    cache = get_recent_cache()
+    if cache is None:
+        return
+    try:
+        await cache.aappend(room_name, message)
+    except Exception as e:
+        logger.error(f"更新最近消息快取時發生錯誤: {e}")
+
+
+@metrics.register_collector
+def _collect_metrics():
+    # 快取尚未建立時不建立，避免 /metrics 觸發 Redis 連線
+    if _cache is None:
+        return []
+    return [
+        ('chat_recent_cache_hits_total', 'counter', '最近消息快取命中次數', [({}, _cache.hits)]),
+        ('chat_recent_cache_misses_total', 'counter', '最近消息快取未命中次數', [({}, _cache.misses)]),
+    ]
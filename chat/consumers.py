@@ -1,115 +1,462 @@
-import json
-import datetime
 import logging # 導入 logging 模組
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from django.contrib.auth.models import User # 確保導入 User 模型
-from .models import ChatMessage # 確保導入 ChatMessage 模型
+from django.conf import settings
+from . import drain # 結束 worker 前排空連線
+from . import receipts # 已讀游標
+from .db import db_sync_to_async # 有界的資料庫執行緒池
+from .dedup import DuplicateMessage, is_valid_client_msg_id # client_msg_id 去重
+from . import metrics # Prometheus 指標
+from . import presence # 在線狀態
+from . import rooms # 聊天室統計
+from . import routers # 讀寫分離
+from . import wire # WebSocket 幀編碼
+from .history import DEFAULT_PAGE_SIZE, fetch_page, fetch_since # 鍵集分頁歷史查詢
+from .messaging import apublish_message, is_valid_room_name, room_group_name # 與 REST API 共用的消息發送流程
+from .fanout import local_fanout # 大型聊天室的進程內群發
+from .outbound import OutboundQueue # 每個連線的發送佇列
+from .ephemeral import get_ephemeral_relay # 輸入中提示與已讀回執
+from .ratelimit import check_ephemeral_rate, check_message_rate, connection_bucket, ephemeral_bucket # 令牌桶速率限制
 
 # 配置日誌記錄器
 logger = logging.getLogger(__name__)
 
+async def build_resume_frame(room_name, last_seen_id):
+    """
+    產生斷線重連的補發幀：{"type": "replay", "messages": [...]}；
+    遺漏的消息超過 CHAT_RESUME_MAX_MESSAGES 條時返回 {"type": "reload"}，由客戶端重新載入頁面。
+
+    呼叫前連線已加入群組，補發與即時廣播之間可能有重複，客戶端以 id 去重。
+    """
+    try:
+        last_seen_id = int(last_seen_id)
+    except (TypeError, ValueError):
+        return wire.dumps({"error": "last_seen_id 格式無效。"})
+    messages, complete = await db_sync_to_async(fetch_since)(room_name, last_seen_id, settings.CHAT_RESUME_MAX_MESSAGES)
+    if not complete:
+        return wire.dumps({'type': 'reload'})
+    return wire.dumps({'type': 'replay', 'messages': messages})
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
+    codec = wire.JSON_CODEC # 連線時依 Sec-WebSocket-Protocol 協商
+
+    @metrics.timed(metrics.ws_handler_seconds, 'chat', 'connect')
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'chat_{self.room_name}'
+        if drain.is_draining():
+            # worker 即將結束，拒絕新連線，客戶端會重連到其他 worker
+            await self.close(code=drain.CLOSE_SERVICE_RESTART)
+            return
+        self.room_group_name = room_group_name(self.room_name)
 
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        metrics.ws_connections_active.inc(self.room_name)
 
         self.user = self.scope['user']
-        # 如果用戶已認證，使用其用戶名；否則，顯示為 '未登入用戶'
-        username = await sync_to_async(lambda: self.user.username)() if self.user.is_authenticated else "未登入用戶"
-        logger.info(f"用戶 '{username}' 連線到房間: {self.room_name}")
+        self.client_address = (self.scope.get('client') or [None])[0]
+        self.rate_bucket = connection_bucket() # 每個連線自己的發送頻率限制
+        self.ephemeral_bucket = ephemeral_bucket() # 輸入中提示 / 已讀回執的頻率限制
+        self.sticky_key = routers.sticky_key(self.user, self.client_address) # 發送後一段時間內讀取主庫
+        self.presence_key = presence.member_key(self.user, self.channel_name)
+        presence.join(self.channel_layer, self.room_name, self.presence_key)
+        # AuthMiddlewareStack 已在連線前以異步方式載入用戶，只在連線時解析一次身分，
+        # 之後每條消息直接使用，不再切換到執行緒。未登入時 sender 欄位存為 None
+        self.sender = self.user if self.user.is_authenticated else None
+        self.username = self.user.username if self.user.is_authenticated else "未登入用戶"
+        logger.info(f"用戶 '{self.username}' 連線到房間: {self.room_name}")
 
-        await self.accept()
+        # 客戶端以子協定 chat.msgpack / chat.msgpack.zlib 要求二進位幀，未要求時沿用 JSON
+        self.codec = wire.negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+        # 每個連線的發送佇列：合併熱門聊天室的幀，並限制慢速客戶端佔用的記憶體
+        self.outbound = OutboundQueue(
+            self.send,
+            self.close,
+            window=settings.CHAT_OUTBOUND_COALESCE_WINDOW_MS / 1000,
+            max_depth=settings.CHAT_OUTBOUND_MAX_QUEUE,
+            policy=settings.CHAT_SLOW_CONSUMER_POLICY,
+            codec=self.codec,
+        )
+        self.outbound.start()
+        # 發送佇列建立後才加入進程內群發，否則期間到達的廣播沒有佇列可放
+        await local_fanout.join(self.channel_layer, self.room_group_name, self.room_name, self)
+        drain.register(self)
+
+        # 重連時以查詢參數 ?last_seen_id= 補發斷線期間遺漏的消息
+        last_seen_id = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seen_id', [None])[0]
+        if last_seen_id is not None:
+            await self.resume(last_seen_id)
 
+    @metrics.timed(metrics.ws_handler_seconds, 'chat', 'disconnect')
     async def disconnect(self, close_code):
+        if getattr(self, 'room_group_name', None) is None:
+            return # 排空期間被拒絕的連線
+        drain.unregister(self)
+        if getattr(self, 'outbound', None) is not None:
+            await self.outbound.stop()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
-        username = await sync_to_async(lambda: self.user.username)() if self.user.is_authenticated else "未登入用戶"
-        logger.info(f"用戶 '{username}' 從房間斷開: {self.room_name} 代碼: {close_code}")
+        await local_fanout.leave(self.channel_layer, self.room_group_name, self.room_name, self)
+        metrics.ws_connections_active.dec(self.room_name)
+        if getattr(self, 'presence_key', None) is not None:
+            presence.leave(self.room_name, self.presence_key)
+        logger.info(f"用戶 '{getattr(self, 'username', '未登入用戶')}' 從房間斷開: {self.room_name} 代碼: {close_code}")
 
-    async def receive(self, text_data):
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """
+        協商二進位格式的連線，其餘以 JSON 產生的幀 (錯誤、歷史、補發等) 在此轉為二進位幀。
+        """
+        if text_data is not None and self.codec.binary:
+            text_data, bytes_data = None, self.codec.encode(text_data)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    @metrics.timed(metrics.ws_handler_seconds, 'chat', 'receive')
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            text_data_json = json.loads(text_data)
+            # 二進位幀與 JSON 幀的欄位相同
+            text_data_json = wire.decode_binary(bytes_data) if bytes_data is not None else wire.loads(text_data)
+            if not isinstance(text_data_json, dict):
+                raise wire.FrameDecodeError('幀必須是物件')
             message = text_data_json.get('message')
 
             # 後端驗證房間名稱格式 (範例：只允許字母數字)
-            import re
-            valid_room_pattern = re.compile(r'^[a-zA-Z0-9_]+$') # 允許字母、數字、底線
-            if not valid_room_pattern.match(self.room_name):
+            if not is_valid_room_name(self.room_name):
                 logger.warning(f"Consumer: 檢測到無效房間名稱格式: {self.room_name}，拒絕處理消息。")
-                await self.send(text_data=json.dumps({"error": "房間名稱格式無效。"}))
+                await self.send(text_data=wire.dumps({"error": "房間名稱格式無效。"}))
+                return
+
+            # 客戶端向前捲動時請求更早的歷史消息
+            if text_data_json.get('action') == 'fetch_older':
+                await self.fetch_older(text_data_json.get('before'), text_data_json.get('limit'))
+                return
+
+            # 客戶端也可以在連線後的第一個幀要求補發
+            if text_data_json.get('action') == 'resume':
+                await self.resume(text_data_json.get('last_seen_id'))
+                return
+
+            # 輸入中提示與已讀回執不寫入消息表
+            if text_data_json.get('action') in ('typing', 'read'):
+                await self.ephemeral(text_data_json)
                 return
 
             if not message or not isinstance(message, str) or not message.strip():
                 logger.warning("收到空消息或無效消息。")
-                await self.send(text_data=json.dumps({"error": "消息內容為空或格式無效。"})) # 前端提示
+                await self.send(text_data=wire.dumps({"error": "消息內容為空或格式無效。"})) # 前端提示
                 return
 
-            username = await sync_to_async(lambda: self.user.username)() if self.user.is_authenticated else "未登入用戶"
-            
-            # 使用 Django 的時區感知時間
-            from django.utils import timezone
-            current_timestamp = timezone.now()
+            # 可選的客戶端消息 id：逾時重試時沿用同一個 id，伺服器只處理一次
+            client_msg_id = text_data_json.get('client_msg_id')
+            if client_msg_id is not None and not is_valid_client_msg_id(client_msg_id):
+                await self.send(text_data=wire.dumps({"error": "client_msg_id 格式無效。"}))
+                return
+
+            # 超過速率限制的消息在寫入資料庫與群發之前就被拒絕
+            allowed, retry_after = check_message_rate(self.rate_bucket, self.user, self.client_address, self.room_name)
+            if not allowed:
+                await self.send(text_data=wire.dumps({"error": "發送過於頻繁，請稍後再試。", "retry_after": round(retry_after, 3)}))
+                return
 
-            # 將消息存儲到數據庫
-            # 確保 ChatMessage 模型已在 models.py 中啟用
             try:
-                # 只有當用戶已認證時，才將其作為 sender 儲存
-                if self.user.is_authenticated:
-                    await sync_to_async(ChatMessage.objects.create)(
-                        room_name=self.room_name,
-                        sender=self.user,
-                        content=message,
-                        timestamp=current_timestamp
-                    )
-                else:
-                    # 如果未登入，sender 欄位設為 None (如果模型允許 null=True)
-                    await sync_to_async(ChatMessage.objects.create)(
-                        room_name=self.room_name,
-                        content=message,
-                        timestamp=current_timestamp
-                    )
-                logger.debug(f"消息 '{message}' 已儲存到資料庫。")
-            except Exception as e:
-                logger.error(f"保存消息到數據庫時發生錯誤: {e}")
-                # 即使資料庫儲存失敗，仍嘗試發送到 WebSocket，保證即時性
-                # 但生產環境應有更完善的錯誤處理和重試機制
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message', 
-                    'message': message,
-                    'user': username,
-                    'timestamp': current_timestamp.isoformat(), # 使用 ISO 格式方便前端解析
-                }
-            )
-        except json.JSONDecodeError:
+                await apublish_message(self.channel_layer, self.room_name, self.sender, self.username, message, client_msg_id)
+            except DuplicateMessage as e:
+                # 重試的消息已處理過，只回覆發送者，不再寫入與廣播
+                await self.send(text_data=wire.dumps({"type": "duplicate", "client_msg_id": e.client_msg_id, "id": e.message_id}))
+            else:
+                await routers.amark_written(self.sticky_key)
+        except wire.JSONDecodeError:
+            metrics.errors_total.inc('ws_invalid_json')
             logger.error("收到非 JSON 格式的數據。")
-            await self.send(text_data=json.dumps({"error": "Invalid JSON format."}))
+            await self.send(text_data=wire.dumps({"error": "Invalid JSON format."}))
+        except wire.FrameDecodeError as e:
+            metrics.errors_total.inc('ws_invalid_frame')
+            logger.error(f"收到無法解碼的二進位幀: {e}")
+            await self.send(text_data=wire.dumps({"error": "Invalid binary frame."}))
         except Exception as e:
+            metrics.errors_total.inc('ws_receive')
             logger.error(f"處理消息時發生錯誤: {e}")
-            await self.send(text_data=json.dumps({"error": "Server error processing message."}))
+            await self.send(text_data=wire.dumps({"error": "Server error processing message."}))
 
 
-    async def chat_message(self, event):
-        message = event['message']
-        user = event['user']
-        timestamp = event.get('timestamp', '時間未知')
-
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'user': user,
-            'timestamp': timestamp,
+    async def ephemeral(self, data):
+        """
+        {"action": "typing", "typing": true} 或 {"action": "read", "last_read_id": 123}。
+        已讀位置寫入已讀游標 (批次)；兩者都合併後群發給聊天室，超過頻率限制的群發直接丟棄。
+        """
+        if self.sender is None:
+            await self.send(text_data=wire.dumps({"error": "需要登入才能發送輸入中提示與已讀回執。"}))
+            return
+        relay = get_ephemeral_relay()
+        if data['action'] == 'read':
+            last_read_id = data.get('last_read_id')
+            if not isinstance(last_read_id, int) or isinstance(last_read_id, bool) or last_read_id <= 0:
+                await self.send(text_data=wire.dumps({"error": "last_read_id 格式無效。"}))
+                return
+            # 游標不受頻率限制，客戶端最後一次回報的位置一定會寫入
+            receipts.record_read(self.user.id, self.room_name, last_read_id)
+            if check_ephemeral_rate(self.ephemeral_bucket):
+                relay.read(self.channel_layer, self.room_name, self.username, last_read_id)
+        elif check_ephemeral_rate(self.ephemeral_bucket):
+            relay.typing(self.channel_layer, self.room_name, self.username, bool(data.get('typing', True)))
+
+    async def drain_connection(self):
+        """
+        worker 排空時呼叫：發送重連提示後以 drain.CLOSE_SERVICE_RESTART 關閉連線，客戶端依 retry_after 重連並補發遺漏的消息。
+        """
+        await self.send(text_data=wire.dumps(drain.reconnect_hint()))
+        await self.close(code=drain.CLOSE_SERVICE_RESTART)
+
+    async def resume(self, last_seen_id):
+        """
+        補發 id 大於 last_seen_id 的消息，只回傳給發出請求的客戶端。
+        """
+        frame = await build_resume_frame(self.room_name, last_seen_id)
+        await self.send(text_data=frame)
+
+    async def fetch_older(self, before, limit):
+        """
+        以游標讀取一頁更早的歷史消息，只回傳給發出請求的客戶端。
+        """
+        if before is not None and not isinstance(before, str):
+            await self.send(text_data=wire.dumps({"error": "分頁游標格式無效。"}))
+            return
+        try:
+            limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+            # 歷史分頁讀取唯讀副本 (若有設定)
+            page = await db_sync_to_async(routers.on_replica(fetch_page, self.sticky_key))(self.room_name, before=before, limit=limit)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"收到無效的歷史分頁請求: {e}")
+            await self.send(text_data=wire.dumps({"error": "分頁參數無效。"}))
+            return
+
+        await self.send(text_data=wire.dumps({
+            'type': 'history',
+            'messages': page['messages'],
+            'older': page['older'],
         }))
 
+    @metrics.timed(metrics.ws_handler_seconds, 'chat', 'chat_message')
+    async def chat_message(self, event):
+        frames = event.get('frames') # 批次發送 API 一次送來多個幀
+        if frames is None:
+            frame = event.get('frame')
+            if frame is None:
+                # 相容舊版事件格式 (滾動部署期間仍可能收到)
+                frame = wire.build_chat_frame(event['message'], event['user'], event.get('timestamp', '時間未知'), event.get('id'))
+            frames = [frame]
+        for frame in frames:
+            self.outbound.put(frame)
+        metrics.messages_out_total.inc(amount=len(frames))
+
+class MultiplexConsumer(AsyncWebsocketConsumer):
+    """
+    單一 WebSocket 連線同時訂閱多個聊天室與個人通知串流。
+
+    客戶端以控制消息管理訂閱：
+      {"action": "subscribe", "room": "lobby", "last_seen_id": 123} / {"action": "unsubscribe", "room": "lobby"}
+      {"action": "subscribe", "stream": "notifications"} (需登入)
+      {"action": "send", "room": "lobby", "message": "..."}
+      {"action": "fetch_older", "room": "lobby", "before": "<游標>"}
+    伺服器發出的每個幀都帶串流標籤：{"stream": "chat:lobby" | "notifications" | "control", "payload": {...}}
+    """
+
+    @metrics.timed(metrics.ws_handler_seconds, 'multiplex', 'connect')
+    async def connect(self):
+        self.user = self.scope['user']
+        self.sender = self.user if self.user.is_authenticated else None
+        self.username = self.user.username if self.user.is_authenticated else "未登入用戶"
+        self.rooms = set() # 已訂閱的聊天室
+        if drain.is_draining():
+            await self.close(code=drain.CLOSE_SERVICE_RESTART)
+            return
+        self.client_address = (self.scope.get('client') or [None])[0]
+        self.rate_bucket = connection_bucket() # 整個多工連線共用一個發送頻率限制
+        self.sticky_key = routers.sticky_key(self.user, self.client_address)
+        self.presence_key = presence.member_key(self.user, self.channel_name)
+        self.notification_group_name = None
+
+        await self.accept()
+
+        self.outbound = OutboundQueue(
+            self.send,
+            self.close,
+            window=settings.CHAT_OUTBOUND_COALESCE_WINDOW_MS / 1000,
+            max_depth=settings.CHAT_OUTBOUND_MAX_QUEUE,
+            policy=settings.CHAT_SLOW_CONSUMER_POLICY,
+        )
+        self.outbound.start()
+        drain.register(self)
+        logger.info(f"用戶 '{self.username}' 建立多工連線。")
+
+    @metrics.timed(metrics.ws_handler_seconds, 'multiplex', 'disconnect')
+    async def disconnect(self, close_code):
+        drain.unregister(self)
+        if getattr(self, 'outbound', None) is not None:
+            await self.outbound.stop()
+        for room_name in list(getattr(self, 'rooms', ())):
+            await self.channel_layer.group_discard(room_group_name(room_name), self.channel_name)
+            await local_fanout.leave(self.channel_layer, room_group_name(room_name), room_name, self)
+            metrics.ws_connections_active.dec(room_name)
+            presence.leave(room_name, self.presence_key)
+        if getattr(self, 'notification_group_name', None):
+            await self.channel_layer.group_discard(self.notification_group_name, self.channel_name)
+        logger.info(f"用戶 '{getattr(self, 'username', '未登入用戶')}' 的多工連線斷開，代碼: {close_code}")
+
+    @metrics.timed(metrics.ws_handler_seconds, 'multiplex', 'receive')
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            # 多工連線不協商子協定，只接受 JSON 文字幀
+            metrics.errors_total.inc('ws_invalid_frame')
+            logger.error("多工連線收到不支援的二進位幀。")
+            await self.send_control({"error": "Invalid binary frame."})
+            return
+        try:
+            data = wire.loads(text_data)
+            action = data.get('action')
+            if action == 'subscribe':
+                if data.get('stream') == 'notifications':
+                    await self.subscribe_notifications()
+                else:
+                    await self.subscribe(data.get('room'), data.get('last_seen_id'))
+            elif action == 'unsubscribe':
+                if data.get('stream') == 'notifications':
+                    await self.unsubscribe_notifications()
+                else:
+                    await self.unsubscribe(data.get('room'))
+            elif action == 'send':
+                await self.send_chat(data.get('room'), data.get('message'), data.get('client_msg_id'))
+            elif action == 'fetch_older':
+                await self.fetch_older(data.get('room'), data.get('before'), data.get('limit'))
+            else:
+                await self.send_control({"error": "未知的操作。"})
+        except wire.JSONDecodeError:
+            metrics.errors_total.inc('ws_invalid_json')
+            logger.error("多工連線收到非 JSON 格式的數據。")
+            await self.send_control({"error": "Invalid JSON format."})
+        except Exception as e:
+            metrics.errors_total.inc('ws_receive')
+            logger.error(f"多工連線處理消息時發生錯誤: {e}")
+            await self.send_control({"error": "Server error processing message."})
+
+    async def send_control(self, payload):
+        await self.send(text_data=wire.tag_frame('control', wire.dumps(payload)))
+
+    async def drain_connection(self):
+        await self.send_control(drain.reconnect_hint())
+        await self.close(code=drain.CLOSE_SERVICE_RESTART)
+
+    async def subscribe(self, room_name, last_seen_id=None):
+        if not is_valid_room_name(room_name):
+            await self.send_control({"error": "房間名稱格式無效。"})
+            return
+        if room_name not in self.rooms:
+            if len(self.rooms) >= settings.CHAT_MULTIPLEX_MAX_ROOMS:
+                await self.send_control({"error": "訂閱的聊天室數量已達上限。"})
+                return
+            await self.channel_layer.group_add(room_group_name(room_name), self.channel_name)
+            await local_fanout.join(self.channel_layer, room_group_name(room_name), room_name, self)
+            self.rooms.add(room_name)
+            metrics.ws_connections_active.inc(room_name)
+            presence.join(self.channel_layer, room_name, self.presence_key)
+        await self.send_control({"type": "subscribed", "room": room_name})
+        if last_seen_id is not None:
+            frame = await build_resume_frame(room_name, last_seen_id)
+            await self.send(text_data=wire.tag_frame(f'chat:{room_name}', frame))
+
+    async def unsubscribe(self, room_name):
+        if room_name in self.rooms:
+            await self.channel_layer.group_discard(room_group_name(room_name), self.channel_name)
+            await local_fanout.leave(self.channel_layer, room_group_name(room_name), room_name, self)
+            self.rooms.discard(room_name)
+            metrics.ws_connections_active.dec(room_name)
+            presence.leave(room_name, self.presence_key)
+        await self.send_control({"type": "unsubscribed", "room": room_name})
+
+    async def subscribe_notifications(self):
+        if not self.user.is_authenticated:
+            await self.send_control({"error": "需要登入才能訂閱個人通知。"})
+            return
+        if self.notification_group_name is None:
+            self.notification_group_name = f'user_notifications_{self.user.id}'
+            await self.channel_layer.group_add(self.notification_group_name, self.channel_name)
+        await self.send_control({"type": "subscribed", "stream": "notifications"})
+
+    async def unsubscribe_notifications(self):
+        if self.notification_group_name is not None:
+            await self.channel_layer.group_discard(self.notification_group_name, self.channel_name)
+            self.notification_group_name = None
+        await self.send_control({"type": "unsubscribed", "stream": "notifications"})
+
+    async def send_chat(self, room_name, message, client_msg_id=None):
+        if room_name not in self.rooms:
+            await self.send_control({"error": "請先訂閱該聊天室。"})
+            return
+        if not message or not isinstance(message, str) or not message.strip():
+            await self.send_control({"error": "消息內容為空或格式無效。"})
+            return
+        if client_msg_id is not None and not is_valid_client_msg_id(client_msg_id):
+            await self.send_control({"error": "client_msg_id 格式無效。"})
+            return
+        allowed, retry_after = check_message_rate(self.rate_bucket, self.user, self.client_address, room_name)
+        if not allowed:
+            await self.send_control({"error": "發送過於頻繁，請稍後再試。", "room": room_name, "retry_after": round(retry_after, 3)})
+            return
+        try:
+            await apublish_message(self.channel_layer, room_name, self.sender, self.username, message, client_msg_id)
+        except DuplicateMessage as e:
+            await self.send_control({"type": "duplicate", "room": room_name, "client_msg_id": e.client_msg_id, "id": e.message_id})
+        else:
+            await routers.amark_written(self.sticky_key)
+
+    async def fetch_older(self, room_name, before, limit):
+        if room_name not in self.rooms:
+            await self.send_control({"error": "請先訂閱該聊天室。"})
+            return
+        if before is not None and not isinstance(before, str):
+            await self.send_control({"error": "分頁游標格式無效。"})
+            return
+        try:
+            limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+            page = await db_sync_to_async(routers.on_replica(fetch_page, self.sticky_key))(room_name, before=before, limit=limit)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"收到無效的歷史分頁請求: {e}")
+            await self.send_control({"error": "分頁參數無效。"})
+            return
+        await self.send(text_data=wire.tag_frame(f'chat:{room_name}', wire.dumps({
+            'type': 'history',
+            'messages': page['messages'],
+            'older': page['older'],
+        })))
+
+    @metrics.timed(metrics.ws_handler_seconds, 'multiplex', 'chat_message')
+    async def chat_message(self, event):
+        room_name = event.get('room')
+        if room_name not in self.rooms:
+            return # 取消訂閱前已在途中的消息
+        frames = event.get('frames')
+        if frames is None:
+            frame = event.get('frame')
+            if frame is None:
+                frame = wire.build_chat_frame(event['message'], event['user'], event.get('timestamp', '時間未知'), event.get('id'))
+            frames = [frame]
+        for frame in frames:
+            self.outbound.put(wire.tag_frame(f'chat:{room_name}', frame))
+        metrics.messages_out_total.inc(amount=len(frames))
+
+    async def send_notification(self, event):
+        self.outbound.put(wire.tag_frame('notifications', wire.dumps({
+            'type': 'notification',
+            'message': event['message'],
+            'timestamp': event.get('timestamp'),
+        })))
+
 # 範例：通用通知 Consumer
 # class NotificationConsumer(AsyncWebsocketConsumer):
 #     async def connect(self):
@@ -0,0 +1,70 @@
+import functools
+import logging # 導入 logging 模組
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from . import metrics # Prometheus 指標
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_size = 0
+_executor_lock = threading.Lock()
+
+
+def get_db_executor():
+    """
+    取得 Consumer 資料庫操作共用的有界執行緒池；CHAT_DB_EXECUTOR_WORKERS 為 0 時返回 None。
+
+    Django 的 acreate 等異步 ORM 方法目前只是 sync_to_async(thread_sensitive=True) 的包裝，
+    同一個 worker 內所有連線的資料庫操作都排進同一條執行緒依序執行。
+    """
+    global _executor, _executor_size
+    size = settings.CHAT_DB_EXECUTOR_WORKERS
+    if size <= 0:
+        return None
+    if _executor is None or _executor_size != size:
+        with _executor_lock:
+            if _executor is None or _executor_size != size:
+                if _executor is not None:
+                    _executor.shutdown(wait=False)
+                _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='chat-db')
+                _executor_size = size
+    return _executor
+
+
+def _close_connections_on_error(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            # 池中的執行緒各自持有長期的資料庫連線，出錯後關閉，下次使用時重新連線
+            connections.close_all()
+            raise
+    return wrapper
+
+
+def db_sync_to_async(func):
+    """
+    在專用的資料庫執行緒池中執行同步的 ORM 呼叫，最多 CHAT_DB_EXECUTOR_WORKERS 個查詢同時進行，
+    事件循環不等待也不被阻塞。每條執行緒持有自己的資料庫連線，因此連線數同樣有上限。
+
+    未啟用執行緒池時退回 Django 預設的 sync_to_async (單一執行緒)。
+    """
+    executor = get_db_executor()
+    if executor is None:
+        return sync_to_async(func)
+    return sync_to_async(_close_connections_on_error(func), thread_sensitive=False, executor=executor)
+
+
+@metrics.register_collector
+def _collect_metrics():
+    if _executor is None:
+        return []
+    return [('chat_db_executor_pending', 'gauge', '等待資料庫執行緒池的操作數', [({}, _executor._work_queue.qsize())])]
@@ -0,0 +1,265 @@
+import asyncio
+import logging # 導入 logging 模組
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics # Prometheus 指標
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+MAX_CLIENT_MSG_ID_LENGTH = 64 # 與 ChatMessage.client_msg_id 欄位長度一致
+
+
+class DuplicateMessage(Exception):
+    """
+    同一聊天室內已處理過相同 client_msg_id 的消息。message_id 為原消息的 id (尚未寫入或寫後模式下為 None)。
+    """
+
+    def __init__(self, client_msg_id, message_id=None):
+        super().__init__(client_msg_id)
+        self.client_msg_id = client_msg_id
+        self.message_id = message_id
+
+
+def is_valid_client_msg_id(client_msg_id):
+    return isinstance(client_msg_id, str) and 0 < len(client_msg_id) <= MAX_CLIENT_MSG_ID_LENGTH
+
+
+class DedupCache:
+    """
+    客戶端消息 id 的去重快取。
+
+    claim() 原子地登記 (聊天室, client_msg_id)：第一次返回 (True, None)，重試返回 (False, 原消息 id)。
+    消息寫入資料庫取得 id 後以 complete() 記下，之後的重試可直接回覆原消息 id。
+    項目在 ttl 秒後過期；過期或被淘汰後的重試由資料庫的唯一約束擋下。
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(room_name, client_msg_id):
+        return f'{room_name}:{client_msg_id}'
+
+    def claim(self, room_name, client_msg_id):
+        raise NotImplementedError
+
+    def complete(self, room_name, client_msg_id, message_id):
+        raise NotImplementedError
+
+    def release(self, room_name, client_msg_id):
+        """
+        發送失敗時撤銷登記，讓客戶端的重試可以重新發送。
+        """
+        raise NotImplementedError
+
+    async def aclaim(self, room_name, client_msg_id):
+        return self.claim(room_name, client_msg_id)
+
+    async def acomplete(self, room_name, client_msg_id, message_id):
+        self.complete(room_name, client_msg_id, message_id)
+
+    async def arelease(self, room_name, client_msg_id):
+        self.release(room_name, client_msg_id)
+
+
+class LocalDedupCache(DedupCache):
+    """
+    進程內的 TTL + LRU 快取，最多保留 max_keys 個 id。只能擋下送到同一個 worker 的重試。
+    """
+
+    def __init__(self, ttl=300, max_keys=100000):
+        super().__init__(ttl=ttl)
+        self.max_keys = max_keys
+        self._entries = OrderedDict() # 鍵 -> [過期時間, 消息 id]
+        self._lock = threading.Lock() # REST API 在執行緒池中並行呼叫
+
+    def claim(self, room_name, client_msg_id):
+        key = self._key(room_name, client_msg_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return False, entry[1]
+            self._entries[key] = [now + self.ttl, None]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        return True, None
+
+    def complete(self, room_name, client_msg_id, message_id):
+        with self._lock:
+            entry = self._entries.get(self._key(room_name, client_msg_id))
+            if entry is not None:
+                entry[1] = message_id
+
+    def release(self, room_name, client_msg_id):
+        with self._lock:
+            self._entries.pop(self._key(room_name, client_msg_id), None)
+
+
+class RedisDedupCache(DedupCache):
+    """
+    以 Redis 共用的去重快取，重試送到不同 worker 也能擋下。claim 以 SET NX EX 完成，一次往返。
+    Redis 不可用時放行，由資料庫的唯一約束擋下重複寫入。
+    """
+
+    key_prefix = 'chat:dedup:'
+    pending = b'' # 已登記但尚未取得消息 id
+
+    def __init__(self, url, ttl=300):
+        super().__init__(ttl=ttl)
+        import redis # channels_redis 的依賴，已隨 requirements.txt 安裝
+        # 去重位於發送路徑上，Redis 無回應時應儘快放棄
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self._url = url
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self):
+        from redis import asyncio as aioredis
+        # redis.asyncio 連線綁定事件循環，每個事件循環各自建立客戶端
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = aioredis.Redis.from_url(
+                self._url, socket_connect_timeout=1, socket_timeout=1)
+        return client
+
+    def _redis_key(self, room_name, client_msg_id):
+        return f'{self.key_prefix}{self._key(room_name, client_msg_id)}'
+
+    @staticmethod
+    def _claimed(created, existing):
+        if created:
+            return True, None
+        return False, int(existing) if existing else None
+
+    def claim(self, room_name, client_msg_id):
+        key = self._redis_key(room_name, client_msg_id)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.set(key, self.pending, nx=True, ex=self.ttl)
+        pipe.get(key)
+        return self._claimed(*pipe.execute())
+
+    def complete(self, room_name, client_msg_id, message_id):
+        self._client.set(self._redis_key(room_name, client_msg_id), message_id, xx=True, keepttl=True)
+
+    def release(self, room_name, client_msg_id):
+        self._client.delete(self._redis_key(room_name, client_msg_id))
+
+    async def aclaim(self, room_name, client_msg_id):
+        key = self._redis_key(room_name, client_msg_id)
+        async with self._async_client().pipeline(transaction=False) as pipe:
+            pipe.set(key, self.pending, nx=True, ex=self.ttl)
+            pipe.get(key)
+            return self._claimed(*await pipe.execute())
+
+    async def acomplete(self, room_name, client_msg_id, message_id):
+        await self._async_client().set(self._redis_key(room_name, client_msg_id), message_id, xx=True, keepttl=True)
+
+    async def arelease(self, room_name, client_msg_id):
+        await self._async_client().delete(self._redis_key(room_name, client_msg_id))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_dedup_cache():
+    """
+    取得本進程共用的去重快取；CHAT_DEDUP_BACKEND 為 'none' 時返回 None (只依賴資料庫唯一約束)。
+    """
+    global _cache
+    backend = settings.CHAT_DEDUP_BACKEND
+    if backend == 'none':
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if backend == 'redis':
+                    _cache = RedisDedupCache(settings.CHAT_DEDUP_REDIS_URL, ttl=settings.CHAT_DEDUP_TTL)
+                else:
+                    _cache = LocalDedupCache(ttl=settings.CHAT_DEDUP_TTL, max_keys=settings.CHAT_DEDUP_MAX_KEYS)
+    return _cache
+
+
+def _cache_error(e):
+    metrics.errors_total.inc('dedup_cache')
+    logger.error(f"消息去重快取發生錯誤，暫時略過去重: {e}")
+
+
+def claim(room_name, client_msg_id):
+    """
+    登記一條帶 client_msg_id 的消息；重複時拋出 DuplicateMessage。快取故障時放行。
+    """
+    cache = get_dedup_cache()
+    if cache is None:
+        return
+    try:
+        claimed, message_id = cache.claim(room_name, client_msg_id)
+    except Exception as e:
+        _cache_error(e)
+        return
+    if not claimed:
+        raise DuplicateMessage(client_msg_id, message_id)
+
+
+async def aclaim(room_name, client_msg_id):
+    """
+    claim 的異步版本，供 Consumer 使用。
+    """
+    cache = get_dedup_cache()
+    if cache is None:
+        return
+    try:
+        claimed, message_id = await cache.aclaim(room_name, client_msg_id)
+    except Exception as e:
+        _cache_error(e)
+        return
+    if not claimed:
+        raise DuplicateMessage(client_msg_id, message_id)
+
+
+def complete(room_name, client_msg_id, message_id):
+    cache = get_dedup_cache()
+    if cache is None or message_id is None:
+        return
+    try:
+        cache.complete(room_name, client_msg_id, message_id)
+    except Exception as e:
+        _cache_error(e)
+
+
+async def acomplete(room_name, client_msg_id, message_id):
+    cache = get_dedup_cache()
+    if cache is None or message_id is None:
+        return
+    try:
+        await cache.acomplete(room_name, client_msg_id, message_id)
+    except Exception as e:
+        _cache_error(e)
+
+
+def release(room_name, client_msg_id):
+    cache = get_dedup_cache()
+    if cache is None:
+        return
+    try:
+        cache.release(room_name, client_msg_id)
+    except Exception as e:
+        _cache_error(e)
+
+
+async def arelease(room_name, client_msg_id):
+    cache = get_dedup_cache()
+    if cache is None:
+        return
+    try:
+        await cache.arelease(room_name, client_msg_id)
+    except Exception as e:
+        _cache_error(e)
@@ -0,0 +1,74 @@
+import asyncio
+import logging # 導入 logging 模組
+import os
+import random
+import signal
+import weakref
+
+from django.conf import settings
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+# 伺服器重啟中的 WebSocket 關閉代碼，客戶端應稍後重連。對應標準的 1012 (Service Restart)，
+# 但 daphne 使用的 autobahn 只允許伺服器送出 1000 或 3000-4999，因此使用私有範圍的 4012
+CLOSE_SERVICE_RESTART = 4012
+
+_connections = weakref.WeakSet() # 本進程目前的 WebSocket consumer
+_draining = False
+
+
+def is_draining():
+    return _draining
+
+
+def register(consumer):
+    _connections.add(consumer)
+
+
+def unregister(consumer):
+    _connections.discard(consumer)
+
+
+def reconnect_hint():
+    """
+    發給客戶端的重連提示。retry_after 在 0 到 CHAT_DRAIN_RECONNECT_JITTER 秒之間隨機分布，
+    避免所有客戶端在同一時刻湧向其他 worker。
+    """
+    return {'type': 'reconnect', 'retry_after': round(random.uniform(0, settings.CHAT_DRAIN_RECONNECT_JITTER), 3)}
+
+
+def begin():
+    """
+    開始排空本進程的連線，必須在事件循環中呼叫 (由 runworkers 的 SIGUSR1 處理器觸發)。
+
+    新連線一律拒絕；既有連線在 CHAT_DRAIN_TIMEOUT 的前 80% 時間內分批收到重連提示並關閉，
+    全部關閉後向本進程發送 SIGTERM，由 daphne 正常結束。
+    """
+    global _draining
+    if _draining:
+        return
+    _draining = True
+    logger.info(f"開始排空 {len(_connections)} 個 WebSocket 連線。")
+    asyncio.ensure_future(_drain())
+
+
+async def _drain():
+    consumers = list(_connections)
+    random.shuffle(consumers)
+    window = settings.CHAT_DRAIN_TIMEOUT * 0.8
+
+    async def close_later(consumer, delay):
+        await asyncio.sleep(delay)
+        try:
+            await consumer.drain_connection()
+        except Exception as e:
+            logger.error(f"排空連線時發生錯誤: {e}")
+
+    await asyncio.gather(*(
+        close_later(consumer, window * index / len(consumers))
+        for index, consumer in enumerate(consumers)
+    ))
+    await asyncio.sleep(1) # 讓最後的關閉幀送出
+    logger.info("WebSocket 連線已全部排空，結束 worker。")
+    os.kill(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,80 @@
+import asyncio
+import logging # 導入 logging 模組
+from collections import defaultdict
+
+from django.conf import settings
+
+from . import metrics # Prometheus 指標
+from . import wire # WebSocket 幀編碼
+from .fanout import abroadcast # 群發 (大型聊天室走進程內群發)
+from .messaging import room_group_name
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+
+class EphemeralRelay:
+    """
+    輸入中提示與已讀回執等短暫事件的轉發：不寫入資料庫，也不進入最近消息快取。
+
+    每個聊天室每個用戶只保留最新狀態 (輸入中以最後一次為準，已讀位置取最大值)，
+    背景任務每隔 window 秒把每個有變化的聊天室合併成一個 ephemeral 幀群發一次，
+    群發次數與聊天室數成正比，而不是與按鍵次數成正比。
+    """
+
+    def __init__(self, window=0.25):
+        self.window = window
+        self._typing = defaultdict(dict) # 聊天室 -> {用戶名稱: 是否正在輸入}
+        self._read = defaultdict(dict) # 聊天室 -> {用戶名稱: 最後已讀消息 id}
+        self._channel_layer = None
+        self._task = None
+
+    def typing(self, channel_layer, room_name, username, is_typing):
+        self._typing[room_name][username] = is_typing
+        self._ensure_started(channel_layer)
+
+    def read(self, channel_layer, room_name, username, last_read_id):
+        pending = self._read[room_name]
+        if last_read_id > pending.get(username, 0):
+            pending[username] = last_read_id
+        self._ensure_started(channel_layer)
+
+    def _ensure_started(self, channel_layer):
+        self._channel_layer = channel_layer
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        # 沒有事件時結束，下一個事件再啟動
+        while self._typing or self._read:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception as e:
+                metrics.errors_total.inc('ephemeral')
+                logger.error(f"轉發短暫事件時發生錯誤: {e}")
+
+    async def flush(self):
+        typing, self._typing = self._typing, defaultdict(dict)
+        read, self._read = self._read, defaultdict(dict)
+        for room_name in set(typing) | set(read):
+            frame = {'type': 'ephemeral'}
+            if typing.get(room_name):
+                frame['typing'] = typing[room_name]
+            if read.get(room_name):
+                frame['read'] = read[room_name]
+            metrics.ephemeral_frames_total.inc()
+            await abroadcast(self._channel_layer, room_group_name(room_name), room_name, wire.dumps(frame))
+
+
+_relay = None
+
+
+def get_ephemeral_relay():
+    """
+    取得本進程共用的短暫事件轉發器；只在事件循環中使用，不需要加鎖。
+    """
+    global _relay
+    if _relay is None:
+        _relay = EphemeralRelay(window=settings.CHAT_EPHEMERAL_WINDOW_MS / 1000)
+    return _relay
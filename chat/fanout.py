@@ -0,0 +1,169 @@
+import asyncio
+import logging # 導入 logging 模組
+import time
+import weakref
+from collections import defaultdict
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+
+from . import metrics # Prometheus 指標
+from . import wire # WebSocket 幀編碼
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+
+class LocalFanout:
+    """
+    大型聊天室的進程內群發。
+
+    channels_redis 的 group_send 每條消息都要讀出整個群組的成員列表，並把成員頻道名稱
+    隨消息寫回 Redis，成本與聊天室人數成正比。對成員數達到門檻的聊天室，發送端改為
+    PUBLISH 一次；每個 daphne 進程只為「本進程有成員」的聊天室 SUBSCRIBE 一次，
+    收到後在記憶體中直接交給本進程的 consumer，Redis 流量因此只與 worker 數成正比。
+
+    consumer 仍照常加入群組，發送端每條消息只走其中一條路徑，客戶端不會收到重複消息。
+    """
+
+    def __init__(self):
+        self._members = defaultdict(set) # 聊天室 -> 本進程的 consumer
+        # 事件循環 -> {分片序號: [PubSub, 監聽任務]}；redis.asyncio 連線綁定事件循環
+        self._pubsubs = weakref.WeakKeyDictionary()
+        self._sizes = {} # 群組 -> (成員數, 過期時間)
+
+    @staticmethod
+    def enabled(channel_layer):
+        return settings.CHAT_LOCAL_FANOUT_THRESHOLD > 0 and isinstance(channel_layer, RedisChannelLayer)
+
+    @staticmethod
+    def _channel(channel_layer, room_name):
+        return f'{channel_layer.prefix}:fanout:{room_name}'
+
+    async def join(self, channel_layer, group, room_name, consumer):
+        """
+        consumer 加入聊天室；本進程第一個成員加入時訂閱該聊天室的廣播頻道。
+        """
+        if not self.enabled(channel_layer):
+            return
+        members = self._members[room_name]
+        members.add(consumer)
+        if len(members) == 1:
+            index = channel_layer.consistent_hash(group)
+            pubsubs = self._pubsubs.setdefault(asyncio.get_running_loop(), {})
+            entry = pubsubs.get(index)
+            if entry is None:
+                # 每個分片一條訂閱連線，由一個背景任務分派所有聊天室的消息
+                entry = pubsubs[index] = [channel_layer.connection(index).pubsub(ignore_subscribe_messages=True), None]
+            await entry[0].subscribe(self._channel(channel_layer, room_name))
+            if entry[1] is None or entry[1].done():
+                self._start_listener(channel_layer, entry)
+
+    async def leave(self, channel_layer, group, room_name, consumer):
+        """
+        consumer 離開聊天室；本進程最後一個成員離開時取消訂閱。
+        """
+        members = self._members.get(room_name)
+        if not members or consumer not in members:
+            return
+        members.discard(consumer)
+        if not members:
+            del self._members[room_name]
+            entry = self._pubsubs.get(asyncio.get_running_loop(), {}).get(channel_layer.consistent_hash(group))
+            if entry is not None:
+                await entry[0].unsubscribe(self._channel(channel_layer, room_name))
+
+    async def is_large_room(self, channel_layer, group):
+        """
+        聊天室成員數是否達到門檻。成員數直接讀取群組的 sorted set (ZCARD)，
+        每個群組每 CHAT_LOCAL_FANOUT_CHECK_INTERVAL 秒最多查詢一次。
+        """
+        if not self.enabled(channel_layer):
+            return False
+        now = time.monotonic()
+        cached = self._sizes.get(group)
+        if cached is None or cached[1] <= now:
+            connection = channel_layer.connection(channel_layer.consistent_hash(group))
+            size = await connection.zcard(channel_layer._group_key(group))
+            cached = self._sizes[group] = (size, now + settings.CHAT_LOCAL_FANOUT_CHECK_INTERVAL)
+        return cached[0] >= settings.CHAT_LOCAL_FANOUT_THRESHOLD
+
+    async def publish(self, channel_layer, group, room_name, frame):
+        connection = channel_layer.connection(channel_layer.consistent_hash(group))
+        await connection.publish(self._channel(channel_layer, room_name), frame)
+
+    async def publish_many(self, channel_layer, group, room_name, frames):
+        connection = channel_layer.connection(channel_layer.consistent_hash(group))
+        async with connection.pipeline(transaction=False) as pipe:
+            for frame in frames:
+                pipe.publish(self._channel(channel_layer, room_name), frame)
+            await pipe.execute()
+
+    def _start_listener(self, channel_layer, entry):
+        entry[1] = asyncio.get_running_loop().create_task(self._listen(channel_layer, entry[0]))
+        entry[1].add_done_callback(lambda task: self._listener_done(channel_layer, entry, task))
+
+    def _listener_done(self, channel_layer, entry, task):
+        """
+        監聽任務意外結束時記錄錯誤並重新啟動，否則該分片上所有大型聊天室都會停止收到消息。
+        """
+        if task.cancelled() or entry[1] is not task:
+            return
+        error = task.exception()
+        metrics.errors_total.inc('local_fanout')
+        logger.error(f"進程內群發的監聽任務意外結束，重新啟動: {error!r}")
+        # 稍後重新啟動，避免持續失敗時空轉；期間若已有新成員加入並啟動新任務則略過
+        asyncio.get_running_loop().call_later(
+            1.0, lambda: entry[1] is task and entry[0].channels and self._start_listener(channel_layer, entry))
+
+    async def _listen(self, channel_layer, pubsub):
+        prefix_length = len(self._channel(channel_layer, ''))
+        while True:
+            try:
+                message = await pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 連線中斷時 redis-py 重連後會自動重新訂閱
+                metrics.errors_total.inc('local_fanout')
+                logger.error(f"進程內群發的訂閱連線發生錯誤: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message.get('type') != 'message':
+                continue
+            room_name = message['channel'].decode('utf-8')[prefix_length:]
+            event = wire.chat_message_event(message['data'].decode('utf-8'), room_name)
+            for consumer in list(self._members.get(room_name, ())):
+                try:
+                    await consumer.chat_message(event)
+                except Exception as e:
+                    # 單一 consumer 的錯誤不影響同一分片上的其他聊天室
+                    metrics.errors_total.inc('local_fanout')
+                    logger.error(f"進程內群發轉交消息到聊天室 {room_name} 時發生錯誤: {e}")
+
+
+local_fanout = LocalFanout()
+
+
+async def abroadcast(channel_layer, group, room_name, frame):
+    """
+    把已編碼的 chat_message 幀送到聊天室：大型聊天室走進程內群發，其餘走 group_send。
+    """
+    if await local_fanout.is_large_room(channel_layer, group):
+        metrics.broadcasts_total.inc('local_fanout')
+        await local_fanout.publish(channel_layer, group, room_name, frame)
+    else:
+        metrics.broadcasts_total.inc('group_send')
+        await channel_layer.group_send(group, wire.chat_message_event(frame, room_name))
+
+
+async def abroadcast_frames(channel_layer, group, room_name, frames):
+    """
+    把同一聊天室的多個已編碼幀一次送出：group_send 只讀取一次成員列表，大型聊天室以管線 PUBLISH。
+    """
+    if await local_fanout.is_large_room(channel_layer, group):
+        metrics.broadcasts_total.inc('local_fanout')
+        await local_fanout.publish_many(channel_layer, group, room_name, frames)
+    else:
+        metrics.broadcasts_total.inc('group_send')
+        await channel_layer.group_send(group, wire.chat_messages_event(frames, room_name))
@@ -0,0 +1,249 @@
+import base64
+import binascii
+import logging # 導入 logging 模組
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import archive # 冷資料歸檔
+from .cache import get_recent_cache # 每個聊天室的最近消息快取
+from .models import ChatMessage # 確保導入 ChatMessage 模型
+from .persistence import get_write_behind_buffer # 寫後緩衝區
+from .routers import reading_from_replica # 讀寫分離
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50 # 每頁預設消息數
+MAX_PAGE_SIZE = 200 # 每頁最大消息數
+
+# 只取出序列化需要的欄位，避免建立完整的模型實例
+HISTORY_FIELDS = ('id', 'content', 'timestamp', 'sender__username')
+
+
+def encode_cursor(timestamp, message_id):
+    """
+    將 (timestamp, id) 編碼為不透明的分頁游標。
+
+    寫後模式下尚未寫入資料庫的消息沒有 id，此時以 0 代替，游標退化為「早於該時間戳」。
+    """
+    if isinstance(timestamp, str):
+        timestamp = parse_datetime(timestamp)
+    raw = f'{timestamp.isoformat()}|{message_id or 0}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    解碼分頁游標，返回 (timestamp, id)。格式無效時拋出 ValueError。
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        timestamp_str, id_str = raw.rsplit('|', 1)
+        timestamp = parse_datetime(timestamp_str)
+        message_id = int(id_str)
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise ValueError(f'無效的分頁游標: {cursor}') from e
+    if timestamp is None:
+        raise ValueError(f'無效的分頁游標: {cursor}')
+    return timestamp, message_id
+
+
+def serialize_message(row):
+    """
+    將 values() 查詢結果轉為前端使用的消息格式。
+    """
+    return {
+        'id': row['id'],
+        'message': row['content'],
+        'user': row['sender__username'] or '未登入用戶',
+        'timestamp': row['timestamp'].isoformat(),
+    }
+
+
+def serialize_chat_message(message_id, content, username, timestamp):
+    """
+    將剛寫入 (或放入寫後緩衝區，此時 message_id 為 None) 的消息轉為與歷史消息相同的格式。
+    """
+    return {
+        'id': message_id,
+        'message': content,
+        'user': username,
+        'timestamp': timestamp.isoformat(),
+    }
+
+
+def fetch_latest_from_cache(room_name, limit):
+    """
+    從最近消息快取讀取最新一頁；未命中或快取不足以回答時返回 None。
+    """
+    cache = get_recent_cache()
+    if cache is None:
+        return None
+    try:
+        cached = cache.get(room_name)
+    except Exception as e:
+        logger.error(f"讀取最近消息快取時發生錯誤: {e}")
+        return None
+    if cached is None:
+        return None
+    if len(cached) < limit and len(cached) >= cache.size:
+        # 快取已滿但比請求的頁面小，必須回到資料庫
+        return None
+    # 快取未滿代表該聊天室所有消息都在快取中
+    return _latest_page(cached, limit, has_more=len(cached) >= cache.size)
+
+
+def _latest_page(messages, limit, has_more):
+    """
+    從由舊到新排列的消息中取出最新 limit 條，組成最新一頁。
+    """
+    page_messages = messages[-limit:]
+    has_older = len(messages) > limit or has_more
+    return {
+        'messages': page_messages,
+        'older': encode_cursor(page_messages[0]['timestamp'], page_messages[0]['id']) if page_messages and has_older else None,
+        'newer': None,
+    }
+
+
+def fill_token(room_name):
+    """
+    查詢資料庫前取得回填快取用的 token；不回填 (未啟用快取、讀取副本或快取故障) 時返回 None。
+    """
+    cache = get_recent_cache()
+    if cache is None or reading_from_replica():
+        # 副本可能落後主庫，以副本的結果建立快取會遺漏最新的消息，直到快取過期
+        return None
+    buffer = get_write_behind_buffer()
+    if buffer is not None and buffer.has_pending(room_name):
+        # 寫後緩衝區中的消息還不在資料庫中，此時回填的快取會缺少它們直到過期
+        return None
+    try:
+        return cache.fill_token(room_name)
+    except Exception as e:
+        logger.error(f"讀取最近消息快取時發生錯誤: {e}")
+        return None
+
+
+def fill_cache(room_name, page, token):
+    """
+    以資料庫查詢的最新一頁建立快取；查詢期間聊天室有新消息時放棄回填。
+    """
+    if token is None:
+        return
+    cache = get_recent_cache()
+    try:
+        cache.fill(room_name, page['messages'][-cache.size:], token)
+    except Exception as e:
+        logger.error(f"寫入最近消息快取時發生錯誤: {e}")
+
+
+def fetch_page(room_name, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    以 (timestamp, id) 鍵集分頁讀取聊天室歷史消息。
+
+    - 未指定游標：返回最新一頁。
+    - before：返回該游標之前 (更早) 的一頁。
+    - after：返回該游標之後 (更新) 的一頁。
+
+    返回的消息一律依時間由舊到新排列，並附上 older / newer 游標 (沒有更多時為 None)。
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if before is None and after is None:
+        # 最新一頁優先由快取回答，未命中時查詢資料庫並回填快取
+        page = fetch_latest_from_cache(room_name, limit)
+        if page is not None:
+            return page
+        cache = get_recent_cache()
+        token = fill_token(room_name)
+        if cache is not None and cache.size > limit:
+            # 一次讀取整個緩衝區大小的消息回填快取，再從中切出請求的頁面
+            page = _query_page(room_name, None, None, cache.size)
+            fill_cache(room_name, page, token)
+            return _latest_page(page['messages'], limit, has_more=page['older'] is not None)
+        page = _query_page(room_name, None, None, limit)
+        fill_cache(room_name, page, token)
+        return page
+    return _query_page(room_name, before, after, limit)
+
+
+def _query_page(room_name, before, after, limit):
+    queryset = ChatMessage.objects.filter(room_name=room_name)
+
+    if after is not None:
+        timestamp, message_id = decode_cursor(after)
+        # 游標早於資料庫中的消息時，先從歸檔讀取，再接上資料庫中的消息
+        messages = archive.fetch_archived_after(room_name, (timestamp, message_id), limit + 1)
+        if len(messages) <= limit:
+            if messages:
+                # 已讀完歸檔，從最後一條歸檔消息之後接上；歸檔中途中斷時已歸檔的行可能仍留在資料庫中
+                timestamp, message_id = parse_datetime(messages[-1]['timestamp']), messages[-1]['id']
+            # timestamp__gte 讓資料庫能在 (room_name, timestamp, id) 索引上做範圍掃描
+            queryset = queryset.filter(timestamp__gte=timestamp).filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+            ).order_by('timestamp', 'id')
+            messages += [serialize_message(row) for row in queryset.values(*HISTORY_FIELDS)[:limit + 1 - len(messages)]]
+        has_newer = len(messages) > limit
+        messages = messages[:limit]
+        has_older = True
+    else:
+        if before is not None:
+            timestamp, message_id = decode_cursor(before)
+            queryset = queryset.filter(timestamp__lte=timestamp).filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+            )
+        queryset = queryset.order_by('-timestamp', '-id')
+        rows = list(queryset.values(*HISTORY_FIELDS)[:limit + 1])
+        rows.reverse()
+        messages = [serialize_message(row) for row in rows]
+        if len(rows) <= limit:
+            # 資料庫中已沒有更早的消息，捲動超過時改讀歸檔
+            if rows:
+                bound = (rows[0]['timestamp'], rows[0]['id'])
+            else:
+                bound = decode_cursor(before) if before is not None else None
+            messages = archive.fetch_archived_before(room_name, bound, limit + 1 - len(rows)) + messages
+        has_older = len(messages) > limit
+        messages = messages[-limit:]
+        has_newer = before is not None
+
+    return {
+        'messages': messages,
+        'older': encode_cursor(messages[0]['timestamp'], messages[0]['id']) if messages and has_older else None,
+        'newer': encode_cursor(messages[-1]['timestamp'], messages[-1]['id']) if messages and has_newer else None,
+    }
+
+
+def fetch_since(room_name, last_seen_id, limit):
+    """
+    取得 id 大於 last_seen_id 的消息 (由舊到新)，供斷線重連補發。
+
+    返回 (messages, complete)：遺漏超過 limit 條時 complete 為 False，messages 為空，
+    客戶端應改為重新載入整頁。
+
+    只有所有 worker 共用的快取 (Redis) 才包含其他 worker 寫入的消息，可以由快取回答；
+    進程內快取只看得到本進程的發送，一律走 (room_name, id) 索引。
+    """
+    cache = get_recent_cache()
+    if cache is not None and cache.shared:
+        try:
+            cached = cache.get(room_name)
+        except Exception as e:
+            logger.error(f"讀取最近消息快取時發生錯誤: {e}")
+            cached = None
+        # 快取是該聊天室最新的連續消息，最舊一條不晚於 last_seen_id 時涵蓋了所有遺漏的消息
+        if cached and all(m['id'] is not None for m in cached) and cached[0]['id'] <= last_seen_id:
+            missed = [m for m in cached if m['id'] is None or m['id'] > last_seen_id]
+            if len(missed) <= limit:
+                return missed, True
+            return [], False
+
+    rows = list(
+        ChatMessage.objects.filter(room_name=room_name, id__gt=last_seen_id)
+        .order_by('id').values(*HISTORY_FIELDS)[:limit + 1]
+    )
+    if len(rows) > limit:
+        return [], False
+    return [serialize_message(row) for row in rows], True
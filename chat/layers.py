@@ -0,0 +1,71 @@
+import hashlib
+from bisect import bisect
+from functools import lru_cache
+
+from channels_redis.core import RedisChannelLayer
+
+DEFAULT_VIRTUAL_NODES = 160 # 每個 Redis 主機在雜湊環上的虛擬節點數
+
+
+def _hash(value):
+    # 穩定的 64 位元雜湊，不同進程、不同 Python 版本結果一致 (內建 hash() 每次啟動都不同)
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def host_label(host):
+    """
+    主機在雜湊環上的識別字串。以位址而非在 hosts 中的順序計算，
+    因此增加或移除主機時，其他主機負責的聊天室不受影響。
+    """
+    if isinstance(host, dict):
+        return str(host.get('address') or sorted(host.items()))
+    return str(host)
+
+
+class HashRing:
+    """
+    一致性雜湊環：每個節點放置 virtual_nodes 個虛擬節點，鍵落在順時針方向的第一個虛擬節點。
+    加入第 N 個節點時只有約 1/N 的鍵會移動。
+    """
+
+    def __init__(self, labels, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        points = sorted(
+            (_hash(f'{label}#{replica}'), index)
+            for index, label in enumerate(labels)
+            for replica in range(virtual_nodes)
+        )
+        self._points = [point for point, _ in points]
+        self._nodes = [index for _, index in points]
+
+    def node(self, key):
+        """
+        返回 key 所屬節點在 labels 中的序號。
+        """
+        position = bisect(self._points, _hash(key))
+        return self._nodes[position % len(self._nodes)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    以一致性雜湊把聊天室分散到多個 Redis 主機的頻道層。
+
+    群組 (例如 chat_<room>) 的成員與 group_send 都落在同一個分片上，每個 daphne 進程的
+    process-local 頻道也固定在一個分片；不同聊天室的負載則平均分散到所有主機。
+    channels_redis 內建的雜湊是對主機數取模，增加主機時幾乎所有群組都會換分片；
+    這裡改用雜湊環，只有約 1/N 的聊天室會移動。
+
+    所有進程必須使用相同的 hosts 列表，否則同一個聊天室會被不同進程送到不同分片。
+    """
+
+    def __init__(self, hosts=None, virtual_nodes=DEFAULT_VIRTUAL_NODES, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing([host_label(host) for host in self.hosts], virtual_nodes)
+        # 群組名稱與進程頻道名稱重複出現，快取雜湊結果
+        self._shard_for = lru_cache(maxsize=65536)(self.ring.node)
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return self._shard_for(value)
@@ -0,0 +1,72 @@
+import time
+from datetime import timedelta, timezone as dt_timezone
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from chat import archive
+from chat.history import HISTORY_FIELDS, serialize_message
+from chat.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = (
+        '把早於保留天數的消息移入每個聊天室、每天一個的 gzip JSONL 歸檔檔，再分批從資料庫刪除。'
+        '每批只鎖定少量行，可在服務運行時執行；重複執行不會產生重複的歸檔。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.CHAT_ARCHIVE_RETENTION_DAYS,
+                            help='歸檔早於此天數的消息')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_ARCHIVE_BATCH_SIZE,
+                            help='每批搬移並刪除的行數')
+        parser.add_argument('--sleep', type=float, default=0.1, help='批次之間暫停的秒數，讓出資料庫給線上請求')
+        parser.add_argument('--room', action='append', help='只歸檔指定的聊天室 (可重複)')
+        parser.add_argument('--dry-run', action='store_true', help='只列出各聊天室待歸檔的消息數')
+        parser.add_argument('--every', type=float, default=0, help='每隔此秒數重複執行 (排程模式)；0 表示只執行一次')
+
+    def handle(self, *args, **options):
+        while True:
+            self._archive_once(options)
+            if options['every'] <= 0:
+                return
+            close_old_connections()
+            time.sleep(options['every'])
+
+    def _archive_once(self, options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        rooms = options['room'] or list(
+            ChatMessage.objects.filter(timestamp__lt=cutoff).order_by().values_list('room_name', flat=True).distinct()
+        )
+        if options['dry_run']:
+            for room_name in rooms:
+                count = ChatMessage.objects.filter(room_name=room_name, timestamp__lt=cutoff).count()
+                self.stdout.write(f'{room_name}: {count} 條消息待歸檔')
+            return
+
+        total = 0
+        for room_name in rooms:
+            archived, deleted = self._archive_room(room_name, cutoff, options)
+            total += deleted
+            self.stdout.write(f'{room_name}: 歸檔 {archived} 條，刪除 {deleted} 行')
+        self.stdout.write(self.style.SUCCESS(f'完成：共移出 {total} 條早於 {cutoff.isoformat()} 的消息'))
+
+    def _archive_room(self, room_name, cutoff, options):
+        archived = deleted = 0
+        while True:
+            # 走 (room_name, timestamp, id) 索引，每批從最舊的消息開始
+            rows = list(
+                ChatMessage.objects.filter(room_name=room_name, timestamp__lt=cutoff)
+                .order_by('timestamp', 'id').values(*HISTORY_FIELDS)[:options['batch_size']]
+            )
+            if not rows:
+                return archived, deleted
+            for day, day_rows in groupby(rows, key=lambda row: row['timestamp'].astimezone(dt_timezone.utc).date()):
+                archived += archive.append_block(room_name, day, [serialize_message(row) for row in day_rows])
+            # 歸檔已落盤並記入索引後才刪除；中途失敗時下次執行會略過已歸檔的消息
+            deleted += ChatMessage.objects.filter(id__in=[row['id'] for row in rows]).delete()[0]
+            if options['sleep'] > 0:
+                time.sleep(options['sleep'])
@@ -0,0 +1,58 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from chat import pages
+from chat.models import ChatMessage, Room
+
+BENCH_ROOM_PREFIX = 'bench_bulk_' # 基準測試用的聊天室名稱前綴
+BENCH_USERNAME = 'bench_bulk_admin'
+
+
+class Command(BaseCommand):
+    help = (
+        '量測批次發送 API (api/send_messages/) 在不同批次大小下每秒可發送的消息數，'
+        '批次大小 1 相當於逐條呼叫 SendMessageAPI。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='每種批次大小發送的消息總數')
+        parser.add_argument('--batch-sizes', default='1,10,100,500', help='以逗號分隔的批次大小')
+        parser.add_argument('--rooms', type=int, default=20, help='消息分散到的聊天室數')
+        parser.add_argument('--keep', action='store_true', help='結束後保留測試資料')
+
+    def handle(self, *args, **options):
+        rooms = [f'{BENCH_ROOM_PREFIX}{i}' for i in range(options['rooms'])]
+        user, _ = User.objects.get_or_create(username=BENCH_USERNAME, defaults={'is_staff': True})
+        try:
+            client = Client()
+            client.force_login(user)
+            self.stdout.write(f"每種批次大小發送 {options['messages']} 條消息，分散到 {len(rooms)} 個聊天室")
+            for batch_size in [int(size) for size in options['batch_sizes'].split(',')]:
+                rate, latency = self._run(client, rooms, options['messages'], batch_size)
+                self.stdout.write(f'  batch={batch_size:<5} {rate:>9,.0f} msg/s  每個請求平均 {latency * 1000:.2f}ms')
+        finally:
+            if not options['keep']:
+                ChatMessage.objects.filter(room_name__startswith=BENCH_ROOM_PREFIX).delete()
+                Room.objects.filter(name__startswith=BENCH_ROOM_PREFIX).delete()
+                for room in rooms:
+                    pages.invalidate(room)
+                user.delete()
+
+    def _run(self, client, rooms, total, batch_size):
+        requests = 0
+        started = time.perf_counter()
+        for start in range(0, total, batch_size):
+            items = [
+                {'room': rooms[i % len(rooms)], 'message': f'system message {i}'}
+                for i in range(start, min(start + batch_size, total))
+            ]
+            response = client.post('/chat/api/send_messages/', json.dumps(items), content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f'批次發送失敗: {response.status_code} {response.content[:200]!r}')
+            requests += 1
+        elapsed = time.perf_counter() - started
+        return total / elapsed, elapsed / requests
@@ -0,0 +1,89 @@
+import asyncio
+import statistics
+import time
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from chat.models import ChatMessage
+from chat.persistence import asave_message
+
+BENCH_ROOM = 'bench_db_writes'
+
+
+class Command(BaseCommand):
+    help = (
+        '量測單一 worker 在直接寫入模式下的消息寫入吞吐量：比較原本每條消息都經過 Django 單一執行緒'
+        ' (sync_to_async 取用戶名 + acreate) 的路徑，與連線時解析身分、寫入走有界資料庫執行緒池的路徑。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='每種模式寫入的消息數')
+        parser.add_argument('--concurrency', type=int, default=100, help='同時發送的連線數')
+        parser.add_argument('--pool-sizes', nargs='+', type=int, default=[1, 4, 8], help='要比較的執行緒池大小')
+        parser.add_argument('--keep', action='store_true', help='結束後保留測試資料')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username='bench_db_writes')
+        try:
+            results = [('單一執行緒 (原本的路徑)', self._run(self._legacy_save, user, 0, options))]
+            for size in options['pool_sizes']:
+                results.append((f'執行緒池 {size}', self._run(self._pooled_save, user, size, options)))
+        finally:
+            if not options['keep']:
+                ChatMessage.objects.filter(room_name=BENCH_ROOM).delete()
+
+        # 中文字寬不一，模式名稱放在最後一欄
+        self.stdout.write(f"{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'loop lag ms':>14}  模式")
+        for label, (rate, p50, p99, lag) in results:
+            self.stdout.write(f'{rate:>10,.0f}{p50:>10.2f}{p99:>10.2f}{lag:>14.2f}  {label}')
+
+    @staticmethod
+    async def _legacy_save(user):
+        # 重構前 ChatConsumer.receive 每條消息的資料庫相關操作
+        await sync_to_async(lambda: user.username)()
+        await ChatMessage.objects.acreate(room_name=BENCH_ROOM, sender=user, content='bench', timestamp=timezone.now())
+
+    @staticmethod
+    async def _pooled_save(user):
+        await asave_message(BENCH_ROOM, user, 'bench', timezone.now())
+
+    def _run(self, save, user, pool_size, options):
+        with override_settings(CHAT_WRITE_BEHIND=False, CHAT_DB_EXECUTOR_WORKERS=pool_size):
+            return asyncio.run(self._bench(save, user, options))
+
+    async def _bench(self, save, user, options):
+        latencies = []
+        remaining = options['messages']
+        max_lag = 0.0
+        done = asyncio.Event()
+
+        async def sender():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                await save(user)
+                latencies.append(time.perf_counter() - started)
+
+        async def watch_loop():
+            # 事件循環被阻塞時，1 毫秒的 sleep 會明顯延遲醒來
+            nonlocal max_lag
+            while not done.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(0.001)
+                max_lag = max(max_lag, time.perf_counter() - started - 0.001)
+
+        watcher = asyncio.create_task(watch_loop())
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(options['concurrency'])))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await watcher
+
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return len(latencies) / elapsed, statistics.median(latencies) * 1000, p99 * 1000, max_lag * 1000
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat import wire
+from chat.consumers import ChatConsumer
+
+
+class _NullOutbound:
+    """
+    替代 OutboundQueue，丟棄所有幀。
+    """
+
+    def put(self, frame):
+        pass
+
+
+class Command(BaseCommand):
+    help = '量測 chat_message 群發時每個接收者的處理成本 (逐一編碼 vs 發送端只編碼一次)。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=5000, help='聊天室成員數')
+        parser.add_argument('--messages', type=int, default=20, help='群發的消息數')
+        parser.add_argument('--size', type=int, default=200, help='消息內容長度 (字元)')
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        consumers = [self._make_consumer() for _ in range(options['recipients'])]
+        message = '聊' * options['size']
+        timestamp = timezone.now().isoformat()
+
+        # 舊格式：事件帶原始欄位，每個接收者各自 json.dumps
+        legacy_event = {'type': 'chat_message', 'message': message, 'user': 'bench', 'timestamp': timestamp}
+        before = await self._fanout(consumers, options['messages'], lambda: legacy_event)
+
+        # 新格式：發送端編碼一次 (計入成本)，接收者直接轉發
+        after = await self._fanout(
+            consumers, options['messages'],
+            lambda: wire.chat_message_event(wire.build_chat_frame(message, 'bench', timestamp), 'bench'))
+
+        self.stdout.write(f'JSON 編碼器: {"orjson" if wire._USE_ORJSON else "json"}')
+        self.stdout.write(f'逐一編碼:     {before:.3f} µs/接收者')
+        self.stdout.write(f'只編碼一次:   {after:.3f} µs/接收者 ({before / after:.1f}x)')
+
+    def _make_consumer(self):
+        consumer = ChatConsumer()
+        consumer.outbound = _NullOutbound() # 不經過真正的 WebSocket，只量測 chat_message 本身
+        return consumer
+
+    async def _fanout(self, consumers, messages, make_event):
+        started = time.perf_counter()
+        for _ in range(messages):
+            event = make_event()
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        elapsed = time.perf_counter() - started
+        return elapsed / (messages * len(consumers)) * 1_000_000
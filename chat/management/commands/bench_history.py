@@ -0,0 +1,83 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from chat.history import fetch_page
+from chat.models import ChatMessage
+
+BENCH_ROOM_PREFIX = 'bench_history_' # 基準測試用的聊天室名稱前綴
+
+
+class Command(BaseCommand):
+    help = (
+        '量測歷史消息分頁在不同資料表大小下的延遲 (鍵集分頁應保持平穩)。'
+        '最新頁在停用最近消息快取的情況下量測資料庫查詢，另以 cached 欄位列出快取命中的延遲。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000],
+                            help='依序成長到的資料表總行數')
+        parser.add_argument('--rooms', type=int, default=100, help='分散寫入的聊天室數量')
+        parser.add_argument('--page-size', type=int, default=50, help='每頁消息數')
+        parser.add_argument('--repeat', type=int, default=50, help='每個量測點的重複次數')
+        parser.add_argument('--keep', action='store_true', help='結束後保留測試資料')
+
+    def handle(self, *args, **options):
+        rooms = [f'{BENCH_ROOM_PREFIX}{i}' for i in range(options['rooms'])]
+        hot_room = rooms[0]
+        base_time = timezone.now() - timezone.timedelta(days=365)
+        inserted = 0
+        try:
+            for size in sorted(options['sizes']):
+                inserted = self._seed(rooms, base_time, inserted, size)
+                # 最新頁預設由最近消息快取回答，停用快取才會量到鍵集分頁的資料庫查詢
+                with override_settings(CHAT_RECENT_CACHE_BACKEND='none'):
+                    latest = self._measure(lambda: fetch_page(hot_room, limit=options['page_size']), options['repeat'])
+
+                    # 從最新一頁往前翻 10 頁，量測深度分頁
+                    cursor = fetch_page(hot_room, limit=options['page_size'])['older']
+                    for _ in range(10):
+                        cursor = fetch_page(hot_room, before=cursor, limit=options['page_size'])['older'] or cursor
+                    older = self._measure(
+                        lambda: fetch_page(hot_room, before=cursor, limit=options['page_size']), options['repeat'])
+
+                # 依設定的快取後端量測最新頁 (第一次呼叫回填快取)；CHAT_RECENT_CACHE_BACKEND=none 時與 latest 相同
+                fetch_page(hot_room, limit=options['page_size'])
+                cached = self._measure(lambda: fetch_page(hot_room, limit=options['page_size']), options['repeat'])
+
+                self.stdout.write(
+                    f'rows={inserted:>9}  latest p50={latest[0]:.2f}ms p95={latest[1]:.2f}ms  '
+                    f'older p50={older[0]:.2f}ms p95={older[1]:.2f}ms  '
+                    f'cached p50={cached[0]:.2f}ms p95={cached[1]:.2f}ms'
+                )
+            plan = ChatMessage.objects.filter(room_name=hot_room).order_by('-timestamp', '-id')[:options['page_size']]
+            self.stdout.write('查詢計畫:\n' + plan.explain())
+        finally:
+            if not options['keep']:
+                ChatMessage.objects.filter(room_name__startswith=BENCH_ROOM_PREFIX).delete()
+
+    def _seed(self, rooms, base_time, start, target, batch_size=5000):
+        # 依序寫入時間戳遞增的消息，輪流分配到各聊天室
+        for offset in range(start, target, batch_size):
+            ChatMessage.objects.bulk_create([
+                ChatMessage(
+                    room_name=random.choice(rooms),
+                    content=f'benchmark message {i}',
+                    timestamp=base_time + timezone.timedelta(milliseconds=i),
+                )
+                for i in range(offset, min(offset + batch_size, target))
+            ])
+        return max(start, target)
+
+    def _measure(self, func, repeat):
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
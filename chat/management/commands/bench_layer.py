@@ -0,0 +1,92 @@
+import asyncio
+import time
+import uuid
+from collections import Counter
+
+from channels_redis.core import RedisChannelLayer
+from channels_redis.utils import _consistent_hash
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import HashRing, ShardedRedisChannelLayer, host_label
+from chat.messaging import room_group_name
+
+
+class Command(BaseCommand):
+    help = (
+        '比較單一 Redis 與分片頻道層的 group_send 吞吐量，並分析聊天室在分片上的分布，'
+        '以及增加一台主機時需要移動的聊天室比例。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hosts',
+            help='以逗號分隔的 Redis URL，預設使用 REDIS_URLS；可在本機以不同埠啟動多個 redis-server')
+        parser.add_argument('--rooms', type=int, default=500, help='聊天室數')
+        parser.add_argument('--members', type=int, default=20, help='每個聊天室的成員 (頻道) 數')
+        parser.add_argument('--processes', type=int, default=4, help='模擬的 daphne 進程數')
+        parser.add_argument('--messages', type=int, default=5000, help='group_send 次數')
+        parser.add_argument('--concurrency', type=int, default=50, help='同時進行的 group_send 數')
+        parser.add_argument('--ring-only', action='store_true', help='只分析分布與重新平衡，不連線 Redis')
+
+    def handle(self, *args, **options):
+        hosts = options['hosts'].split(',') if options['hosts'] else list(settings.REDIS_URLS)
+        groups = [room_group_name(f'bench_layer_{index}') for index in range(options['rooms'])]
+        self._report_ring(hosts, groups)
+        if options['ring_only']:
+            return
+        if len(hosts) < 2:
+            raise CommandError('吞吐量比較至少需要兩個 Redis 主機 (--hosts)。')
+        single = asyncio.run(self._bench(RedisChannelLayer, hosts[:1], groups, options))
+        sharded = asyncio.run(self._bench(ShardedRedisChannelLayer, hosts, groups, options))
+        self.stdout.write(f'單一主機:   {single:,.0f} group_send/秒')
+        self.stdout.write(f'{len(hosts)} 個分片:   {sharded:,.0f} group_send/秒 ({sharded / single:.2f}x)')
+
+    def _report_ring(self, hosts, groups):
+        labels = [host_label(host) for host in hosts]
+        ring = HashRing(labels)
+        counts = Counter(ring.node(group) for group in groups)
+        self.stdout.write(f'{len(groups)} 個聊天室在 {len(hosts)} 個分片上的分布:')
+        for index, label in enumerate(labels):
+            self.stdout.write(f'  {label}: {counts.get(index, 0)}')
+
+        # 模擬加入一台新主機，比較需要換分片的聊天室比例
+        grown_labels = labels + ['redis://new-host:6379']
+        grown = HashRing(grown_labels)
+        ring_moved = sum(labels[ring.node(g)] != grown_labels[grown.node(g)] for g in groups)
+        modulo_moved = sum(
+            _consistent_hash(g, len(labels)) != _consistent_hash(g, len(labels) + 1) for g in groups)
+        self.stdout.write(f'加入第 {len(hosts) + 1} 台主機後需移動的聊天室:')
+        self.stdout.write(f'  雜湊環:           {ring_moved / len(groups):.1%} (理想值 {1 / (len(hosts) + 1):.1%})')
+        self.stdout.write(f'  channels_redis 取模: {modulo_moved / len(groups):.1%}')
+
+    async def _bench(self, layer_class, hosts, groups, options):
+        prefix = f'bench_layer_{uuid.uuid4().hex[:8]}'
+        # 每個 layer 實例代表一個 daphne 進程，各自有獨立的 process-local 頻道前綴
+        layers = [
+            layer_class(hosts=hosts, prefix=prefix, capacity=options['messages'] * 2)
+            for _ in range(options['processes'])
+        ]
+        try:
+            for group in groups:
+                for member in range(options['members']):
+                    layer = layers[member % len(layers)]
+                    await layer.group_add(group, await layer.new_channel())
+
+            sender = layers[0]
+            semaphore = asyncio.Semaphore(options['concurrency'])
+            message = {'type': 'chat_message', 'frame': '{"message":"bench"}'}
+
+            async def send(index):
+                async with semaphore:
+                    await sender.group_send(groups[index % len(groups)], message)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(send(index) for index in range(options['messages'])))
+            elapsed = time.perf_counter() - started
+        finally:
+            # flush 只刪除本次前綴的鍵
+            await layers[0].flush()
+            for layer in layers:
+                await layer.close_pools()
+        return options['messages'] / elapsed
@@ -0,0 +1,100 @@
+import asyncio
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from django.utils import timezone
+
+from chat import pages
+from chat.models import ChatMessage, Room
+
+BENCH_ROOM_PREFIX = 'bench_page_' # 基準測試用的聊天室名稱前綴
+
+
+class Command(BaseCommand):
+    help = (
+        '量測熱門聊天室頁面 (chat/<room>/) 每秒可處理的請求數：每次完整渲染、使用歷史片段快取、'
+        '以及帶 If-None-Match 的條件請求 (304)，並比較串流輸出的首位元組時間。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10, help='熱門聊天室數')
+        parser.add_argument('--messages', type=int, default=100, help='每個聊天室的消息數')
+        parser.add_argument('--requests', type=int, default=2000, help='每種模式的請求數')
+        parser.add_argument('--size', type=int, default=100, help='消息內容長度 (字元)')
+        parser.add_argument('--keep', action='store_true', help='結束後保留測試資料')
+
+    def handle(self, *args, **options):
+        rooms = [f'{BENCH_ROOM_PREFIX}{i}' for i in range(options['rooms'])]
+        try:
+            self._seed(rooms, options['messages'], options['size'])
+            etags = asyncio.run(self._etags(rooms))
+            rng = random.Random(0)
+            plan = [rng.choice(rooms) for _ in range(options['requests'])]
+            self.stdout.write(f"聊天室 {len(rooms)} 個，每個 {options['messages']} 條消息，每種模式 {len(plan)} 個請求")
+
+            # 停用片段快取與最近消息快取：每個請求都查詢消息表並渲染整頁
+            with override_settings(CHAT_ROOM_PAGE_CACHE_ROOMS=0, CHAT_RECENT_CACHE_BACKEND='none'):
+                self._report('full render', self._run(plan))
+            self._report('fragment cache', self._run(plan))
+            self._report('304', self._run(plan, etags))
+        finally:
+            if not options['keep']:
+                ChatMessage.objects.filter(room_name__startswith=BENCH_ROOM_PREFIX).delete()
+                Room.objects.filter(name__startswith=BENCH_ROOM_PREFIX).delete()
+                for room in rooms:
+                    pages.invalidate(room)
+
+    def _seed(self, rooms, count, size):
+        now = timezone.now()
+        for room in rooms:
+            messages = ChatMessage.objects.bulk_create([
+                ChatMessage(room_name=room, content=f'{i} ' + 'x' * size, timestamp=now - timezone.timedelta(seconds=count - i))
+                for i in range(count)
+            ])
+            last_id = messages[-1].id or ChatMessage.objects.filter(room_name=room).order_by('-id').values_list('id', flat=True).first()
+            Room.objects.update_or_create(name=room, defaults={
+                'message_count': count,
+                'last_message_at': now,
+                'last_message_id': last_id,
+            })
+
+    async def _etags(self, rooms):
+        client = AsyncClient()
+        etags = {}
+        for room in rooms:
+            response = await client.get(f'/chat/{room}/')
+            async for _ in response.streaming_content:
+                pass
+            etags[room] = response['ETag']
+        return etags
+
+    def _run(self, plan, etags=None):
+        # 以 AsyncClient 經過 ASGI 處理器，與 daphne 相同地以 async for 逐段讀取串流內容
+        return asyncio.run(self._arun(plan, etags))
+
+    async def _arun(self, plan, etags):
+        client = AsyncClient()
+        first_byte = []
+        started = time.perf_counter()
+        for room in plan:
+            headers = {'HTTP_IF_NONE_MATCH': etags[room]} if etags else {}
+            request_started = time.perf_counter()
+            response = await client.get(f'/chat/{room}/', **headers)
+            if response.streaming:
+                chunks = aiter(response.streaming_content)
+                await anext(chunks)
+                first_byte.append(time.perf_counter() - request_started)
+                async for _ in chunks:
+                    pass
+        elapsed = time.perf_counter() - started
+        return len(plan) / elapsed, elapsed / len(plan), first_byte
+
+    def _report(self, label, result):
+        rate, latency, first_byte = result
+        line = f'  {label:<15} {rate:>9,.0f} req/s  平均 {latency * 1000:.2f}ms'
+        if first_byte:
+            first_byte.sort()
+            line += f'  首位元組 p50={first_byte[len(first_byte) // 2] * 1000:.2f}ms'
+        self.stdout.write(line)
@@ -0,0 +1,101 @@
+import itertools
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import ChatMessage
+from chat.search import search_messages
+
+BENCH_ROOM_PREFIX = 'bench_search_' # 基準測試用的聊天室名稱前綴
+
+# 合成消息的詞彙：少數常用詞出現在大部分消息中，其餘詞依 Zipf 分布變得越來越少見
+COMMON_WORDS = ['hello', 'thanks', 'meeting', '大家好', '沒問題', '謝謝你']
+# 以固定種子產生的隨機字母詞，避免共用前綴讓 trigram 索引失去選擇性
+_word_rng = random.Random(0)
+RARE_WORDS = [''.join(_word_rng.choices('abcdefghijklmnopqrstuvwxyz', k=7)) for _ in range(20000)]
+RARE_CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(RARE_WORDS))))
+
+
+class Command(BaseCommand):
+    help = '量測全文搜尋在不同資料表大小下的延遲，並與掃描整個資料表的 content__icontains 比較。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[100000, 1000000, 3000000],
+                            help='依序成長到的資料表總行數')
+        parser.add_argument('--rooms', type=int, default=100, help='分散寫入的聊天室數量')
+        parser.add_argument('--page-size', type=int, default=20, help='每頁結果數')
+        parser.add_argument('--repeat', type=int, default=20, help='每個量測點的重複次數')
+        parser.add_argument('--skip-scan', action='store_true', help='不量測 icontains 全表掃描 (資料量大時很慢)')
+        parser.add_argument('--keep', action='store_true', help='結束後保留測試資料')
+
+    def handle(self, *args, **options):
+        rooms = [f'{BENCH_ROOM_PREFIX}{i}' for i in range(options['rooms'])]
+        base_time = timezone.now() - timezone.timedelta(days=365)
+        queries = {
+            'common': COMMON_WORDS[0],
+            'rare': RARE_WORDS[5000],
+            'two terms': f'{COMMON_WORDS[3]} {RARE_WORDS[50]}',
+        }
+        page_size = options['page_size']
+        inserted = 0
+        try:
+            for size in sorted(options['sizes']):
+                inserted = self._seed(rooms, base_time, inserted, size)
+                self.stdout.write(f'rows={inserted}')
+                for label, query in queries.items():
+                    indexed = self._measure(lambda: search_messages(query, limit=page_size), options['repeat'])
+                    in_room = self._measure(
+                        lambda: search_messages(query, room_name=rooms[0], limit=page_size), options['repeat'])
+                    recent = self._measure(
+                        lambda: search_messages(query, limit=page_size, order='recent'), options['repeat'])
+                    line = (f'  {label:<10} rank p50={indexed[0]:.2f}ms p95={indexed[1]:.2f}ms  '
+                            f'rank+room p50={in_room[0]:.2f}ms p95={in_room[1]:.2f}ms  '
+                            f'recent p50={recent[0]:.2f}ms p95={recent[1]:.2f}ms')
+                    if not options['skip_scan']:
+                        term = query.split()[-1]
+                        scan = self._measure(
+                            lambda: list(ChatMessage.objects.filter(content__icontains=term)
+                                         .order_by('-id').values_list('id', flat=True)[:page_size]),
+                            max(1, options['repeat'] // 4))
+                        line += f'  icontains p50={scan[0]:.2f}ms p95={scan[1]:.2f}ms'
+                    self.stdout.write(line)
+        finally:
+            if not options['keep']:
+                ChatMessage.objects.filter(room_name__startswith=BENCH_ROOM_PREFIX).delete()
+
+    def _seed(self, rooms, base_time, start, target, batch_size=5000):
+        # 索引由觸發器 / GIN 索引在寫入時維護，寫入時間也包含建立索引的成本
+        rng = random.Random(start)
+        started = time.perf_counter()
+        for offset in range(start, target, batch_size):
+            ChatMessage.objects.bulk_create([
+                ChatMessage(
+                    room_name=rng.choice(rooms),
+                    content=self._content(rng),
+                    timestamp=base_time + timezone.timedelta(milliseconds=i),
+                )
+                for i in range(offset, min(offset + batch_size, target))
+            ])
+        if target > start:
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'寫入 {target - start} 行，{(target - start) / elapsed:,.0f} 行/秒 (含索引維護)')
+        return max(start, target)
+
+    @staticmethod
+    def _content(rng):
+        words = rng.choices(COMMON_WORDS, k=rng.randint(1, 3))
+        words += rng.choices(RARE_WORDS, cum_weights=RARE_CUM_WEIGHTS, k=rng.randint(2, 8))
+        rng.shuffle(words)
+        return ' '.join(words)
+
+    def _measure(self, func, repeat):
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
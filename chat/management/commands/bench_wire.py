@@ -0,0 +1,90 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat import wire
+
+# 合成消息的詞彙：中英混合、隨機組合，壓縮率較接近實際聊天內容
+WORDS = ['你好', '今天', '會議', '沒問題', '謝謝', '明天見', '收到', '可以', 'hello', 'ok', 'thanks', 'deploy',
+         'review', 'lunch', 'bug', 'release', '？', '！', '，', '。', '😀', '123', '2024', 'https://example.com/x']
+
+
+class Command(BaseCommand):
+    help = (
+        '比較 JSON、chat.msgpack 與 chat.msgpack.zlib 三種幀格式的每條消息位元組數，'
+        '以及伺服器編碼、客戶端解碼的 CPU 時間。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[20, 200, 2000], help='消息內容長度 (字元)')
+        parser.add_argument('--batch', type=int, default=20, help='合併幀包含的消息數')
+        parser.add_argument('--iterations', type=int, default=20000, help='每個量測點的重複次數')
+        parser.add_argument('--compress-min-bytes', type=int, default=512, help='chat.msgpack.zlib 的壓縮門檻')
+
+    def handle(self, *args, **options):
+        codecs = [
+            ('json', wire.JsonCodec()),
+            ('msgpack', wire.MsgpackCodec(wire.SUBPROTOCOL_MSGPACK)),
+            ('msgpack.zlib', wire.MsgpackCodec(wire.SUBPROTOCOL_MSGPACK_ZLIB, options['compress_min_bytes'])),
+        ]
+        timestamp = timezone.now().isoformat()
+        self.stdout.write(f'JSON 編碼器: {"orjson" if wire._USE_ORJSON else "json"}')
+        self.stdout.write(
+            f"{'size':>6} {'format':<13}{'bytes/msg':>10}{'bytes/msg (batch)':>19}"
+            f"{'encode µs':>11}{'decode µs':>11}"
+        )
+        for size in options['sizes']:
+            rng = random.Random(size)
+            frames = [
+                wire.build_chat_frame(self._content(rng, size), f'user{i % 7}', timestamp, 1000 + i, f'client-{i}')
+                for i in range(options['batch'])
+            ]
+            for label, codec in codecs:
+                single = self._payload(codec.frame_kwargs(frames[0]))
+                batch = self._payload(codec.batch_kwargs(frames))
+                encode = self._time(lambda: self._encode(codec, frames[0]), options['iterations'])
+                decode = self._time(lambda: self._decode(codec, single), options['iterations'])
+                self.stdout.write(
+                    f'{size:>6} {label:<13}{len(single):>10}{len(batch) / len(frames):>19.1f}'
+                    f'{encode:>11.2f}{decode:>11.2f}'
+                )
+
+    @staticmethod
+    def _content(rng, size):
+        words = []
+        length = 0
+        while length < size:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)[:size]
+
+    @staticmethod
+    def _payload(kwargs):
+        if 'bytes_data' in kwargs:
+            return kwargs['bytes_data']
+        return kwargs['text_data'].encode('utf-8')
+
+    @staticmethod
+    def _encode(codec, frame):
+        # 每條消息在每個 worker 上的成本：JSON 幀由發送端編碼一次後直接轉發，
+        # 二進位格式再轉換 (與壓縮) 一次，不經過 encode_binary_broadcast 的快取
+        if codec.binary:
+            return wire.encode_binary(frame, codec.compress_min_bytes)
+        return frame
+
+    @staticmethod
+    def _decode(codec, payload):
+        # 模擬客戶端收到幀後的解碼
+        if codec.binary:
+            return wire.decode_binary(payload)
+        return wire.loads(payload)
+
+    @staticmethod
+    def _time(func, iterations):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return (time.perf_counter() - started) / iterations * 1_000_000
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import platform
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from chat import wire
+from chat.models import ChatMessage
+from chat.routing import websocket_urlpatterns
+
+try:
+    import websockets # 可選依賴：--url 模式連線到運行中的 daphne
+except ImportError:
+    websockets = None
+
+ROOM_PREFIX = 'loadtest_'
+
+# 進程內模式使用的頻道層，容量放大以免群發時因佇列已滿而丟棄消息
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 10000},
+    },
+}
+
+
+class _CommunicatorClient:
+    """
+    進程內客戶端：以 WebsocketCommunicator 直接驅動 ChatConsumer，不經過網路。
+    """
+
+    def __init__(self, application, room_name):
+        self._communicator = WebsocketCommunicator(application, f'/ws/chat/{room_name}/')
+        self._communicator.scope['user'] = AnonymousUser()
+
+    async def connect(self):
+        connected, _ = await self._communicator.connect()
+        if not connected:
+            raise CommandError('ChatConsumer 拒絕連線。')
+
+    async def send(self, text):
+        await self._communicator.send_to(text_data=text)
+
+    async def receive(self):
+        # 不設逾時：WebsocketCommunicator 逾時會取消整個 consumer，結束時改由呼叫端取消等待
+        return await self._communicator.receive_from(timeout=None)
+
+    async def close(self):
+        await self._communicator.disconnect()
+
+
+class _LiveClient:
+    """
+    連線到運行中 daphne 的客戶端 (需安裝 websockets)。
+    """
+
+    def __init__(self, base_url, room_name):
+        self._url = f'{base_url}/ws/chat/{room_name}/'
+        parts = urlsplit(base_url)
+        # AllowedHostsOriginValidator 要求 Origin 標頭
+        self._origin = f'{"https" if parts.scheme == "wss" else "http"}://{parts.netloc}'
+        self._connection = None
+
+    async def connect(self):
+        self._connection = await websockets.connect(self._url, origin=self._origin, max_size=None)
+
+    async def send(self, text):
+        await self._connection.send(text)
+
+    async def receive(self):
+        return await self._connection.recv()
+
+    async def close(self):
+        await self._connection.close()
+
+
+def _percentile(sorted_values, percent):
+    # 最近排名法 (nearest-rank)
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        '對 ChatConsumer 進行壓力測試：模擬多個聊天室的客戶端以固定速率發送消息，'
+        '量測吞吐量與發送到接收的延遲 (p50/p95/p99)，結果以 JSON 輸出。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5, help='聊天室數')
+        parser.add_argument('--clients', type=int, default=20, help='每個聊天室的連線數 (含發送者)')
+        parser.add_argument('--senders', type=int, default=2, help='每個聊天室中發送消息的連線數')
+        parser.add_argument('--rate', type=float, default=5.0, help='每個發送者每秒發送的消息數')
+        parser.add_argument('--duration', type=float, default=10.0, help='發送持續秒數')
+        parser.add_argument('--drain', type=float, default=5.0, help='停止發送後等待在途消息送達的最長秒數')
+        parser.add_argument('--size', type=int, default=100, help='消息內容長度 (字元)')
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='同時建立的連線數上限')
+        parser.add_argument(
+            '--url',
+            help='連線到運行中的伺服器，例如 ws://127.0.0.1:8000 (需安裝 websockets)；未指定時在進程內使用 InMemoryChannelLayer')
+        parser.add_argument('--output', help='將 JSON 結果寫入檔案，未指定時輸出到標準輸出')
+        parser.add_argument('--keep', action='store_true', help='保留測試寫入的消息')
+        parser.add_argument(
+            '--rate-limit', action='store_true',
+            help='進程內模式保留速率限制 (預設停用，所有模擬客戶端共用同一個來源位址)')
+
+    def handle(self, *args, **options):
+        if options['senders'] > options['clients']:
+            raise CommandError('--senders 不能大於 --clients。')
+        if options['rate'] <= 0:
+            raise CommandError('--rate 必須大於 0。')
+        if options['url'] and websockets is None:
+            raise CommandError('--url 模式需要安裝 websockets 套件。')
+
+        run_id = uuid.uuid4().hex[:8]
+        try:
+            if options['url']:
+                result = asyncio.run(self._run(options, run_id, self._live_factory(options['url'].rstrip('/'))))
+            else:
+                overrides = {'CHANNEL_LAYERS': IN_MEMORY_CHANNEL_LAYERS}
+                if not options['rate_limit']:
+                    overrides['CHAT_RATE_LIMIT_ENABLED'] = False
+                with override_settings(**overrides):
+                    application = URLRouter(websocket_urlpatterns)
+                    result = asyncio.run(self._run(options, run_id, lambda room: _CommunicatorClient(application, room)))
+        finally:
+            if not options['keep']:
+                # 僅在壓測目標與本進程共用資料庫時有作用
+                ChatMessage.objects.filter(room_name__startswith=f'{ROOM_PREFIX}{run_id}_').delete()
+
+        output = json.dumps(result, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+            self.stderr.write(f'結果已寫入 {options["output"]}')
+        else:
+            self.stdout.write(output)
+
+    def _live_factory(self, base_url):
+        return lambda room: _LiveClient(base_url, room)
+
+    async def _run(self, options, run_id, make_client):
+        rooms = [f'{ROOM_PREFIX}{run_id}_{index}' for index in range(options['rooms'])]
+        clients = {room: [make_client(room) for _ in range(options['clients'])] for room in rooms}
+
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(client):
+            async with semaphore:
+                await client.connect()
+
+        started_at = timezone.now()
+        connect_started = time.perf_counter()
+        await asyncio.gather(*(connect(client) for room in rooms for client in clients[room]))
+        connect_seconds = time.perf_counter() - connect_started
+
+        latencies = []
+        counters = {'received': 0, 'other_frames': 0}
+        sent = {room: 0 for room in rooms}
+        marker = f'{run_id}:'
+        filler = 'x' * options['size']
+
+        def record(text):
+            now = time.perf_counter_ns()
+            frame = wire.loads(text)
+            if frame.get('type') == 'batch':
+                frames = frame['messages']
+            elif 'message' in frame:
+                frames = [frame]
+            else:
+                counters['other_frames'] += 1
+                return
+            for item in frames:
+                message = item.get('message') or ''
+                if not message.startswith(marker):
+                    continue
+                # 消息內容：<run_id>:<發送時間 ns>:<填充>
+                sent_ns = int(message.split(':', 2)[1])
+                latencies.append((now - sent_ns) / 1_000_000)
+                counters['received'] += 1
+
+        async def receive_forever(client):
+            while True:
+                record(await client.receive())
+
+        async def send_at_rate(client, room, deadline):
+            loop = asyncio.get_running_loop()
+            interval = 1 / options['rate']
+            next_at = loop.time()
+            while next_at < deadline:
+                await client.send(wire.dumps({'message': f'{marker}{time.perf_counter_ns()}:{filler}'}))
+                sent[room] += 1
+                next_at += interval
+                await asyncio.sleep(max(0.0, next_at - loop.time()))
+
+        receivers = [asyncio.create_task(receive_forever(client)) for room in rooms for client in clients[room]]
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        deadline = loop.time() + options['duration']
+        await asyncio.gather(*(
+            send_at_rate(client, room, deadline)
+            for room in rooms for client in clients[room][:options['senders']]
+        ))
+        send_seconds = time.perf_counter() - started
+
+        # 等待在途消息送達，或直到 drain 逾時
+        expected = sum(sent.values()) * options['clients']
+        drain_deadline = loop.time() + options['drain']
+        while counters['received'] < expected and loop.time() < drain_deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        await asyncio.gather(*(client.close() for room in rooms for client in clients[room]), return_exceptions=True)
+
+        latencies.sort()
+        latency = lambda value: round(value, 3) if value is not None else None
+        total_sent = sum(sent.values())
+        result = {
+            'run_id': run_id,
+            'started_at': started_at.isoformat(),
+            'mode': 'live' if options['url'] else 'inprocess',
+            'target': options['url'] or 'InMemoryChannelLayer',
+            'python': platform.python_version(),
+            'json_backend': 'orjson' if wire._USE_ORJSON else 'json',
+            'config': {
+                'rooms': options['rooms'],
+                'clients_per_room': options['clients'],
+                'senders_per_room': options['senders'],
+                'rate_per_sender': options['rate'],
+                'duration': options['duration'],
+                'message_size': options['size'],
+            },
+            'connect_seconds': round(connect_seconds, 3),
+            'sent': total_sent,
+            'expected_deliveries': expected,
+            'received': counters['received'],
+            'delivery_ratio': round(counters['received'] / expected, 4) if expected else None,
+            'other_frames': counters['other_frames'],
+            'send_throughput': round(total_sent / send_seconds, 1) if send_seconds else None,
+            'receive_throughput': round(counters['received'] / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'min': latency(latencies[0] if latencies else None),
+                'p50': latency(_percentile(latencies, 50)),
+                'p95': latency(_percentile(latencies, 95)),
+                'p99': latency(_percentile(latencies, 99)),
+                'max': latency(latencies[-1] if latencies else None),
+                'mean': latency(sum(latencies) / len(latencies) if latencies else None),
+            },
+        }
+        if not options['url']:
+            # 進程內模式下本進程的設定即伺服器設定
+            result['server_settings'] = {
+                'write_behind': settings.CHAT_WRITE_BEHIND,
+                'recent_cache_backend': settings.CHAT_RECENT_CACHE_BACKEND,
+                'coalesce_window_ms': settings.CHAT_OUTBOUND_COALESCE_WINDOW_MS,
+                'max_queue': settings.CHAT_OUTBOUND_MAX_QUEUE,
+                'slow_consumer_policy': settings.CHAT_SLOW_CONSUMER_POLICY,
+            }
+        return result
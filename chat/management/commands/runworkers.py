@@ -0,0 +1,205 @@
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# daphne.server 必須在其他模組載入 Twisted 之前匯入，以安裝 asyncio reactor
+from daphne.server import Server, twisted_loop # isort:skip
+from channels.routing import get_default_application
+from daphne.endpoints import build_endpoint_description_strings
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import drain
+
+# 預設為進程內 ('local') 的共用狀態：多個 worker 時各自一份，去重、補發與讀己之寫都會失效
+PROCESS_LOCAL_SETTINGS = (
+    'CHAT_RECENT_CACHE_BACKEND',
+    'CHAT_DEDUP_BACKEND',
+    'CHAT_PRESENCE_BACKEND',
+    'CHAT_DB_STICKY_BACKEND',
+    'CHAT_RATE_LIMIT_BACKEND',
+)
+
+
+class _DrainingServer(Server):
+    """
+    記下監聽埠的 daphne Server，排空時先停止 accept，再交給 chat.drain 關閉既有連線。
+    """
+
+    def run(self):
+        self.ports = []
+        super().run()
+
+    def listen_success(self, port):
+        super().listen_success(port)
+        self.ports.append(port)
+
+    def drain(self):
+        for port in self.ports:
+            port.stopListening()
+        drain.begin()
+
+
+class Command(BaseCommand):
+    help = (
+        '以多個 daphne worker 進程共用同一個監聽 socket 運行 ASGI 應用，監督並重啟異常結束的 worker。'
+        'SIGTERM / SIGINT 時停止接受新連線，向客戶端發送重連提示並在期限內排空；'
+        'SIGHUP 時先啟動新一批 worker，再排空舊的 worker。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker 進程數，預設為 CPU 核心數')
+        parser.add_argument('-b', '--bind', default='0.0.0.0', help='監聽位址')
+        parser.add_argument('-p', '--port', type=int, default=8000, help='監聽埠')
+        parser.add_argument('--backlog', type=int, default=2048, help='listen() 的連線佇列長度')
+        parser.add_argument(
+            '--drain-timeout', type=float,
+            help='排空連線的最長秒數，預設使用 CHAT_DRAIN_TIMEOUT；逾時後強制結束 worker')
+        parser.add_argument(
+            '--allow-local-state', action='store_true',
+            help='允許多個 worker 使用進程內 (local) 的快取、去重、在線狀態等後端 (僅供開發)')
+        # 內部使用：worker 進程從父進程繼承的監聽 socket
+        parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker_fd'] is not None:
+            return self._run_worker(options['worker_fd'], options['verbosity'])
+        if options['workers'] < 1:
+            raise CommandError('--workers 至少為 1。')
+        local_state = [name for name in PROCESS_LOCAL_SETTINGS if getattr(settings, name) == 'local']
+        if options['workers'] > 1 and local_state:
+            message = f"{', '.join(local_state)} 為 'local'，{options['workers']} 個 worker 之間不會共用這些狀態；請改為 'redis'。"
+            if not options['allow_local_state']:
+                raise CommandError(message + '若確定要這樣運行，加上 --allow-local-state。')
+            self.stderr.write(message)
+        self.options = options
+        self.drain_timeout = options['drain_timeout']
+        if self.drain_timeout is None:
+            self.drain_timeout = settings.CHAT_DRAIN_TIMEOUT
+        self.listener = self._bind(options['bind'], options['port'], options['backlog'])
+        self.workers = {} # 序號 -> [Popen, 啟動時間, 連續快速失敗次數]
+        self.pending = {} # 等待重啟的序號 -> (重啟時間, 連續快速失敗次數)
+        self.retiring = [] # SIGHUP 後正在排空的舊 worker
+        self.stopping = False
+        self.reloading = False
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        self.stdout.write(
+            f"在 {options['bind']}:{options['port']} 啟動 {options['workers']} 個 worker (父進程 {os.getpid()})")
+        for index in range(options['workers']):
+            self._spawn(index)
+        try:
+            self._supervise()
+        finally:
+            self._shutdown()
+
+    def _bind(self, host, port, backlog):
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind((host, port))
+        except OSError as e:
+            raise CommandError(f'無法監聽 {host}:{port}: {e}')
+        listener.listen(backlog)
+        # 所有 worker 繼承同一個 socket，由核心把新連線分配給正在 accept 的 worker
+        listener.set_inheritable(True)
+        return listener
+
+    def _spawn(self, index, failures=0):
+        fd = self.listener.fileno()
+        command = [
+            sys.executable, '-m', 'django', 'runworkers',
+            '--worker-fd', str(fd), '--verbosity', str(self.options['verbosity']),
+        ]
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [str(settings.BASE_DIR), environment.get('PYTHONPATH')]))
+        environment['CHAT_DRAIN_TIMEOUT'] = str(self.drain_timeout)
+        # 獨立的 session：終端機的 Ctrl-C 只送給父進程，由父進程決定如何排空
+        process = subprocess.Popen(command, pass_fds=(fd,), env=environment, start_new_session=True)
+        self.workers[index] = [process, time.monotonic(), failures]
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def _supervise(self):
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self._reload()
+            now = time.monotonic()
+            for index, (process, started, failures) in list(self.workers.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                # 啟動後很快就結束視為連續失敗，以指數退避避免重啟風暴
+                failures = failures + 1 if now - started < 10 else 0
+                delay = min(2 ** failures - 1, 30)
+                self.stderr.write(f'worker {process.pid} 結束 (代碼 {code})，{delay} 秒後重啟。')
+                del self.workers[index]
+                self.pending[index] = (now + delay, failures)
+            for index, (respawn_at, failures) in list(self.pending.items()):
+                if respawn_at <= now:
+                    del self.pending[index]
+                    self._spawn(index, failures)
+            self.retiring = [process for process in self.retiring if process.poll() is None]
+            time.sleep(0.5)
+
+    def _reload(self):
+        """
+        滾動重啟：新 worker 先開始 accept，舊 worker 停止 accept 後在背景排空。
+        """
+        old = [process for process, _, _ in self.workers.values()]
+        self.stdout.write(f'重新啟動 {len(old)} 個 worker')
+        for index in list(self.workers):
+            self._spawn(index)
+        for process in old:
+            self._signal(process, signal.SIGUSR1)
+        self.retiring.extend(old)
+
+    def _signal(self, process, signum):
+        if process.poll() is None:
+            try:
+                process.send_signal(signum)
+            except ProcessLookupError:
+                pass
+
+    def _shutdown(self):
+        processes = [process for process, _, _ in self.workers.values()] + self.retiring
+        # 先關閉父進程持有的 socket，worker 收到 SIGUSR1 後也會停止 accept
+        self.listener.close()
+        self.stdout.write(f'排空 {len(processes)} 個 worker (最長 {self.drain_timeout:g} 秒)')
+        for process in processes:
+            self._signal(process, signal.SIGUSR1)
+        # worker 排空後自行結束；額外的寬限時間留給 daphne 關閉應用實例
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for signum in (signal.SIGTERM, signal.SIGKILL):
+            while time.monotonic() < deadline and any(process.poll() is None for process in processes):
+                time.sleep(0.1)
+            for process in processes:
+                self._signal(process, signum)
+            deadline = time.monotonic() + 5
+        for process in processes:
+            process.wait()
+
+    def _run_worker(self, fd, verbosity):
+        server = _DrainingServer(
+            application=get_default_application(),
+            endpoints=build_endpoint_description_strings(file_descriptor=fd),
+            # Twisted 接管繼承的 fd 後會關閉原本的 fd，停止 accept 後核心不再把連線排進這個進程
+            verbosity=verbosity,
+        )
+        # 信號處理器在主執行緒的事件循環之外執行，排空工作交回事件循環
+        signal.signal(signal.SIGUSR1, lambda signum, frame: twisted_loop.call_soon_threadsafe(server.drain))
+        server.run()
@@ -0,0 +1,38 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        '本機測試讀寫分離用：以 SQLite 線上備份 API 把主庫複製到 DB_REPLICAS 中的每個副本檔。'
+        '搭配 --every 定期執行，可模擬有複製延遲的唯讀副本。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=0, help='每隔此秒數重複複製；0 表示只執行一次')
+
+    def handle(self, *args, **options):
+        default = settings.DATABASES['default']
+        if not default['ENGINE'].endswith('sqlite3'):
+            raise CommandError('只適用於 SQLite；PostgreSQL 請使用串流複製建立副本。')
+        if not settings.CHAT_DB_REPLICAS:
+            raise CommandError('沒有設定 DB_REPLICAS。')
+        while True:
+            started = time.perf_counter()
+            source = sqlite3.connect(default['NAME'])
+            try:
+                for alias in settings.CHAT_DB_REPLICAS:
+                    target = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write(f'已複製到 {len(settings.CHAT_DB_REPLICAS)} 個副本 ({time.perf_counter() - started:.2f}s)')
+            if options['every'] <= 0:
+                return
+            time.sleep(options['every'])
@@ -0,0 +1,266 @@
+import asyncio
+import logging # 導入 logging 模組
+import re
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone # 導入時區感知時間
+
+from . import dedup # client_msg_id 去重
+from . import metrics # Prometheus 指標
+from . import pages # 聊天室頁面的歷史片段快取
+from . import rooms # 聊天室統計
+from . import wire # WebSocket 幀編碼
+from .cache import aappend_recent, append_recent # 每個聊天室的最近消息快取
+from .db import db_sync_to_async # 有界的資料庫執行緒池
+from .dedup import DuplicateMessage
+from .fanout import abroadcast, abroadcast_frames # 群發 (大型聊天室走進程內群發)
+from .history import serialize_chat_message
+from .models import ChatMessage
+from .persistence import asave_message, find_message_id, find_message_ids, save_message, save_messages # 消息寫入入口
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+VALID_ROOM_PATTERN = re.compile(r'^[a-zA-Z0-9_]+$') # 允許字母、數字、底線
+
+
+def is_valid_room_name(room_name):
+    return isinstance(room_name, str) and bool(VALID_ROOM_PATTERN.match(room_name))
+
+
+def room_group_name(room_name):
+    """
+    聊天室對應的頻道層群組名稱。
+    """
+    return f'chat_{room_name}'
+
+
+def _write_mode():
+    return 'write_behind' if settings.CHAT_WRITE_BEHIND else 'direct'
+
+
+async def apublish_message(channel_layer, room_name, sender, username, content, client_msg_id=None):
+    """
+    WebSocket 發送消息的完整流程：寫入 (或放入寫後緩衝區)、更新最近消息快取、
+    編碼一次最終幀並廣播到聊天室群組。sender 為 None 表示未登入用戶。
+
+    帶有 client_msg_id 的重試只查詢一次去重快取就拋出 DuplicateMessage，不寫入也不廣播。
+    """
+    if client_msg_id is not None:
+        try:
+            await dedup.aclaim(room_name, client_msg_id)
+        except DuplicateMessage:
+            metrics.duplicates_total.inc('websocket', 'cache')
+            raise
+    current_timestamp = timezone.now()
+    metrics.messages_in_total.inc('websocket')
+
+    # 將消息存儲到數據庫 (寫後模式下僅放入緩衝區，不阻塞廣播)
+    saved = None
+    try:
+        with metrics.db_write_seconds.time(_write_mode()):
+            saved = await asave_message(room_name, sender, content, current_timestamp, client_msg_id)
+        logger.debug(f"消息 '{content}' 已提交儲存。")
+    except IntegrityError as e:
+        existing = await db_sync_to_async(find_message_id)(room_name, client_msg_id) if client_msg_id else None
+        if existing is None:
+            metrics.errors_total.inc('db_write')
+            logger.error(f"保存消息到數據庫時發生錯誤: {e}")
+        else:
+            # 去重快取已過期或被淘汰，由資料庫唯一約束擋下的重試
+            metrics.duplicates_total.inc('websocket', 'database')
+            raise DuplicateMessage(client_msg_id, existing)
+    except Exception as e:
+        metrics.errors_total.inc('db_write')
+        logger.error(f"保存消息到數據庫時發生錯誤: {e}")
+        # 即使資料庫儲存失敗，仍嘗試發送到 WebSocket，保證即時性
+
+    message_id = saved.id if saved is not None else None # 寫後模式下尚無 id
+    if client_msg_id is not None:
+        await dedup.acomplete(room_name, client_msg_id, message_id)
+    rooms.record_message(room_name, message_id, username, content, current_timestamp) # 只累加在記憶體中，批次寫入
+    pages.invalidate(room_name) # 本進程快取的聊天室頁面歷史片段
+
+    try:
+        # 更新聊天室的最近消息快取
+        await aappend_recent(room_name, serialize_chat_message(message_id, content, username, current_timestamp))
+
+        # 發送端只編碼一次最終幀，群組內每個接收者直接轉發
+        frame = wire.build_chat_frame(content, username, current_timestamp.isoformat(), message_id, client_msg_id) # 使用 ISO 格式方便前端解析
+        with metrics.group_send_seconds.time():
+            await abroadcast(channel_layer, room_group_name(room_name), room_name, frame)
+    except Exception:
+        if client_msg_id is not None and saved is None:
+            # 消息既未寫入也未送出，撤銷登記讓重試可以重新發送
+            await dedup.arelease(room_name, client_msg_id)
+        raise
+    return saved
+
+
+def publish_message(channel_layer, room_name, sender, username, content, client_msg_id=None):
+    """
+    apublish_message 的同步版本，供 REST API 使用。
+    """
+    if client_msg_id is not None:
+        try:
+            dedup.claim(room_name, client_msg_id)
+        except DuplicateMessage:
+            metrics.duplicates_total.inc('api', 'cache')
+            raise
+    current_timestamp = timezone.now()
+    metrics.messages_in_total.inc('api')
+
+    # 將消息存儲到數據庫 (與 ChatConsumer 共用寫入入口，寫後模式下僅放入緩衝區)
+    saved = None
+    try:
+        with metrics.db_write_seconds.time(_write_mode()):
+            saved = save_message(room_name, sender, content, current_timestamp, client_msg_id)
+        logger.debug(f"API 發送消息 '{content}' 已提交儲存。")
+    except IntegrityError as e:
+        existing = find_message_id(room_name, client_msg_id) if client_msg_id else None
+        if existing is None:
+            metrics.errors_total.inc('db_write')
+            logger.error(f"API 保存消息到數據庫時發生錯誤: {e}")
+        else:
+            # 去重快取已過期或被淘汰，由資料庫唯一約束擋下的重試
+            metrics.duplicates_total.inc('api', 'database')
+            raise DuplicateMessage(client_msg_id, existing)
+    except Exception as e:
+        metrics.errors_total.inc('db_write')
+        logger.error(f"API 保存消息到數據庫時發生錯誤: {e}")
+        # 即使資料庫儲存失敗，仍嘗試發送到 WebSocket，保證即時性
+
+    message_id = saved.id if saved is not None else None # 寫後模式下尚無 id
+    if client_msg_id is not None:
+        dedup.complete(room_name, client_msg_id, message_id)
+    rooms.record_message(room_name, message_id, username, content, current_timestamp) # 只累加在記憶體中，批次寫入
+    pages.invalidate(room_name) # 本進程快取的聊天室頁面歷史片段
+
+    try:
+        # 更新聊天室的最近消息快取
+        append_recent(room_name, serialize_chat_message(message_id, content, username, current_timestamp))
+
+        # 使用 async_to_sync 將異步的群發 (group_send 或進程內群發) 轉為同步執行
+        # 這會觸發 ChatConsumer 中的 chat_message 方法；最終幀在此編碼一次，接收端直接轉發
+        frame = wire.build_chat_frame(content, username, current_timestamp.isoformat(), message_id, client_msg_id) # 使用 ISO 格式方便前端解析
+        with metrics.group_send_seconds.time():
+            async_to_sync(abroadcast)(channel_layer, room_group_name(room_name), room_name, frame)
+    except Exception:
+        if client_msg_id is not None and saved is None:
+            # 消息既未寫入也未送出，撤銷登記讓重試可以重新發送
+            dedup.release(room_name, client_msg_id)
+        raise
+    return saved
+
+
+async def abroadcast_rooms(channel_layer, frames_by_room):
+    """
+    在同一個事件循環入口內並行群發多個聊天室 (每個聊天室一次)，同時進行的群發數以
+    CHAT_BULK_SEND_CONCURRENCY 為上限。返回 {聊天室: 例外或 None}。
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.CHAT_BULK_SEND_CONCURRENCY))
+
+    async def send(room_name, frames):
+        async with semaphore:
+            await abroadcast_frames(channel_layer, room_group_name(room_name), room_name, frames)
+
+    room_names = list(frames_by_room)
+    results = await asyncio.gather(*(send(room_name, frames_by_room[room_name]) for room_name in room_names),
+                                   return_exceptions=True)
+    return dict(zip(room_names, results))
+
+
+def _save_batch(messages):
+    """
+    批次寫入；去重快取已失效的重試被唯一約束擋下時，以一次查詢找出已存在的消息，其餘重新寫入。
+    返回 {(聊天室, client_msg_id): 已存在的消息 id}；寫入成功的消息帶有 id (寫後模式下為 None)。
+    """
+    try:
+        with metrics.db_write_seconds.time(_write_mode()):
+            save_messages(messages)
+        return {}
+    except IntegrityError:
+        existing = find_message_ids({(m.room_name, m.client_msg_id) for m in messages if m.client_msg_id})
+        remaining = [m for m in messages if (m.room_name, m.client_msg_id) not in existing]
+        for message in messages:
+            message.pk = None # 已回滾的分批寫入可能已填入 id
+        if remaining:
+            with metrics.db_write_seconds.time(_write_mode()):
+                save_messages(remaining)
+        return existing
+
+
+def publish_messages(channel_layer, sender, username, items):
+    """
+    批次發送 API 的流程：items 為已驗證的 [(聊天室, 內容, client_msg_id 或 None)]。
+
+    所有消息在一個交易中以一次 bulk_create 寫入，再依聊天室合併幀，
+    在一次 async_to_sync 內並行群發 (每個聊天室一次 group_send)。
+    返回與 items 對應的結果：{'status': 'sent' | 'duplicate' | 'error', 'id': ...}。
+    """
+    results = [None] * len(items)
+    accepted = [] # (items 中的序號, 未儲存的 ChatMessage)
+    current_timestamp = timezone.now()
+    for index, (room_name, content, client_msg_id) in enumerate(items):
+        if client_msg_id is not None:
+            try:
+                dedup.claim(room_name, client_msg_id)
+            except DuplicateMessage as e:
+                metrics.duplicates_total.inc('api', 'cache')
+                results[index] = {'status': 'duplicate', 'id': e.message_id}
+                continue
+        accepted.append((index, ChatMessage(
+            room_name=room_name,
+            sender=sender,
+            content=content,
+            timestamp=current_timestamp,
+            client_msg_id=client_msg_id,
+        )))
+    metrics.messages_in_total.inc('api', amount=len(accepted))
+
+    existing = {}
+    try:
+        # bulk_create 在 PostgreSQL 與 SQLite 3.35+ 上以 RETURNING 為每個物件填入 id
+        existing = _save_batch([message for _, message in accepted])
+    except Exception as e:
+        metrics.errors_total.inc('db_write')
+        logger.error(f"API 批次保存 {len(accepted)} 條消息時發生錯誤: {e}")
+        for _, message in accepted:
+            message.pk = None # 交易已回滾
+        # 與單條發送一致：即使資料庫儲存失敗，仍嘗試發送到 WebSocket
+
+    frames_by_room = {}
+    broadcast = [] # (序號, 聊天室, 消息 id)
+    for index, message in accepted:
+        room_name, client_msg_id = message.room_name, message.client_msg_id
+        if (room_name, client_msg_id) in existing:
+            metrics.duplicates_total.inc('api', 'database')
+            results[index] = {'status': 'duplicate', 'id': existing[(room_name, client_msg_id)]}
+            continue
+        message_id = message.id
+        if client_msg_id is not None:
+            dedup.complete(room_name, client_msg_id, message_id)
+        rooms.record_message(room_name, message_id, username, message.content, current_timestamp) # 只累加在記憶體中，批次寫入
+        append_recent(room_name, serialize_chat_message(message_id, message.content, username, current_timestamp))
+        frames_by_room.setdefault(room_name, []).append(
+            wire.build_chat_frame(message.content, username, current_timestamp.isoformat(), message_id, client_msg_id))
+        broadcast.append((index, room_name, message_id))
+    for room_name in frames_by_room:
+        pages.invalidate(room_name) # 本進程快取的聊天室頁面歷史片段
+
+    with metrics.group_send_seconds.time():
+        failures = async_to_sync(abroadcast_rooms)(channel_layer, frames_by_room) if frames_by_room else {}
+    for index, room_name, message_id in broadcast:
+        error = failures.get(room_name)
+        if error is None:
+            results[index] = {'status': 'sent', 'id': message_id}
+            continue
+        metrics.errors_total.inc('group_send')
+        logger.error(f"批次群發到聊天室 {room_name} 時發生錯誤: {error}")
+        if message_id is None and items[index][2] is not None:
+            # 消息既未寫入也未送出，撤銷登記讓重試可以重新發送
+            dedup.release(room_name, items[index][2])
+        results[index] = {'status': 'error', 'id': message_id, 'error': '群發失敗。'}
+    return results
@@ -0,0 +1,215 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+
+# 延遲直方圖的預設分桶 (秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 本進程所有指標，依註冊順序輸出
+_registry = []
+# 額外的收集函式，輸出時呼叫，返回 (名稱, 類型, 說明, [(標籤字典, 值), ...])
+_collectors = []
+
+
+class _Metric:
+    """
+    Prometheus 指標的共同部分。
+
+    為了能在熱路徑上常駐，更新只是對字典的加法，不使用鎖；事件迴圈是單執行緒，
+    只有同步視圖與執行緒池中的更新可能在極少數情況下互相覆蓋，對監控用途可接受。
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield self.name, labels, value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = tuple(zip(self.labelnames, labelvalues))
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, *labelvalues, amount=1):
+        key = tuple(zip(self.labelnames, labelvalues))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        key = tuple(zip(self.labelnames, labelvalues))
+        value = self._values.get(key, 0) - amount
+        if value <= 0 and self.labelnames:
+            # 歸零的標籤組合直接移除，避免已關閉的聊天室持續累積
+            self._values.pop(key, None)
+        else:
+            self._values[key] = value
+
+    def set(self, value, *labelvalues):
+        self._values[tuple(zip(self.labelnames, labelvalues))] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        key = tuple(zip(self.labelnames, labelvalues))
+        state = self._values.get(key)
+        if state is None:
+            # [各分桶計數 (最後一格為 +Inf), 總和]
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def time(self, *labelvalues):
+        """
+        量測 with 區塊的耗時；區塊內可以 await。
+        """
+        return _Timer(self, labelvalues)
+
+    def samples(self):
+        for labels, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + (('le', _format_value(bound)),), cumulative
+            yield f'{self.name}_count', labels, cumulative
+            yield f'{self.name}_sum', labels, total
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labelvalues', 'started')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+
+
+def timed(histogram, *labelvalues):
+    """
+    裝飾函式 (同步或異步)，將每次呼叫的耗時記入 histogram。
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labelvalues)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labelvalues)
+        return wrapper
+    return decorator
+
+
+def register_collector(collector):
+    """
+    註冊一個在輸出時才讀取的指標來源 (例如 outbound.stats)，不增加熱路徑成本。
+    """
+    _collectors.append(collector)
+    return collector
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """
+    以 Prometheus 文字格式輸出本進程的所有指標。
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, metric_type, documentation, samples in collector():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# 熱路徑指標
+ws_handler_seconds = Histogram(
+    'chat_ws_handler_seconds', 'WebSocket consumer 處理函式耗時', ('consumer', 'handler'))
+ws_connections_active = Gauge(
+    'chat_ws_connections_active', '每個聊天室目前的 WebSocket 連線 (含多工訂閱) 數', ('room',))
+messages_in_total = Counter(
+    'chat_messages_in_total', '收到的聊天消息數', ('source',))
+messages_out_total = Counter(
+    'chat_messages_out_total', '轉發給客戶端的聊天消息數 (每個接收者計一次)')
+db_write_seconds = Histogram(
+    'chat_db_write_seconds', 'ChatMessage 寫入 (或放入寫後緩衝區) 耗時', ('mode',))
+group_send_seconds = Histogram(
+    'chat_group_send_seconds', '頻道層 group_send 耗時')
+api_send_seconds = Histogram(
+    'chat_api_send_seconds', 'SendMessageAPI.post 耗時')
+api_send_bulk_seconds = Histogram(
+    'chat_api_send_bulk_seconds', 'SendBulkMessagesAPI.post 耗時')
+errors_total = Counter(
+    'chat_errors_total', '錯誤次數', ('where',))
+broadcasts_total = Counter(
+    'chat_broadcasts_total', '聊天室群發次數，依路徑 (group_send / local_fanout) 區分', ('path',))
+presence_updates_total = Counter(
+    'chat_presence_updates_total', '推送的 presence 幀數 (每個聊天室每批一個)')
+ephemeral_frames_total = Counter(
+    'chat_ephemeral_frames_total', '群發的 ephemeral 幀數 (輸入中提示與已讀回執，每個聊天室每個時間窗一個)')
+room_page_fragments_total = Counter(
+    'chat_room_page_fragments_total', '聊天室頁面歷史片段的快取命中 / 未命中次數', ('result',))
+rate_limited_total = Counter(
+    'chat_rate_limited_total', '因超過速率限制而拒絕的消息數', ('path', 'scope'))
+duplicates_total = Counter(
+    'chat_duplicates_total', '依 client_msg_id 擋下的重複消息數，依擋下的位置 (cache / database) 區分', ('path', 'source'))
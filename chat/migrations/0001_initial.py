@@ -0,0 +1,32 @@
+# Generated by Django 5.0.14 on 2026-10-18 00:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(db_index=True, max_length=255, verbose_name='聊天室名稱')),
+                ('content', models.TextField(verbose_name='消息內容')),
+                ('timestamp', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='發送時間')),
+                ('sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='發送者')),
+            ],
+            options={
+                'verbose_name': '聊天消息',
+                'verbose_name_plural': '聊天消息',
+                'ordering': ['timestamp'],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.14 on 2026-10-18 00:32
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='發送時間'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room_name', 'timestamp', 'id'], name='chat_room_ts_id_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.14 on 2026-10-18 00:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatmessage_room_timestamp_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room_name', 'id'], name='chat_room_id_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.14 on 2026-10-18 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_room_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='client_msg_id',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='客戶端消息 ID'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_msg_id__isnull', False)), fields=('room_name', 'client_msg_id'), name='chat_room_client_msg_id_uniq'),
+        ),
+    ]
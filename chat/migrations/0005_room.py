@@ -0,0 +1,56 @@
+# Generated by Django 5.0.14 on 2026-10-18 01:04
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def backfill_rooms(apps, schema_editor):
+    """
+    以既有消息建立聊天室統計。只在遷移時對消息表做一次 GROUP BY，之後由寫入路徑累加。
+    """
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Room = apps.get_model('chat', 'Room')
+    rooms = []
+    for row in ChatMessage.objects.values('room_name').annotate(count=Count('id'), last_at=Max('timestamp')):
+        last = (
+            ChatMessage.objects.filter(room_name=row['room_name'])
+            .order_by('-timestamp', '-id').select_related('sender').first()
+        )
+        rooms.append(Room(
+            name=row['room_name'],
+            message_count=row['count'],
+            last_message_at=row['last_at'],
+            last_message_id=last.id,
+            last_message_user=last.sender.username if last.sender else '未登入用戶',
+            last_message_preview=last.content[:200],
+        ))
+    Room.objects.bulk_create(rooms, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatmessage_client_msg_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Room',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='聊天室名稱')),
+                ('message_count', models.BigIntegerField(default=0, verbose_name='消息數')),
+                ('member_count', models.IntegerField(default=0, verbose_name='在線人數')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True, verbose_name='最後消息時間')),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True, verbose_name='最後消息 ID')),
+                ('last_message_user', models.CharField(blank=True, default='', max_length=150, verbose_name='最後發送者')),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=200, verbose_name='最後消息預覽')),
+            ],
+            options={
+                'verbose_name': '聊天室',
+                'verbose_name_plural': '聊天室',
+                'indexes': [models.Index(fields=['last_message_at', 'id'], name='chat_room_activity_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_rooms, migrations.RunPython.noop),
+    ]
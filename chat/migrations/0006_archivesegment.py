@@ -0,0 +1,37 @@
+# Generated by Django 5.0.14 on 2026-10-18 01:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_room'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=255, verbose_name='聊天室名稱')),
+                ('day', models.DateField(verbose_name='日期')),
+                ('path', models.CharField(max_length=500, verbose_name='檔案路徑')),
+                ('message_count', models.IntegerField(default=0, verbose_name='消息數')),
+                ('first_timestamp', models.DateTimeField(verbose_name='最早消息時間')),
+                ('first_id', models.BigIntegerField(verbose_name='最早消息 ID')),
+                ('last_timestamp', models.DateTimeField(verbose_name='最新消息時間')),
+                ('last_id', models.BigIntegerField(verbose_name='最新消息 ID')),
+                ('blocks', models.JSONField(default=list, verbose_name='區塊索引')),
+            ],
+            options={
+                'verbose_name': '歸檔分段',
+                'verbose_name_plural': '歸檔分段',
+                'indexes': [models.Index(fields=['room_name', 'first_timestamp'], name='chat_archive_room_first_idx'), models.Index(fields=['room_name', 'last_timestamp'], name='chat_archive_room_last_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivesegment',
+            constraint=models.UniqueConstraint(fields=('room_name', 'day'), name='chat_archive_room_day_uniq'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+from django.db import migrations
+
+# 與 chat/search.py 的查詢一致；修改時需要新的遷移重建索引
+SQLITE_STATEMENTS = [
+    # 外部內容 (external content) 表：只保存倒排索引，消息內容仍只存在 chat_chatmessage。
+    # trigram 分詞器以三個字元為單位，中文等不以空白分詞的文字也能做子字串搜尋 (需要 SQLite 3.34+)
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+    "content, content='chat_chatmessage', content_rowid='id', tokenize='trigram')",
+    # 以觸發器在同一個交易內增量維護索引，寫後批次寫入與 REST API 都不需要額外的程式碼
+    "CREATE TRIGGER chat_message_fts_ai AFTER INSERT ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER chat_message_fts_ad AFTER DELETE ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER chat_message_fts_au AFTER UPDATE OF content ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    # 為既有消息建立索引
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE_STATEMENTS = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_au",
+    "DROP TRIGGER IF EXISTS chat_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_message_fts_ai",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+# 表達式 GIN 索引由 PostgreSQL 在寫入時自動維護，不需要額外的欄位或觸發器；
+# CONCURRENTLY 建立索引時不阻擋寫入
+POSTGRESQL_STATEMENTS = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_message_search_idx "
+    "ON chat_chatmessage USING GIN (to_tsvector('simple', content))",
+]
+
+POSTGRESQL_REVERSE_STATEMENTS = [
+    "DROP INDEX CONCURRENTLY IF EXISTS chat_message_search_idx",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_STATEMENTS, 'postgresql': POSTGRESQL_STATEMENTS}.get(vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_REVERSE_STATEMENTS, 'postgresql': POSTGRESQL_REVERSE_STATEMENTS}.get(vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY 不能在交易中執行
+    atomic = False
+
+    dependencies = [
+        ('chat', '0006_archivesegment'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.14 on 2026-10-18 01:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=255, verbose_name='聊天室名稱')),
+                ('last_read_id', models.BigIntegerField(verbose_name='最後已讀消息 ID')),
+                ('read_message_count', models.BigIntegerField(default=0, verbose_name='已讀消息數')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='更新時間')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL, verbose_name='用戶')),
+            ],
+            options={
+                'verbose_name': '已讀游標',
+                'verbose_name_plural': '已讀游標',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'room_name'), name='chat_read_cursor_user_room_uniq'),
+        ),
+    ]
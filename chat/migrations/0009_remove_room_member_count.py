@@ -0,0 +1,17 @@
+# Generated by Django 5.0.14 on 2026-10-18 01:42
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_readcursor'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='room',
+            name='member_count',
+        ),
+    ]
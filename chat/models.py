@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User # 導入 Django 內建用戶模型
 
 # 聊天消息模型 (用於存儲歷史記錄)
@@ -12,23 +13,106 @@ class ChatMessage(models.Model):
         verbose_name="發送者"
     ) 
     content = models.TextField(verbose_name="消息內容") # 消息內容
-    timestamp = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="發送時間") # 發送時間
+    # 發送時間：使用 default 而非 auto_now_add，寫後批次寫入時才能保留廣播時的時間戳
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="發送時間")
+    # 客戶端產生的消息 id (例如 UUID)，逾時重試時沿用同一個 id，用於去重
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True, verbose_name="客戶端消息 ID")
 
     class Meta:
         ordering = ['timestamp'] # 依時間戳排序，確保消息順序
         verbose_name = '聊天消息'
         verbose_name_plural = '聊天消息' # 後台顯示名稱
-        # 為 room_name 和 timestamp 組合添加索引，優化歷史消息查詢
-        # 可選：如果 room_name 和 timestamp 組合經常被查詢，可以考慮這個索引
-        # indexes = [
-        #     models.Index(fields=['room_name', 'timestamp']),
-        # ]
+        # 為 room_name、timestamp、id 組合添加索引，歷史消息的鍵集分頁 (keyset pagination)
+        # 可直接在索引上做範圍掃描，不需要對整個聊天室的消息排序
+        indexes = [
+            models.Index(fields=['room_name', 'timestamp', 'id'], name='chat_room_ts_id_idx'),
+            # 斷線重連時以 id 補發遺漏的消息 (room_name = ? AND id > ?)
+            models.Index(fields=['room_name', 'id'], name='chat_room_id_idx'),
+        ]
+        constraints = [
+            # 去重快取過期或被淘汰時，由資料庫擋下同一聊天室內重複的 client_msg_id
+            models.UniqueConstraint(
+                fields=['room_name', 'client_msg_id'],
+                condition=models.Q(client_msg_id__isnull=False),
+                name='chat_room_client_msg_id_uniq',
+            ),
+        ]
 
 
     def __str__(self):
         sender_name = self.sender.username if self.sender else "匿名"
         return f'{self.room_name} - {sender_name}: {self.content[:50]}...' # 顯示前50字
 
+# 聊天室模型：反正規化的統計資料，由寫入路徑批次累加，列出聊天室時不需要掃描 ChatMessage。
+# 在線人數不持久化，列出時由帶到期時間的在線成員集合取得 (見 chat/presence.py)
+class Room(models.Model):
+    name = models.CharField(max_length=255, unique=True, verbose_name="聊天室名稱")
+    message_count = models.BigIntegerField(default=0, verbose_name="消息數")
+    last_message_at = models.DateTimeField(null=True, blank=True, verbose_name="最後消息時間")
+    last_message_id = models.BigIntegerField(null=True, blank=True, verbose_name="最後消息 ID") # 寫後模式下為空
+    last_message_user = models.CharField(max_length=150, blank=True, default='', verbose_name="最後發送者")
+    last_message_preview = models.CharField(max_length=200, blank=True, default='', verbose_name="最後消息預覽")
+
+    class Meta:
+        verbose_name = '聊天室'
+        verbose_name_plural = '聊天室'
+        # 活躍聊天室列表依 (last_message_at, id) 由新到舊做鍵集分頁
+        indexes = [
+            models.Index(fields=['last_message_at', 'id'], name='chat_room_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.message_count} 條消息)'
+
+# 歸檔分段：每個聊天室每天一個 gzip JSONL 檔，記錄檔案內每個區塊的位移，讀取時只解壓需要的區塊
+class ArchiveSegment(models.Model):
+    room_name = models.CharField(max_length=255, verbose_name="聊天室名稱")
+    day = models.DateField(verbose_name="日期") # UTC 日期
+    path = models.CharField(max_length=500, verbose_name="檔案路徑") # 相對於 CHAT_ARCHIVE_DIR
+    message_count = models.IntegerField(default=0, verbose_name="消息數")
+    first_timestamp = models.DateTimeField(verbose_name="最早消息時間")
+    first_id = models.BigIntegerField(verbose_name="最早消息 ID")
+    last_timestamp = models.DateTimeField(verbose_name="最新消息時間")
+    last_id = models.BigIntegerField(verbose_name="最新消息 ID")
+    # 每個區塊是一個獨立的 gzip member：
+    # [位移, 長度, 消息數, 最早時間, 最早 ID, 最新時間, 最新 ID]，依 (timestamp, id) 由舊到新排列
+    blocks = models.JSONField(default=list, verbose_name="區塊索引")
+
+    class Meta:
+        verbose_name = '歸檔分段'
+        verbose_name_plural = '歸檔分段'
+        constraints = [
+            models.UniqueConstraint(fields=['room_name', 'day'], name='chat_archive_room_day_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['room_name', 'first_timestamp'], name='chat_archive_room_first_idx'),
+            models.Index(fields=['room_name', 'last_timestamp'], name='chat_archive_room_last_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_name} {self.day} ({self.message_count} 條消息)'
+
+# 已讀游標：每個用戶在每個聊天室讀到的最後一條消息，由 WebSocket 的已讀回執批次寫入
+class ReadCursor(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors', verbose_name="用戶")
+    room_name = models.CharField(max_length=255, verbose_name="聊天室名稱")
+    last_read_id = models.BigIntegerField(verbose_name="最後已讀消息 ID")
+    # 讀到 last_read_id 時該聊天室累計的消息數 (對應 Room.message_count)，
+    # 未讀數 = Room.message_count - read_message_count，查詢時不需要計算 ChatMessage 的行數
+    read_message_count = models.BigIntegerField(default=0, verbose_name="已讀消息數")
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name="更新時間")
+
+    class Meta:
+        verbose_name = '已讀游標'
+        verbose_name_plural = '已讀游標'
+        constraints = [
+            # 批次寫入以 INSERT ... ON CONFLICT (user_id, room_name) 合併
+            models.UniqueConstraint(fields=['user', 'room_name'], name='chat_read_cursor_user_room_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} @ {self.room_name}: {self.last_read_id}'
+
 # 通知模型 (如果需要持久化通知，可以取消註解)
 # class Notification(models.Model):
 #     recipient = models.ForeignKey(
@@ -0,0 +1,162 @@
+import asyncio
+import logging # 導入 logging 模組
+import time
+from collections import deque
+
+from . import metrics # Prometheus 指標
+from . import wire # WebSocket 幀編碼
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+# 慢速客戶端處理策略
+POLICY_DROP_OLDEST = 'drop_oldest' # 丟棄最舊的待發送幀
+POLICY_DISCONNECT = 'disconnect' # 中斷連線，由客戶端重連後重新載入
+POLICY_SUMMARY = 'summary' # 清空佇列，改發一則「略過 N 條消息」的摘要幀
+
+MAX_BATCH = 500 # 單一批次幀最多合併的消息數
+
+# 本進程所有連線的累計計數
+stats = {
+    'frames_queued': 0,
+    'frames_sent': 0,
+    'batches_sent': 0,
+    'dropped': 0,
+    'summaries': 0,
+    'disconnects': 0,
+}
+
+
+@metrics.register_collector
+def _collect_metrics():
+    return [
+        (f'chat_outbound_{key}_total', 'counter', f'發送佇列累計 {key}', [({}, value)])
+        for key, value in stats.items()
+    ]
+
+
+class OutboundQueue:
+    """
+    每個 WebSocket 連線的發送佇列。
+
+    chat_message 只把幀放入佇列，由背景任務依序發送。距離上次發送不足 window 秒時，
+    期間到達的幀會合併為一個 {"type": "batch", "messages": [...]} 幀，熱門聊天室因此
+    每秒最多發送 1/window 個幀，消息順序不變。佇列超過 max_depth 時依 policy 處理。
+    佇列只在 send 尚未返回時累積：daphne 的 send 在幀放入傳輸層緩衝區後就返回，
+    不等待客戶端讀取，因此 max_depth 限制的是進程內的突發量 (事件循環忙碌、合併窗口)，
+    不是 TCP 層面的慢速客戶端。
+    佇列中一律是 JSON 幀，發送時由 codec 轉為連線協商的格式 (見 wire.negotiate)。
+    """
+
+    def __init__(self, send, close, window=0.0, max_depth=1000, policy=POLICY_DROP_OLDEST, codec=wire.JSON_CODEC):
+        self._send = send
+        self.codec = codec
+        self._close = close
+        self.window = window
+        self.max_depth = max_depth
+        self.policy = policy
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        self._task = None
+        self._last_sent = 0.0
+        self._skipped = 0 # summary 策略下略過、尚未通知客戶端的消息數
+        self._closing = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._done)
+
+    @staticmethod
+    def _done(task):
+        # 取出未預期的例外，避免任務靜默結束
+        if not task.cancelled() and task.exception() is not None:
+            metrics.errors_total.inc('outbound')
+            logger.error(f"發送佇列任務意外結束: {task.exception()!r}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def put(self, frame):
+        """
+        放入一個待發送的文字幀，不會阻塞。
+        """
+        if self._closing:
+            return
+        if len(self._frames) >= self.max_depth:
+            if not self._overflow():
+                return
+        self._frames.append(frame)
+        stats['frames_queued'] += 1
+        self._ready.set()
+
+    def _overflow(self):
+        # 返回 True 表示仍可放入新幀
+        if self.policy == POLICY_DISCONNECT:
+            stats['disconnects'] += 1
+            stats['dropped'] += len(self._frames)
+            logger.warning(f"發送佇列超過 {self.max_depth} 幀，中斷慢速客戶端。")
+            self._frames.clear()
+            self._closing = True
+            self._ready.set()
+            return False
+        if self.policy == POLICY_SUMMARY:
+            stats['dropped'] += len(self._frames)
+            self._skipped += len(self._frames)
+            self._frames.clear()
+            return True
+        stats['dropped'] += 1
+        self._frames.popleft()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._closing:
+                await self._close(code=4008)
+                return
+            try:
+                await self._send_pending()
+            except Exception as e:
+                # 連線已關閉等發送失敗：停止接收新幀並關閉連線，不讓幀繼續堆積
+                metrics.errors_total.inc('outbound')
+                logger.error(f"發送佇列發送失敗，關閉連線: {e}")
+                self._closing = True
+                stats['dropped'] += len(self._frames)
+                self._frames.clear()
+                try:
+                    await self._close(code=1011)
+                except Exception as close_error:
+                    logger.debug(f"關閉連線時發生錯誤: {close_error}")
+                return
+
+    async def _send_pending(self):
+        """
+        發送目前佇列中的幀 (必要時先等待合併窗口)。
+        """
+        # 距離上次發送不足一個合併窗口時，先等待以累積更多幀
+        wait = self._last_sent + self.window - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self._skipped:
+            stats['summaries'] += 1
+            summary = wire.dumps({'type': 'summary', 'skipped': self._skipped})
+            self._skipped = 0
+            await self._send(text_data=summary)
+        while self._frames:
+            count = min(len(self._frames), MAX_BATCH if self.window > 0 else 1)
+            batch = [self._frames.popleft() for _ in range(count)]
+            if len(batch) == 1:
+                await self._send(**self.codec.frame_kwargs(batch[0]))
+            else:
+                # 幀已是編碼好的 JSON 或 msgpack，直接拼接，不需重新編碼
+                await self._send(**self.codec.batch_kwargs(batch))
+                stats['batches_sent'] += 1
+            stats['frames_sent'] += len(batch)
+        self._last_sent = time.monotonic()
@@ -0,0 +1,158 @@
+import logging # 導入 logging 模組
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.dateparse import parse_datetime
+from django.utils.safestring import mark_safe
+
+from . import metrics # Prometheus 指標
+from .db import db_sync_to_async # 有界的資料庫執行緒池
+from .history import fetch_page # 鍵集分頁歷史查詢
+from .models import Room
+from .routers import replica_reads # 讀寫分離
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+# room.html 中歷史消息片段的位置；整頁以此切成前後兩段，歷史消息在兩段之間串流輸出
+_HISTORY_SLOT = '<!--chat-history-slot-->'
+
+
+class HistoryFragmentCache:
+    """
+    每個聊天室已渲染的歷史消息片段 (chat/room_history.html) 的進程內 LRU 快取。
+
+    片段以聊天室的版本 (Room 表的 last_message_id 與 message_count) 為鍵，
+    任何 worker 寫入新消息後，聊天室統計批次寫入時版本隨之改變，舊片段不再命中；
+    本進程發送消息時另以 invalidate() 立即移除。
+    """
+
+    def __init__(self, max_rooms=1000):
+        self.max_rooms = max_rooms
+        self._fragments = OrderedDict() # 聊天室 -> (版本, 片段)
+        self._lock = threading.Lock() # 同步視圖在執行緒池中並行呼叫
+
+    def get(self, room_name, version):
+        with self._lock:
+            entry = self._fragments.get(room_name)
+            if entry is None or entry[0] != version:
+                return None
+            self._fragments.move_to_end(room_name)
+            return entry[1]
+
+    def put(self, room_name, version, fragment):
+        with self._lock:
+            self._fragments[room_name] = (version, fragment)
+            self._fragments.move_to_end(room_name)
+            if len(self._fragments) > self.max_rooms:
+                self._fragments.popitem(last=False)
+
+    def invalidate(self, room_name):
+        with self._lock:
+            self._fragments.pop(room_name, None)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_fragment_cache():
+    """
+    取得本進程共用的歷史片段快取；CHAT_ROOM_PAGE_CACHE_ROOMS 為 0 時返回 None。
+    """
+    global _cache
+    if settings.CHAT_ROOM_PAGE_CACHE_ROOMS <= 0:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = HistoryFragmentCache(max_rooms=settings.CHAT_ROOM_PAGE_CACHE_ROOMS)
+    return _cache
+
+
+def invalidate(room_name):
+    """
+    聊天室有新消息時呼叫，只更新記憶體。
+    """
+    cache = get_fragment_cache()
+    if cache is not None:
+        cache.invalidate(room_name)
+
+
+def room_state(room_name):
+    """
+    聊天室頁面的版本資訊，只讀取 Room 表；聊天室尚未建立 (或停用統計) 時返回 None。
+    """
+    return Room.objects.filter(name=room_name).values('last_message_id', 'message_count', 'last_message_at').first()
+
+
+def room_etag(state, user):
+    """
+    頁面的 ETag：聊天室的最新消息 id 與消息數，加上用戶 (頁面內容依登入狀態不同)。
+    統計每秒批次寫入，ETag 最多落後一個寫入間隔；頁面帶有 last_seen_id，
+    客戶端連線後會補發這段期間的消息。
+    """
+    return f'{state["last_message_id"] or 0}-{state["message_count"]}-{user.pk or 0}'
+
+
+def render_history(room_name, limit):
+    """
+    讀取最新一頁歷史消息並渲染為片段，同時帶入分頁游標與最新消息 id。
+    """
+    messages = []
+    older_cursor = None
+    try:
+        page = fetch_page(room_name, limit=limit)
+        older_cursor = page['older']
+        for item in page['messages']:
+            # 模板使用 date 過濾器，將 ISO 時間戳轉回 datetime
+            messages.append(dict(item, timestamp=parse_datetime(item['timestamp'])))
+    except Exception as e:
+        logger.error(f"加載歷史消息時發生錯誤: {e}")
+    return render_to_string('chat/room_history.html', {
+        'messages': messages,
+        'older_cursor': older_cursor, # 用於向前載入更早的消息
+        'last_seen_id': next((m['id'] for m in reversed(messages) if m['id']), 0), # 重連時補發此 id 之後的消息
+    })
+
+
+def history_fragment(room_name, state, sticky_key=None):
+    """
+    聊天室的歷史消息片段：版本相同時直接使用快取，否則查詢並渲染後放入快取。
+    """
+    cache = get_fragment_cache()
+    version = (state['last_message_id'], state['message_count']) if state is not None else None
+    if cache is not None and version is not None:
+        fragment = cache.get(room_name, version)
+        if fragment is not None:
+            metrics.room_page_fragments_total.inc('hit')
+            return fragment
+    metrics.room_page_fragments_total.inc('miss')
+    with replica_reads(sticky_key):
+        fragment = render_history(room_name, settings.CHAT_ROOM_PAGE_HISTORY)
+    if cache is not None and version is not None:
+        cache.put(room_name, version, fragment)
+    return fragment
+
+
+def stream_room_page(request, room_name, state, sticky_key=None):
+    """
+    返回依序產生聊天室頁面的異步迭代器：先輸出頁首 (不需要查詢)，再輸出歷史消息片段，最後輸出頁尾與腳本，
+    首位元組的時間與歷史消息的多寡無關。
+
+    頁首與頁尾在呼叫時 (視圖的執行緒中) 渲染；歷史片段在資料庫執行緒池中取得。
+    ASGI 下 Django 直接以 async for 逐段送出，同步迭代器則會先被整個讀入記憶體。
+    """
+    page = render_to_string('chat/room.html', {
+        'room_name': room_name,
+        'history': mark_safe(_HISTORY_SLOT),
+    }, request=request)
+    head, tail = page.split(_HISTORY_SLOT, 1)
+
+    async def chunks():
+        yield head
+        yield await db_sync_to_async(history_fragment)(room_name, state, sticky_key)
+        yield tail
+    return chunks()
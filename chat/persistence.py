@@ -0,0 +1,328 @@
+import atexit
+import json
+import logging # 導入 logging 模組
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import metrics # Prometheus 指標
+from .db import db_sync_to_async # 有界的資料庫執行緒池
+from .models import ChatMessage # 確保導入 ChatMessage 模型
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    消息寫後 (write-behind) 緩衝區。
+
+    消息先進入每個進程各自的有界佇列，由背景執行緒依「數量」或「時間」門檻
+    以 bulk_create 批次寫入資料庫。資料庫不可用時會退避重試，重試耗盡或佇列
+    溢出的消息寫入溢出檔 (JSONL)，待資料庫恢復後再補寫。
+
+    enqueue() 可能在事件循環中呼叫，溢出的消息交給單一執行緒的 executor 寫檔，
+    不在事件循環中、也不在佇列鎖內做檔案 I/O。
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.5, max_queue=10000,
+                 max_retries=3, spill_path=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._overflow = [] # 等待寫入溢出檔的消息
+        self._overflow_scheduled = False
+        self._pending = Counter() # 聊天室 -> 還在記憶體中 (佇列、溢出、寫入中) 的消息數
+        self._spill_lock = threading.Lock() # 溢出檔的寫入與改名
+        self._spill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-write-behind-spill')
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def enqueue(self, room_name, sender, content, timestamp, client_msg_id=None):
+        """
+        將一條消息放入緩衝區，立即返回。佇列已滿時，最舊的消息會被移入溢出檔。
+        """
+        schedule_spill = False
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                self._overflow.append(self._queue.popleft())
+                schedule_spill = not self._overflow_scheduled
+                self._overflow_scheduled = True
+            self._queue.append(ChatMessage(
+                room_name=room_name,
+                sender=sender,
+                content=content,
+                timestamp=timestamp,
+                client_msg_id=client_msg_id,
+            ))
+            self._pending[room_name] += 1
+            should_flush = len(self._queue) >= self.batch_size
+        if schedule_spill:
+            logger.warning("寫後緩衝區已滿，最舊的消息移入溢出檔。")
+            try:
+                self._spill_executor.submit(self._spill_overflow)
+            except RuntimeError:
+                # 進程結束中，executor 已關閉
+                self._spill_overflow()
+        self._ensure_started()
+        if should_flush:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        將目前緩衝區內所有消息寫入資料庫 (同步執行)。
+        """
+        while True:
+            with self._lock:
+                if not self._queue:
+                    break
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            try:
+                self._write_batch(batch)
+            finally:
+                self._settled(batch)
+
+    def has_pending(self, room_name):
+        """
+        該聊天室是否有尚未交給資料庫或溢出檔的消息。
+        """
+        with self._lock:
+            return self._pending[room_name] > 0
+
+    def _settled(self, messages):
+        with self._lock:
+            for msg in messages:
+                self._pending[msg.room_name] -= 1
+                if self._pending[msg.room_name] <= 0:
+                    del self._pending[msg.room_name]
+
+    def stop(self):
+        """
+        停止背景執行緒並寫出剩餘消息，供進程結束時呼叫。
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval * 4 + 5)
+        self._spill_executor.shutdown(wait=True)
+        self._spill_overflow()
+        self.flush()
+
+    def _spill_overflow(self):
+        with self._lock:
+            overflow, self._overflow = self._overflow, []
+            self._overflow_scheduled = False
+        if overflow:
+            try:
+                self._spill(overflow)
+            finally:
+                self._settled(overflow)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                self._replay_spill()
+            except Exception as e:
+                logger.error(f"寫後緩衝區背景寫入時發生錯誤: {e}")
+            finally:
+                # 背景執行緒持有自己的資料庫連線，定期清理過期連線
+                close_old_connections()
+
+    def _write_batch(self, batch):
+        delay = 0.1
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                # 去重快取失效時的重試由唯一約束擋下，略過衝突的行，不讓整批寫入失敗
+                ChatMessage.objects.bulk_create(batch, ignore_conflicts=True)
+                logger.debug(f"寫後緩衝區已批次寫入 {len(batch)} 條消息。")
+                return True
+            except Exception as e:
+                logger.error(f"批次寫入消息失敗 (第 {attempt} 次): {e}")
+                close_old_connections()
+                if attempt < self.max_retries:
+                    time.sleep(delay)
+                    delay *= 2
+        self._spill(batch)
+        return False
+
+    def _spill(self, messages):
+        if not self.spill_path:
+            logger.error(f"未配置溢出檔，{len(messages)} 條消息已遺失。")
+            return
+        try:
+            with self._spill_lock, open(self.spill_path, 'a', encoding='utf-8') as f:
+                for msg in messages:
+                    f.write(json.dumps({
+                        'room_name': msg.room_name,
+                        'sender_id': msg.sender_id,
+                        'content': msg.content,
+                        'timestamp': msg.timestamp.isoformat(),
+                        'client_msg_id': msg.client_msg_id,
+                    }, ensure_ascii=False) + '\n')
+            logger.warning(f"{len(messages)} 條消息已寫入溢出檔: {self.spill_path}")
+        except OSError as e:
+            logger.error(f"寫入溢出檔時發生錯誤，{len(messages)} 條消息已遺失: {e}")
+
+    def _replay_spill(self):
+        if not self.spill_path:
+            return
+        # 先改名再讀取，避免與新的溢出寫入互相覆蓋。上次補寫中途結束 (例如進程崩潰) 留下的
+        # .replay 檔先補寫完，本次不改名，不會覆蓋其中尚未寫入的消息
+        replay_path = f'{self.spill_path}.replay'
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, replay_path)
+        with open(replay_path, encoding='utf-8') as f:
+            batch = [
+                ChatMessage(
+                    room_name=row['room_name'],
+                    sender_id=row['sender_id'],
+                    content=row['content'],
+                    timestamp=parse_datetime(row['timestamp']),
+                    client_msg_id=row.get('client_msg_id'),
+                )
+                for row in map(json.loads, f) if row
+            ]
+        for i in range(0, len(batch), self.batch_size):
+            self._write_batch(batch[i:i + self.batch_size])
+        # 全部批次寫完才刪除：中途結束時保留 .replay 檔，下次重新補寫 (帶 client_msg_id 的消息由唯一約束去重)。
+        # 寫入失敗的批次已由 _write_batch 追加到溢出檔，不會隨 .replay 檔一起刪除
+        os.remove(replay_path)
+        if batch:
+            logger.info(f"已從溢出檔補寫 {len(batch)} 條消息。")
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_behind_buffer():
+    """
+    取得本進程共用的寫後緩衝區；未啟用寫後模式時返回 None。
+    """
+    global _buffer
+    if not settings.CHAT_WRITE_BEHIND:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(
+                    batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+                    flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+                    max_queue=settings.CHAT_WRITE_BEHIND_MAX_QUEUE,
+                    max_retries=settings.CHAT_WRITE_BEHIND_MAX_RETRIES,
+                    spill_path=settings.CHAT_WRITE_BEHIND_SPILL_PATH,
+                )
+    return _buffer
+
+
+@metrics.register_collector
+def _collect_metrics():
+    if _buffer is None:
+        return []
+    return [('chat_write_behind_queue_depth', 'gauge', '寫後緩衝區待寫入的消息數', [({}, len(_buffer._queue))])]
+
+
+def save_message(room_name, sender, content, timestamp, client_msg_id=None):
+    """
+    WebSocket 與 REST API 共用的消息寫入入口。
+
+    寫後模式下消息只進入緩衝區並返回 None；否則直接寫入資料庫並返回 ChatMessage。
+    同一聊天室內重複的 client_msg_id 會拋出 IntegrityError。
+    """
+    buffer = get_write_behind_buffer()
+    if buffer is not None:
+        buffer.enqueue(room_name, sender, content, timestamp, client_msg_id)
+        return None
+    return ChatMessage.objects.create(
+        room_name=room_name,
+        sender=sender,
+        content=content,
+        timestamp=timestamp,
+        client_msg_id=client_msg_id,
+    )
+
+
+def save_messages(messages):
+    """
+    批次發送 API 的寫入入口：messages 為尚未儲存的 ChatMessage 列表。
+
+    寫後模式下全部放入緩衝區並返回 None；否則在一個交易中以一次 bulk_create 寫入，
+    返回帶 id 的同一列表。任何一條違反唯一約束時整批回滾並拋出 IntegrityError。
+    """
+    buffer = get_write_behind_buffer()
+    if buffer is not None:
+        for message in messages:
+            buffer.enqueue(message.room_name, message.sender, message.content, message.timestamp, message.client_msg_id)
+        return None
+    with transaction.atomic():
+        return ChatMessage.objects.bulk_create(messages)
+
+
+def find_message_ids(keys):
+    """
+    返回 {(聊天室, client_msg_id): 消息 id}，只包含資料庫中已存在的項目；一次查詢。
+    """
+    query = Q()
+    for room_name, client_msg_id in keys:
+        query |= Q(room_name=room_name, client_msg_id=client_msg_id)
+    if not query:
+        return {}
+    return {
+        (room_name, client_msg_id): message_id
+        for message_id, room_name, client_msg_id in
+        ChatMessage.objects.filter(query).values_list('id', 'room_name', 'client_msg_id')
+    }
+
+
+def find_message_id(room_name, client_msg_id):
+    """
+    返回聊天室內帶有 client_msg_id 的消息 id；不存在時返回 None。
+    """
+    return ChatMessage.objects.filter(
+        room_name=room_name, client_msg_id=client_msg_id).values_list('id', flat=True).first()
+
+
+async def asave_message(room_name, sender, content, timestamp, client_msg_id=None):
+    """
+    save_message 的異步版本，供 Consumer 使用。寫後模式下不經過執行緒切換；
+    直接寫入時在資料庫執行緒池中執行，不與其他連線的寫入排進同一條執行緒。
+    """
+    buffer = get_write_behind_buffer()
+    if buffer is not None:
+        buffer.enqueue(room_name, sender, content, timestamp, client_msg_id)
+        return None
+    return await db_sync_to_async(ChatMessage.objects.create)(
+        room_name=room_name,
+        sender=sender,
+        content=content,
+        timestamp=timestamp,
+        client_msg_id=client_msg_id,
+    )
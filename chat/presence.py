@@ -0,0 +1,375 @@
+import asyncio
+import bisect
+import logging # 導入 logging 模組
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter, defaultdict
+
+from django.conf import settings
+
+from . import metrics # Prometheus 指標
+from . import wire # WebSocket 幀編碼
+from .fanout import abroadcast # 群發 (大型聊天室走進程內群發)
+from .messaging import room_group_name
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMBERS_PAGE_SIZE = 50 # 成員列表每頁預設人數
+MAX_MEMBERS_PAGE_SIZE = 500 # 成員列表每頁最大人數
+ANONYMOUS_NAME = '未登入用戶'
+
+# 每個聊天室三個鍵，以 {聊天室} 作為 hash tag 讓它們落在同一個 Redis Cluster 槽：
+#   KEYS[1] 成員 (score 皆為 0，依成員鍵的字典序排列，供 ZRANGEBYLEX 分頁與 ZCARD 計數)
+#   KEYS[2] "成員鍵|worker" -> 到期時間 (毫秒)，每個 worker 各自一筆，由該 worker 定期心跳延長
+#   KEYS[3] hash：成員鍵 -> 持有該成員的 worker 數
+# 成員只在第一個 worker 加入時進入 KEYS[1]、最後一個 worker 離開 (或到期) 時移出，
+# 一個 worker 上的最後一條連線斷開不會讓仍在其他 worker 上的成員被移除。
+# ARGV: TTL 毫秒、worker id、新增數 n、n 個新增成員、其餘為移除的成員。
+# 以 Redis 伺服器時間判斷到期，不受各 worker 時鐘誤差影響；順便清除已崩潰 worker 留下的過期項目。
+# 返回 {成員數 (ZCARD)、實際加入的成員、實際離開的成員}
+_APPLY_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local ttl = tonumber(ARGV[1])
+local worker = ARGV[2]
+local added = tonumber(ARGV[3])
+local joined, left = {}, {}
+local function release(member)
+    if redis.call('HINCRBY', KEYS[3], member, -1) <= 0 then
+        redis.call('HDEL', KEYS[3], member)
+        redis.call('ZREM', KEYS[1], member)
+        table.insert(left, member)
+    end
+end
+for i = 4, 3 + added do
+    if redis.call('ZADD', KEYS[2], now + ttl, ARGV[i] .. '|' .. worker) == 1 then
+        if redis.call('HINCRBY', KEYS[3], ARGV[i], 1) == 1 then
+            redis.call('ZADD', KEYS[1], 0, ARGV[i])
+            table.insert(joined, ARGV[i])
+        end
+    end
+end
+for i = 4 + added, #ARGV do
+    if redis.call('ZREM', KEYS[2], ARGV[i] .. '|' .. worker) == 1 then
+        release(ARGV[i])
+    end
+end
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 1000)
+for _, entry in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], entry)
+    release(string.match(entry, '^(.*)|[^|]*$'))
+end
+if added > 0 then
+    -- 所有 worker 都停止心跳後，整個聊天室的鍵自動過期
+    redis.call('PEXPIRE', KEYS[1], ttl)
+    redis.call('PEXPIRE', KEYS[2], ttl)
+    redis.call('PEXPIRE', KEYS[3], ttl)
+end
+return {redis.call('ZCARD', KEYS[1]), joined, left}
+"""
+
+
+def member_key(user, channel_name):
+    """
+    成員鍵：登入用戶以用戶名稱 (同一用戶的多個分頁算一人)，未登入用戶以連線的頻道名稱區分。
+    """
+    return f'u:{user.username}' if user.is_authenticated else f'a:{channel_name}'
+
+
+def display_name(key):
+    return key[2:] if key.startswith('u:') else ANONYMOUS_NAME
+
+
+def _decode_keys(keys):
+    return sorted(key.decode('utf-8') for key in keys)
+
+
+def _page(keys, count, limit):
+    """
+    成員列表的一頁：keys 為依字典序排列、最多 limit + 1 個成員鍵，next 為下一頁的 after 參數。
+    """
+    has_more = len(keys) > limit
+    keys = keys[:limit]
+    return {
+        'count': count,
+        'members': [display_name(key) for key in keys],
+        'next': keys[-1] if has_more and keys else None,
+    }
+
+
+class RedisPresenceStore:
+    """
+    以 Redis 彙總所有 worker 的在線成員。
+
+    只有成員在本進程的第一條連線建立、最後一條連線斷開時才寫入 Redis，而且每批一次管線往返；
+    worker 每隔 CHAT_PRESENCE_HEARTBEAT 秒為本進程的成員延長到期時間，崩潰的 worker 停止心跳後，
+    其項目在 CHAT_PRESENCE_TTL 秒後由下一次寫入、心跳或成員列表讀取清除。
+    每個 worker 各自登記持有的成員，同一用戶連在多個 worker 上時，只有最後一個 worker 離開才算離開。
+    """
+
+    key_prefix = 'chat:presence:'
+
+    def __init__(self, url, ttl=45.0):
+        import redis # channels_redis 的依賴，已隨 requirements.txt 安裝
+        self.ttl_ms = int(ttl * 1000)
+        self.worker_id = uuid.uuid4().hex # 區分各 worker 持有的成員項目
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self._script = self._client.register_script(_APPLY_SCRIPT)
+        self._url = url
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self):
+        from redis import asyncio as aioredis
+        # redis.asyncio 連線綁定事件循環，每個事件循環各自建立客戶端與腳本物件
+        loop = asyncio.get_running_loop()
+        entry = self._async_clients.get(loop)
+        if entry is None:
+            client = aioredis.Redis.from_url(self._url, socket_connect_timeout=1, socket_timeout=1)
+            entry = self._async_clients[loop] = (client, client.register_script(_APPLY_SCRIPT))
+        return entry
+
+    def _keys(self, room_name):
+        prefix = f'{self.key_prefix}{{{room_name}}}'
+        return [f'{prefix}:members', f'{prefix}:expires', f'{prefix}:workers']
+
+    def _args(self, added, removed):
+        return [self.ttl_ms, self.worker_id, len(added), *added, *removed]
+
+    async def aapply(self, changes):
+        """
+        changes 為 [(聊天室, 本進程新增的成員鍵, 本進程移除的成員鍵)]，以一次管線往返寫入。
+        返回 {聊天室: (成員數, 實際加入的成員鍵, 實際離開的成員鍵)}：其他 worker 仍持有的成員不算離開，
+        已在其他 worker 上的成員也不算加入。
+        """
+        client, script = self._async_client()
+        async with client.pipeline(transaction=False) as pipe:
+            for room_name, added, removed in changes:
+                await script(keys=self._keys(room_name), args=self._args(added, removed), client=pipe)
+            results = await pipe.execute()
+        return {
+            room_name: (count, _decode_keys(joined), _decode_keys(left))
+            for (room_name, _, _), (count, joined, left) in zip(changes, results)
+        }
+
+    def counts(self, room_names):
+        """
+        多個聊天室的成員數，一次管線往返。已崩潰 worker 的成員在下一次寫入或心跳時清除。
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for room_name in room_names:
+            pipe.zcard(self._keys(room_name)[0])
+        return dict(zip(room_names, pipe.execute()))
+
+    def members(self, room_name, after=None, limit=DEFAULT_MEMBERS_PAGE_SIZE):
+        keys = self._keys(room_name)
+        pipe = self._client.pipeline(transaction=False)
+        self._script(keys=keys, args=self._args((), ()), client=pipe)
+        pipe.zrangebylex(keys[0], f'({after}' if after else '-', '+', start=0, num=limit + 1)
+        (count, _, _), page = pipe.execute()
+        return _page(_decode_keys(page), count, limit)
+
+
+class PresenceTracker:
+    """
+    本進程各聊天室的在線成員 (成員鍵 -> 連線數)，以及尚未推送的加入 / 離開變化。
+
+    join / leave 只更新記憶體，不做 I/O。背景任務每隔 CHAT_PRESENCE_DEBOUNCE 秒把這段期間的變化
+    合併為每個聊天室一個 presence 幀推送給客戶端 (期間加入又離開的成員互相抵銷)，
+    並在設定了 Redis 時批次寫入共用的成員集合，讓成員數與成員列表涵蓋所有 worker。
+    """
+
+    def __init__(self, store=None, debounce=1.0, heartbeat=15.0, max_delta=100):
+        self.store = store
+        self.debounce = debounce
+        self.heartbeat = heartbeat
+        self.max_delta = max_delta
+        self._local = defaultdict(Counter) # 聊天室 -> {成員鍵: 本進程的連線數}
+        self._joined = defaultdict(set) # 聊天室 -> 尚未推送的加入
+        self._left = defaultdict(set) # 聊天室 -> 尚未推送的離開
+        self._lock = threading.Lock() # 成員 API 在執行緒池中讀取
+        self._channel_layer = None
+        self._task = None
+
+    def join(self, channel_layer, room_name, key):
+        with self._lock:
+            connections = self._local[room_name]
+            connections[key] += 1
+            first = connections[key] == 1
+            if first:
+                self._changed(room_name, key, self._joined, self._left)
+        self._channel_layer = channel_layer
+        if first:
+            self._ensure_started()
+
+    def leave(self, room_name, key):
+        with self._lock:
+            connections = self._local.get(room_name)
+            if not connections or key not in connections:
+                return
+            connections[key] -= 1
+            if connections[key] > 0:
+                return
+            del connections[key]
+            if not connections:
+                del self._local[room_name]
+            self._changed(room_name, key, self._left, self._joined)
+
+    @staticmethod
+    def _changed(room_name, key, pending, opposite):
+        # 同一批次內相反的變化互相抵銷，客戶端看到的狀態不變
+        if key in opposite.get(room_name, ()):
+            opposite[room_name].discard(key)
+            if not opposite[room_name]:
+                del opposite[room_name]
+        else:
+            pending[room_name].add(key)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        next_heartbeat = time.monotonic() + self.heartbeat
+        while True:
+            await asyncio.sleep(self.debounce)
+            try:
+                await self.flush()
+            except Exception as e:
+                # 本批次的變化不再推送；立即以心跳重寫本進程的成員，已離開的成員則由到期時間清除
+                metrics.errors_total.inc('presence')
+                logger.error(f"推送在線狀態時發生錯誤: {e}")
+                next_heartbeat = 0
+            if self.store is not None and time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + self.heartbeat
+                try:
+                    await self.send_heartbeat()
+                except Exception as e:
+                    metrics.errors_total.inc('presence')
+                    logger.error(f"在線狀態心跳失敗: {e}")
+                    next_heartbeat = 0
+
+    async def flush(self):
+        """
+        推送累積的變化：每個有變化的聊天室一個 presence 幀，附上最新的成員數。
+        """
+        with self._lock:
+            joined, self._joined = self._joined, defaultdict(set)
+            left, self._left = self._left, defaultdict(set)
+            changes = [(room_name, sorted(joined.get(room_name, ())), sorted(left.get(room_name, ())))
+                       for room_name in set(joined) | set(left)]
+            if self.store is None:
+                results = {
+                    room_name: (len(self._local.get(room_name, ())), added, removed)
+                    for room_name, added, removed in changes
+                }
+        if not changes:
+            return
+        if self.store is not None:
+            results = await self.store.aapply(changes)
+        for room_name, (count, added, removed) in results.items():
+            if not added and not removed:
+                continue # 變化只發生在本進程 (例如同一用戶仍連在其他 worker 上)，客戶端看到的狀態不變
+            frame = {'type': 'presence', 'count': count}
+            if len(added) + len(removed) > self.max_delta:
+                # 大量進出 (例如 worker 重啟) 時只推送成員數，客戶端需要時再讀取成員列表
+                frame['truncated'] = True
+            else:
+                frame['joined'] = [display_name(key) for key in added]
+                frame['left'] = [display_name(key) for key in removed]
+            metrics.presence_updates_total.inc()
+            await abroadcast(self._channel_layer, room_group_name(room_name), room_name, wire.dumps(frame))
+
+    async def send_heartbeat(self):
+        with self._lock:
+            changes = [(room_name, sorted(connections), ()) for room_name, connections in self._local.items()]
+        if changes:
+            await self.store.aapply(changes)
+
+    def counts(self, room_names):
+        if self.store is not None:
+            return self.store.counts(room_names)
+        with self._lock:
+            return {room_name: len(self._local.get(room_name, ())) for room_name in room_names}
+
+    def members(self, room_name, after=None, limit=DEFAULT_MEMBERS_PAGE_SIZE):
+        """
+        依成員鍵的字典序返回一頁成員名稱；after 為上一頁返回的 next。
+        """
+        limit = max(0, min(limit, MAX_MEMBERS_PAGE_SIZE))
+        if self.store is not None:
+            return self.store.members(room_name, after=after, limit=limit)
+        # 未設定 Redis 時只有本進程的成員
+        with self._lock:
+            keys = sorted(self._local.get(room_name, ()))
+        start = bisect.bisect_right(keys, after) if after else 0
+        return _page(keys[start:start + limit + 1], len(keys), limit)
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_presence():
+    """
+    取得本進程共用的在線狀態追蹤器；CHAT_PRESENCE_BACKEND 為 'none' 時返回 None。
+    """
+    global _tracker
+    backend = settings.CHAT_PRESENCE_BACKEND
+    if backend == 'none':
+        return None
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                store = None
+                if backend == 'redis':
+                    store = RedisPresenceStore(settings.CHAT_PRESENCE_REDIS_URL, ttl=settings.CHAT_PRESENCE_TTL)
+                _tracker = PresenceTracker(
+                    store,
+                    debounce=settings.CHAT_PRESENCE_DEBOUNCE,
+                    heartbeat=settings.CHAT_PRESENCE_HEARTBEAT,
+                    max_delta=settings.CHAT_PRESENCE_MAX_DELTA,
+                )
+    return _tracker
+
+
+def join(channel_layer, room_name, key):
+    """
+    連線加入聊天室時呼叫 (需在事件循環中)。
+    """
+    tracker = get_presence()
+    if tracker is not None:
+        tracker.join(channel_layer, room_name, key)
+
+
+def leave(room_name, key):
+    tracker = get_presence()
+    if tracker is not None:
+        tracker.leave(room_name, key)
+
+
+def room_members(room_name, after=None, limit=DEFAULT_MEMBERS_PAGE_SIZE):
+    """
+    聊天室的在線成員數與一頁成員名稱；停用時返回 None。
+    """
+    tracker = get_presence()
+    if tracker is None:
+        return None
+    return tracker.members(room_name, after=after, limit=limit)
+
+
+def room_member_counts(room_names):
+    """
+    多個聊天室的在線人數 {聊天室: 人數}；停用或讀取失敗時返回空字典 (視為 0 人)。
+    """
+    tracker = get_presence()
+    if tracker is None or not room_names:
+        return {}
+    try:
+        return tracker.counts(room_names)
+    except Exception as e:
+        metrics.errors_total.inc('presence')
+        logger.error(f"讀取在線人數時發生錯誤: {e}")
+        return {}
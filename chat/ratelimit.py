@@ -0,0 +1,256 @@
+import logging # 導入 logging 模組
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics # Prometheus 指標
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    令牌桶：每秒補充 rate 個令牌，最多累積 burst 個；每條消息消耗一個令牌。
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        # now 可能在建立令牌桶之前取得，時間差為負時不扣令牌
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """
+        返回還需等待的秒數，0 表示目前有可用令牌。
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class LocalRateLimiter:
+    """
+    進程內的多鍵令牌桶，用於每個用戶、每個聊天室的限制。WebSocket 路徑使用，檢查不經過網路。
+
+    多個限制 (例如用戶與聊天室) 必須全部有令牌才會放行，且只在放行時一起扣除，
+    被拒絕的請求不會消耗其他限制的額度。最多保留 max_keys 個桶，以 LRU 淘汰。
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock() # 同步視圖在執行緒池中並行呼叫
+
+    def hit(self, limits):
+        """
+        limits 為 [(scope, key, rate, burst), ...]。返回 (是否允許, 建議等待秒數, 拒絕的 scope)。
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for scope, key, rate, burst in limits:
+                bucket = self._buckets.get(key)
+                if bucket is None or bucket.rate != rate or bucket.burst != burst:
+                    bucket = self._buckets[key] = TokenBucket(rate, burst)
+                    if len(self._buckets) > self.max_keys:
+                        self._buckets.popitem(last=False)
+                else:
+                    self._buckets.move_to_end(key)
+                wait = bucket.wait_time(now)
+                if wait:
+                    return False, wait, scope
+                buckets.append(bucket)
+            for bucket in buckets:
+                bucket.consume()
+        return True, 0.0, None
+
+
+class RedisRateLimiter:
+    """
+    以 Redis 共用的多鍵令牌桶，讓 HTTP API 的限制在多個 worker 之間一致。
+
+    檢查與扣除在同一個 Lua 腳本內完成，時間取自 Redis 伺服器，不受各 worker 時鐘差異影響。
+    Redis 不可用時放行 (fail-open)，避免限流故障連帶讓 API 無法使用。
+    """
+
+    key_prefix = 'chat:ratelimit:'
+
+    # KEYS: 各個桶；ARGV: 每個桶依序一組 (rate, burst)
+    # 返回 {拒絕的桶序號 (0 表示允許), 建議等待秒數}
+    script = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local current = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    current = math.min(burst, current + math.max(0, now - updated) * rate)
+    if current < 1 then
+        return {i, tostring((1 - current) / rate)}
+    end
+    tokens[i] = current
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return {0, '0'}
+"""
+
+    def __init__(self, url):
+        import redis # channels_redis 的依賴，已隨 requirements.txt 安裝
+        # 限流位於請求路徑上，Redis 無回應時應儘快放棄
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self._script = self._client.register_script(self.script)
+
+    def hit(self, limits):
+        """
+        與 LocalRateLimiter.hit 相同的介面。
+        """
+        keys = [f'{self.key_prefix}{key}' for _, key, _, _ in limits]
+        args = []
+        for _, _, rate, burst in limits:
+            args.extend((rate, burst))
+        try:
+            rejected, wait = self._script(keys=keys, args=args)
+        except Exception as e:
+            metrics.errors_total.inc('rate_limit_backend')
+            logger.error(f"Redis 速率限制檢查失敗，暫時放行: {e}")
+            return True, 0.0, None
+        if rejected:
+            return False, float(wait), limits[rejected - 1][0]
+        return True, 0.0, None
+
+
+def _limit(scope, key, setting_prefix):
+    rate = getattr(settings, f'{setting_prefix}_RATE')
+    if rate <= 0:
+        return None
+    return scope, key, rate, max(1, getattr(settings, f'{setting_prefix}_BURST'))
+
+
+def message_limits(user, client_address, room_name):
+    """
+    發送一條消息需要通過的用戶 / 聊天室限制；費率為 0 的項目停用。
+    """
+    # 未登入用戶以來源 IP 代替
+    sender_key = f'user:{user.id}' if user.is_authenticated else f'ip:{client_address}'
+    limits = [
+        _limit('user', sender_key, 'CHAT_RATE_LIMIT_USER'),
+        _limit('room', f'room:{room_name}', 'CHAT_RATE_LIMIT_ROOM'),
+    ]
+    return [limit for limit in limits if limit is not None]
+
+
+def connection_bucket():
+    """
+    為一個 WebSocket 連線建立自己的令牌桶；未啟用時返回 None。
+    """
+    if not settings.CHAT_RATE_LIMIT_ENABLED or settings.CHAT_RATE_LIMIT_CONNECTION_RATE <= 0:
+        return None
+    return TokenBucket(settings.CHAT_RATE_LIMIT_CONNECTION_RATE, max(1, settings.CHAT_RATE_LIMIT_CONNECTION_BURST))
+
+
+def ephemeral_bucket():
+    """
+    每個 WebSocket 連線的輸入中提示 / 已讀回執限制，與消息發送分開計算；未啟用時返回 None。
+    """
+    if not settings.CHAT_RATE_LIMIT_ENABLED or settings.CHAT_RATE_LIMIT_EPHEMERAL_RATE <= 0:
+        return None
+    return TokenBucket(settings.CHAT_RATE_LIMIT_EPHEMERAL_RATE, max(1, settings.CHAT_RATE_LIMIT_EPHEMERAL_BURST))
+
+
+def check_ephemeral_rate(bucket):
+    """
+    短暫事件的檢查：超過限制的事件直接丟棄，不回覆錯誤。
+    """
+    if bucket is None:
+        return True
+    if bucket.wait_time(time.monotonic()):
+        metrics.rate_limited_total.inc('websocket', 'ephemeral')
+        return False
+    bucket.consume()
+    return True
+
+
+_local_limiter = LocalRateLimiter()
+_api_limiter = None
+_api_limiter_lock = threading.Lock()
+
+
+def get_api_rate_limiter():
+    """
+    HTTP API 使用的限制器：CHAT_RATE_LIMIT_BACKEND 為 'redis' 時在 worker 之間共用。
+    """
+    global _api_limiter
+    if settings.CHAT_RATE_LIMIT_BACKEND != 'redis':
+        return _local_limiter
+    if _api_limiter is None:
+        with _api_limiter_lock:
+            if _api_limiter is None:
+                _api_limiter = RedisRateLimiter(settings.CHAT_RATE_LIMIT_REDIS_URL)
+    return _api_limiter
+
+
+def check_message_rate(bucket, user, client_address, room_name):
+    """
+    WebSocket 發送消息前的檢查：連線自己的令牌桶，加上進程內的用戶 / 聊天室限制。
+    只讀寫記憶體，不接觸資料庫。返回 (是否允許, 建議等待秒數)。
+    """
+    if not settings.CHAT_RATE_LIMIT_ENABLED:
+        return True, 0.0
+    if bucket is not None:
+        wait = bucket.wait_time(time.monotonic())
+        if wait:
+            metrics.rate_limited_total.inc('websocket', 'connection')
+            return False, wait
+    allowed, wait, scope = _local_limiter.hit(message_limits(user, client_address, room_name))
+    if not allowed:
+        metrics.rate_limited_total.inc('websocket', scope)
+        return False, wait
+    if bucket is not None:
+        bucket.consume()
+    return True, 0.0
+
+
+class MessageRateThrottle(BaseThrottle):
+    """
+    DRF 限流類別：SendMessageAPI 依用戶與聊天室的令牌桶限制發送頻率，超過時返回 429。
+    """
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if not settings.CHAT_RATE_LIMIT_ENABLED:
+            return True
+        limits = message_limits(request.user, self.get_ident(request), view.kwargs.get('room_name'))
+        if not limits:
+            return True
+        allowed, wait, scope = get_api_rate_limiter().hit(limits)
+        if not allowed:
+            metrics.rate_limited_total.inc('api', scope)
+            self.retry_after = wait
+        return allowed
+
+    def wait(self):
+        return self.retry_after
@@ -0,0 +1,178 @@
+import atexit
+import logging # 導入 logging 模組
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone # 導入時區感知時間
+
+from . import metrics # Prometheus 指標
+from .models import ChatMessage, ReadCursor, Room
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+MAX_UNREAD_ROOMS = 200 # 未讀數 API 最多返回的聊天室數
+UPSERT_BATCH_SIZE = 500
+
+
+class ReadCursorBuffer:
+    """
+    已讀游標的進程內累加器。
+
+    已讀回執只在記憶體中保留每個 (用戶, 聊天室) 的最大 last_read_id，背景執行緒每 flush_interval 秒
+    以一條 INSERT ... ON CONFLICT DO UPDATE 批次寫入；游標只會前進，亂序到達的舊回執不會覆蓋新值。
+
+    寫入時同時記下讀到該位置時聊天室累計的消息數 (read_message_count)，以 Room 表的
+    (message_count, last_message_id) 為基準，只需計算兩者之間相差的少數消息；
+    客戶端通常回報最新一條消息，此時不需要任何查詢。
+    """
+
+    def __init__(self, flush_interval=2.0, max_gap=1000):
+        self.flush_interval = flush_interval
+        self.max_gap = max_gap # 計算相差消息數的上限，超過時未讀數最多只精確到此值
+        self._cursors = {} # (user_id, room_name) -> last_read_id
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, user_id, room_name, last_read_id):
+        key = (user_id, room_name)
+        with self._lock:
+            if last_read_id > self._cursors.get(key, 0):
+                self._cursors[key] = last_read_id
+        self._ensure_started()
+
+    def flush(self):
+        """
+        將累積的游標寫入資料庫 (同步執行)。寫入失敗的游標併回緩衝區，下次再試。
+        """
+        with self._lock:
+            cursors, self._cursors = self._cursors, {}
+        items = list(cursors.items())
+        for start in range(0, len(items), UPSERT_BATCH_SIZE):
+            batch = items[start:start + UPSERT_BATCH_SIZE]
+            try:
+                self._apply(batch)
+            except Exception as e:
+                metrics.errors_total.inc('read_cursors')
+                logger.error(f"寫入 {len(batch)} 個已讀游標時發生錯誤: {e}")
+                with self._lock:
+                    for key, last_read_id in batch:
+                        if last_read_id > self._cursors.get(key, 0):
+                            self._cursors[key] = last_read_id
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval * 4 + 5)
+        self.flush()
+
+    def _read_message_count(self, room, last_read_id):
+        """
+        聊天室中 id 不大於 last_read_id 的消息數，以 Room 的統計為基準修正。
+        """
+        if room is None:
+            return 0
+        if room.last_message_id is None or room.last_message_id == last_read_id:
+            return room.message_count
+        messages = ChatMessage.objects.filter(room_name=room.name)
+        if last_read_id < room.last_message_id:
+            # 統計中包含尚未讀到的消息
+            gap = messages.filter(id__gt=last_read_id, id__lte=room.last_message_id).values('id')[:self.max_gap].count()
+            return max(0, room.message_count - gap)
+        # 讀到的消息比統計更新 (統計每秒批次寫入一次)
+        gap = messages.filter(id__gt=room.last_message_id, id__lte=last_read_id).values('id')[:self.max_gap].count()
+        return room.message_count + gap
+
+    def _apply(self, batch):
+        rooms = Room.objects.in_bulk({room_name for (_, room_name), _ in batch}, field_name='name')
+        now = timezone.now()
+        rows = [
+            (user_id, room_name, last_read_id, self._read_message_count(rooms.get(room_name), last_read_id), now)
+            for (user_id, room_name), last_read_id in batch
+        ]
+        table = ReadCursor._meta.db_table
+        connection = connections['default']
+        # SQLite (3.24+) 與 PostgreSQL 都支援 ON CONFLICT ... DO UPDATE ... WHERE
+        sql = (
+            f'INSERT INTO {table} (user_id, room_name, last_read_id, read_message_count, updated_at) '
+            f'VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))} '
+            f'ON CONFLICT (user_id, room_name) DO UPDATE SET last_read_id = excluded.last_read_id, '
+            f'read_message_count = excluded.read_message_count, updated_at = excluded.updated_at '
+            f'WHERE excluded.last_read_id > {table}.last_read_id'
+        )
+        params = []
+        for user_id, room_name, last_read_id, read_count, updated_at in rows:
+            params.extend([user_id, room_name, last_read_id, read_count, connection.ops.adapt_datetimefield_value(updated_at)])
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='chat-read-cursors', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            finally:
+                # 背景執行緒持有自己的資料庫連線，定期清理過期連線
+                close_old_connections()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_read_cursor_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = ReadCursorBuffer(
+                    flush_interval=settings.CHAT_READ_CURSOR_FLUSH_INTERVAL,
+                    max_gap=settings.CHAT_UNREAD_MAX_GAP,
+                )
+    return _buffer
+
+
+def record_read(user_id, room_name, last_read_id):
+    """
+    記下用戶在聊天室讀到的最後一條消息，只更新記憶體。
+    """
+    get_read_cursor_buffer().record(user_id, room_name, last_read_id)
+
+
+def fetch_unread_counts(user):
+    """
+    用戶有已讀游標的聊天室及其未讀數 (最近有消息的在前)。只讀取 ReadCursor 與 Room 表。
+    """
+    cursors = list(ReadCursor.objects.filter(user=user).order_by('-updated_at')[:MAX_UNREAD_ROOMS])
+    rooms = Room.objects.in_bulk([cursor.room_name for cursor in cursors], field_name='name')
+    results = []
+    for cursor in cursors:
+        room = rooms.get(cursor.room_name)
+        message_count = room.message_count if room is not None else cursor.read_message_count
+        results.append({
+            'room': cursor.room_name,
+            'unread': max(0, message_count - cursor.read_message_count),
+            'last_read_id': cursor.last_read_id,
+            'last_message_id': room.last_message_id if room is not None else None,
+            'last_message_at': room.last_message_at.isoformat() if room is not None and room.last_message_at else None,
+        })
+    results.sort(key=lambda item: item['last_message_at'] or '', reverse=True)
+    return {'rooms': results}
+
+
+@metrics.register_collector
+def _collect_metrics():
+    if _buffer is None:
+        return []
+    return [('chat_read_cursors_pending', 'gauge', '等待寫入的已讀游標數', [({}, len(_buffer._cursors))])]
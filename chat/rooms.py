@@ -0,0 +1,210 @@
+import atexit
+import logging # 導入 logging 模組
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import Case, F, Q, Value, When
+
+from . import metrics # Prometheus 指標
+from .history import decode_cursor, encode_cursor
+from .models import Room
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 200 # 與 Room.last_message_preview 欄位長度一致
+DEFAULT_ROOMS_PAGE_SIZE = 20
+MAX_ROOMS_PAGE_SIZE = 100
+
+
+class _RoomDelta:
+    __slots__ = ('messages', 'last_at', 'last_id', 'last_user', 'last_preview')
+
+    def __init__(self):
+        self.messages = 0
+        self.last_at = None
+        self.last_id = None
+        self.last_user = ''
+        self.last_preview = ''
+
+
+class RoomStatsBuffer:
+    """
+    聊天室統計的進程內累加器。
+
+    寫入路徑只更新記憶體中的增量，背景執行緒每 flush_interval 秒
+    把每個有變化的聊天室合併成一條 UPDATE (message_count = message_count + n ...)，
+    資料庫負擔與聊天室數成正比，而不是與消息數成正比。
+    """
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self._deltas = {} # room_name -> _RoomDelta
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record_message(self, room_name, message_id, username, content, timestamp):
+        with self._lock:
+            delta = self._deltas.get(room_name)
+            if delta is None:
+                delta = self._deltas[room_name] = _RoomDelta()
+            delta.messages += 1
+            if delta.last_at is None or timestamp >= delta.last_at:
+                delta.last_at = timestamp
+                delta.last_id = message_id
+                delta.last_user = username
+                delta.last_preview = content[:PREVIEW_LENGTH]
+        self._ensure_started()
+
+    def flush(self):
+        """
+        將累積的增量寫入資料庫 (同步執行)。寫入失敗的增量併回緩衝區，下次再試。
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        for room_name, delta in deltas.items():
+            if delta.messages == 0:
+                continue
+            try:
+                self._apply(room_name, delta)
+            except Exception as e:
+                metrics.errors_total.inc('room_stats')
+                logger.error(f"更新聊天室 '{room_name}' 的統計時發生錯誤: {e}")
+                self._merge_back(room_name, delta)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval * 4 + 5)
+        self.flush()
+
+    def _apply(self, room_name, delta):
+        updates = {
+            'message_count': F('message_count') + delta.messages,
+        }
+        if delta.last_at is not None:
+            # 多個 worker 的批次可能亂序到達，只在本批較新時覆蓋最後消息
+            newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=delta.last_at)
+            for field, value in (
+                ('last_message_at', delta.last_at),
+                ('last_message_id', delta.last_id),
+                ('last_message_user', delta.last_user),
+                ('last_message_preview', delta.last_preview),
+            ):
+                updates[field] = Case(
+                    When(newer, then=Value(value)), default=F(field), output_field=Room._meta.get_field(field))
+        if Room.objects.filter(name=room_name).update(**updates):
+            return
+        try:
+            Room.objects.create(
+                name=room_name,
+                message_count=delta.messages,
+                last_message_at=delta.last_at,
+                last_message_id=delta.last_id,
+                last_message_user=delta.last_user,
+                last_message_preview=delta.last_preview,
+            )
+        except IntegrityError:
+            # 另一個 worker 同時建立了這個聊天室，改回累加
+            Room.objects.filter(name=room_name).update(**updates)
+
+    def _merge_back(self, room_name, failed):
+        with self._lock:
+            delta = self._deltas.get(room_name)
+            if delta is None:
+                self._deltas[room_name] = failed
+                return
+            delta.messages += failed.messages
+            if failed.last_at is not None and (delta.last_at is None or failed.last_at > delta.last_at):
+                delta.last_at = failed.last_at
+                delta.last_id = failed.last_id
+                delta.last_user = failed.last_user
+                delta.last_preview = failed.last_preview
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='chat-room-stats', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            finally:
+                # 背景執行緒持有自己的資料庫連線，定期清理過期連線
+                close_old_connections()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_room_stats_buffer():
+    """
+    取得本進程共用的聊天室統計累加器；CHAT_ROOM_STATS_ENABLED 為 False 時返回 None。
+    """
+    global _buffer
+    if not settings.CHAT_ROOM_STATS_ENABLED:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = RoomStatsBuffer(flush_interval=settings.CHAT_ROOM_STATS_FLUSH_INTERVAL)
+    return _buffer
+
+
+def record_message(room_name, message_id, username, content, timestamp):
+    """
+    在寫入路徑上累加聊天室的消息數與最後消息，只更新記憶體。
+    """
+    buffer = get_room_stats_buffer()
+    if buffer is not None:
+        buffer.record_message(room_name, message_id, username, content, timestamp)
+
+
+def serialize_room(room):
+    return {
+        'name': room.name,
+        'message_count': room.message_count,
+        'last_message_at': room.last_message_at.isoformat(),
+        'last_message': {
+            'id': room.last_message_id,
+            'user': room.last_message_user,
+            'preview': room.last_message_preview,
+        },
+    }
+
+
+def fetch_active_rooms(before=None, limit=DEFAULT_ROOMS_PAGE_SIZE):
+    """
+    依最後消息時間由新到舊列出聊天室，以 (last_message_at, id) 鍵集分頁，只讀取 Room 表。
+    before 為上一頁返回的 next 游標；格式無效時拋出 ValueError。
+    """
+    limit = max(1, min(limit, MAX_ROOMS_PAGE_SIZE))
+    queryset = Room.objects.filter(last_message_at__isnull=False)
+    if before is not None:
+        timestamp, room_id = decode_cursor(before)
+        queryset = queryset.filter(last_message_at__lte=timestamp).filter(
+            Q(last_message_at__lt=timestamp) | Q(last_message_at=timestamp, id__lt=room_id)
+        )
+    rooms = list(queryset.order_by('-last_message_at', '-id')[:limit + 1])
+    has_more = len(rooms) > limit
+    rooms = rooms[:limit]
+    return {
+        'rooms': [serialize_room(room) for room in rooms],
+        'next': encode_cursor(rooms[-1].last_message_at, rooms[-1].id) if has_more else None,
+    }
+
+
+@metrics.register_collector
+def _collect_metrics():
+    if _buffer is None:
+        return []
+    return [('chat_room_stats_pending_rooms', 'gauge', '等待寫入統計的聊天室數', [({}, len(_buffer._deltas))])]
@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import logging # 導入 logging 模組
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+from . import metrics # Prometheus 指標
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+# 目前區塊選定的唯讀副本別名；None 表示讀取主庫
+_replica_alias = ContextVar('chat_replica_alias', default=None)
+
+
+class ReplicaRouter:
+    """
+    讀寫分離的資料庫路由。
+
+    寫入一律走 default (主庫)。讀取預設也走主庫，只有在 replica_reads() 區塊內
+    (歷史分頁、搜尋、聊天室列表) 才改走 CHAT_DB_REPLICAS 中的唯讀副本，
+    去重、補發與寫入路徑上的讀取不受副本延遲影響。
+    """
+
+    def db_for_read(self, model, **hints):
+        return _replica_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 副本與主庫是同一份資料
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+def sticky_key(user, client_address):
+    """
+    讀己之寫 (read-your-writes) 的識別：登入用戶以 id，未登入用戶以 IP，與速率限制相同。
+    """
+    return f'user:{user.id}' if user.is_authenticated else f'ip:{client_address}'
+
+
+class StickyWrites:
+    """
+    記錄最近發送過消息的用戶。sticky_seconds 秒內這些用戶的讀取仍走主庫，
+    即使副本尚未追上，自己剛發送的消息也一定看得到。
+    """
+
+    def __init__(self, sticky_seconds=5.0):
+        self.sticky_seconds = sticky_seconds
+
+    def mark(self, key):
+        raise NotImplementedError
+
+    def is_sticky(self, key):
+        raise NotImplementedError
+
+    async def amark(self, key):
+        self.mark(key)
+
+
+class LocalStickyWrites(StickyWrites):
+    """
+    進程內記錄，只對送到同一個 worker 的讀取有效。
+    """
+
+    def __init__(self, sticky_seconds=5.0, max_keys=100000):
+        super().__init__(sticky_seconds=sticky_seconds)
+        self.max_keys = max_keys
+        self._deadlines = {} # 鍵 -> 到期時間
+        self._lock = threading.Lock()
+
+    def mark(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._deadlines) >= self.max_keys:
+                self._deadlines = {k: d for k, d in self._deadlines.items() if d > now}
+            self._deadlines[key] = now + self.sticky_seconds
+
+    def is_sticky(self, key):
+        deadline = self._deadlines.get(key)
+        return deadline is not None and deadline > time.monotonic()
+
+
+class RedisStickyWrites(StickyWrites):
+    """
+    以 Redis 共用的記錄 (SET PX)，發送與讀取落在不同 worker 時也有效。
+    """
+
+    key_prefix = 'chat:sticky:'
+
+    def __init__(self, url, sticky_seconds=5.0):
+        super().__init__(sticky_seconds=sticky_seconds)
+        import redis # channels_redis 的依賴，已隨 requirements.txt 安裝
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self._url = url
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self):
+        from redis import asyncio as aioredis
+        # redis.asyncio 連線綁定事件循環，每個事件循環各自建立客戶端
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = aioredis.Redis.from_url(
+                self._url, socket_connect_timeout=1, socket_timeout=1)
+        return client
+
+    def mark(self, key):
+        self._client.set(self.key_prefix + key, 1, px=int(self.sticky_seconds * 1000))
+
+    async def amark(self, key):
+        await self._async_client().set(self.key_prefix + key, 1, px=int(self.sticky_seconds * 1000))
+
+    def is_sticky(self, key):
+        return bool(self._client.exists(self.key_prefix + key))
+
+
+_sticky = None
+_sticky_lock = threading.Lock()
+
+
+def get_sticky_writes():
+    """
+    取得本進程共用的讀己之寫記錄；沒有設定副本或 CHAT_DB_STICKY_SECONDS 為 0 時返回 None。
+    """
+    global _sticky
+    if not settings.CHAT_DB_REPLICAS or settings.CHAT_DB_STICKY_SECONDS <= 0:
+        return None
+    if _sticky is None:
+        with _sticky_lock:
+            if _sticky is None:
+                if settings.CHAT_DB_STICKY_BACKEND == 'redis':
+                    _sticky = RedisStickyWrites(settings.CHAT_DB_STICKY_REDIS_URL, settings.CHAT_DB_STICKY_SECONDS)
+                else:
+                    _sticky = LocalStickyWrites(settings.CHAT_DB_STICKY_SECONDS)
+    return _sticky
+
+
+def _sticky_error(e):
+    metrics.errors_total.inc('db_sticky')
+    logger.error(f"讀己之寫記錄發生錯誤: {e}")
+
+
+def mark_written(key):
+    """
+    用戶發送消息後呼叫，之後 CHAT_DB_STICKY_SECONDS 秒內該用戶的讀取走主庫。
+    """
+    sticky = get_sticky_writes()
+    if sticky is None:
+        return
+    try:
+        sticky.mark(key)
+    except Exception as e:
+        _sticky_error(e)
+
+
+async def amark_written(key):
+    sticky = get_sticky_writes()
+    if sticky is None:
+        return
+    try:
+        await sticky.amark(key)
+    except Exception as e:
+        _sticky_error(e)
+
+
+def _is_sticky(key):
+    sticky = get_sticky_writes()
+    if sticky is None or key is None:
+        return False
+    try:
+        return sticky.is_sticky(key)
+    except Exception as e:
+        # 無法確認時保守地讀主庫
+        _sticky_error(e)
+        return True
+
+
+@contextmanager
+def replica_reads(key=None):
+    """
+    區塊內的 ORM 讀取改走隨機選定的一個唯讀副本 (同一區塊內的查詢使用同一個副本)。
+    沒有設定副本，或 key 代表的用戶最近發送過消息時，仍讀取主庫。
+    """
+    replicas = settings.CHAT_DB_REPLICAS
+    if not replicas or _is_sticky(key):
+        yield
+        return
+    token = _replica_alias.set(random.choice(replicas))
+    try:
+        yield
+    finally:
+        _replica_alias.reset(token)
+
+
+def on_replica(func, key=None):
+    """
+    將同步函數包裝為在 replica_reads(key) 內執行，供 db_sync_to_async 在執行緒池中使用。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with replica_reads(key):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def reading_from_replica():
+    return _replica_alias.get() is not None
@@ -6,6 +6,9 @@ websocket_urlpatterns = [
     # 範例：處理基於房間名的聊天 WebSocket 連線
     # URL 格式：ws://your-domain.com/ws/chat/your_room_name/
     re_path(r'ws/chat/(?P<room_name>\w+)/$', consumers.ChatConsumer.as_asgi()),
+
+    # 多工連線：一個 WebSocket 以控制消息訂閱多個聊天室與個人通知
+    re_path(r'ws/multiplex/$', consumers.MultiplexConsumer.as_asgi()),
     
     # 範例：處理通用通知 WebSocket 連線（通常與用戶 ID 綁定）
     # re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),
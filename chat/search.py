@@ -0,0 +1,190 @@
+import base64
+import binascii
+import logging # 導入 logging 模組
+
+from django.contrib.auth.models import User
+from django.db import connections, router
+
+from .history import HISTORY_FIELDS, serialize_message
+from .models import ChatMessage
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEARCH_PAGE_SIZE = 20 # 每頁預設結果數
+MAX_SEARCH_PAGE_SIZE = 100 # 每頁最大結果數
+MAX_QUERY_LENGTH = 200
+MIN_TERM_LENGTH = 3 # SQLite trigram 分詞器無法匹配少於三個字元的詞
+SHORT_TERM_SCAN_ROWS = 100000 # 只有短詞時以 LIKE 掃描的最近消息數上限
+
+ORDER_RANK = 'rank' # 依相關度排列，需要為所有符合的消息計算分數
+ORDER_RECENT = 'recent' # 依消息 id 由新到舊，讀到一頁即停止，常見詞也很快
+
+# 索引由遷移 0007_message_search 建立；相關度越高 score 越大
+_BACKENDS = {
+    'sqlite': {
+        'matches': (
+            'SELECT m.id AS id, {score} AS score FROM chat_message_fts '
+            'JOIN chat_chatmessage m ON m.id = chat_message_fts.rowid WHERE chat_message_fts MATCH %s'
+        ),
+        'score': '-bm25(chat_message_fts)',
+        # FTS5 可依 rowid 倒序讀取倒排索引，搭配 LIMIT 不需要排序全部結果
+        'recent_order': 'chat_message_fts.rowid',
+    },
+    'postgresql': {
+        'matches': (
+            "SELECT m.id AS id, {score} AS score FROM chat_chatmessage m, websearch_to_tsquery('simple', %s) AS q(query) "
+            "WHERE to_tsvector('simple', m.content) @@ q.query"
+        ),
+        'score': "ts_rank(to_tsvector('simple', m.content), q.query)",
+        'recent_order': 'm.id',
+    },
+}
+
+# 只有短詞 (例如兩個字的中文詞) 時無法使用 trigram 索引：以主鍵範圍限制在最近 SHORT_TERM_SCAN_ROWS 條消息內比對
+_SHORT_TERM_MATCHES = (
+    'SELECT m.id AS id, {score} AS score FROM chat_chatmessage m '
+    'WHERE m.id > (SELECT COALESCE(MAX(id), 0) FROM chat_chatmessage) - %s'
+)
+
+
+class SearchNotSupported(Exception):
+    """
+    目前的資料庫後端沒有全文索引 (只支援 SQLite 與 PostgreSQL)。
+    """
+
+
+def encode_search_cursor(score, message_id):
+    """
+    將 (score, id) 編碼為不透明的分頁游標；repr 保證浮點數往返後完全相等。
+    """
+    raw = f'{score!r}|{message_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_search_cursor(cursor):
+    """
+    解碼搜尋游標，返回 (score, id)。格式無效時拋出 ValueError。
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        score_str, id_str = raw.rsplit('|', 1)
+        return float(score_str), int(id_str)
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise ValueError(f'無效的搜尋游標: {cursor}') from e
+
+
+def _fts5_query(terms):
+    """
+    把搜尋詞轉為 FTS5 查詢：每個詞加上引號作為片語，詞之間為 AND，
+    避免用戶輸入被解讀為 FTS5 語法 (NEAR、*、欄位名稱等)。
+    """
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _like_pattern(term):
+    """
+    子字串比對的 LIKE 模式，跳脫 LIKE 的萬用字元。
+    """
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def search_messages(query, room_name=None, username=None, since=None, until=None, cursor=None,
+                    limit=DEFAULT_SEARCH_PAGE_SIZE, order=ORDER_RANK):
+    """
+    以全文索引搜尋消息，以鍵集分頁：order='rank' 依相關度 (score, id) 由高到低，
+    order='recent' 依 id 由新到舊 (score 為 None)。
+
+    SQLite 的 trigram 索引無法匹配少於 MIN_TERM_LENGTH 個字元的詞：這些詞改以 LIKE 在索引的結果中比對；
+    全部都是短詞時不使用索引，只在最近 SHORT_TERM_SCAN_ROWS 條消息中比對，並一律依 id 由新到舊排列。
+
+    room_name、username、since (含)、until (不含) 為可選的篩選條件；cursor 為上一頁返回的 next 游標。
+    參數無效時拋出 ValueError，資料庫沒有全文索引時拋出 SearchNotSupported。
+    """
+    query = (query or '').strip()
+    if not query:
+        raise ValueError('搜尋字詞不能為空')
+    if len(query) > MAX_QUERY_LENGTH:
+        raise ValueError(f'搜尋字詞不能超過 {MAX_QUERY_LENGTH} 個字元')
+    if order not in (ORDER_RANK, ORDER_RECENT):
+        raise ValueError(f'無效的排序方式: {order}')
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+
+    # 原始 SQL 不經過 ORM，依路由取得讀取用的連線 (可能是唯讀副本)
+    connection = connections[router.db_for_read(ChatMessage)]
+    vendor = connection.vendor
+    backend = _BACKENDS.get(vendor)
+    if backend is None:
+        raise SearchNotSupported(vendor)
+    terms = query.split()
+    short_terms = [term for term in terms if len(term) < MIN_TERM_LENGTH] if vendor == 'sqlite' else []
+    if short_terms:
+        terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+    if terms:
+        matches, recent_order = backend['matches'], backend['recent_order']
+        params = [_fts5_query(terms) if vendor == 'sqlite' else query]
+    else:
+        matches, recent_order = _SHORT_TERM_MATCHES, 'm.id'
+        params = [SHORT_TERM_SCAN_ROWS]
+        order = ORDER_RECENT # 沒有相關度可排序
+
+    filters = []
+    for term in short_terms:
+        filters.append("m.content LIKE %s ESCAPE '\\'")
+        params.append(_like_pattern(term))
+    if room_name is not None:
+        filters.append('m.room_name = %s')
+        params.append(room_name)
+    if username is not None:
+        sender_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+        if sender_id is None:
+            return {'results': [], 'next': None}
+        filters.append('m.sender_id = %s')
+        params.append(sender_id)
+    if since is not None:
+        filters.append('m.timestamp >= %s')
+        params.append(connection.ops.adapt_datetimefield_value(since))
+    if until is not None:
+        filters.append('m.timestamp < %s')
+        params.append(connection.ops.adapt_datetimefield_value(until))
+
+    if order == ORDER_RECENT:
+        if cursor is not None:
+            filters.append('m.id < %s')
+            params.append(decode_search_cursor(cursor)[1])
+        sql = (matches.format(score='NULL') + ''.join(f' AND {f}' for f in filters)
+               + f" ORDER BY {recent_order} DESC LIMIT %s")
+    else:
+        keyset = ''
+        if cursor is not None:
+            score, message_id = decode_search_cursor(cursor)
+            keyset = ' WHERE score < %s OR (score = %s AND id < %s)'
+            params.extend([score, score, message_id])
+        sql = (f"SELECT id, score FROM ({matches.format(score=backend['score'])}"
+               f"{''.join(f' AND {f}' for f in filters)}) AS ranked{keyset} ORDER BY score DESC, id DESC LIMIT %s")
+    params.append(limit + 1)
+
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql, params)
+        hits = db_cursor.fetchall()
+
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    # 只為本頁的結果讀取消息內容，沿用歷史消息的序列化格式
+    rows = {
+        row['id']: row
+        for row in ChatMessage.objects.using(connection.alias).filter(id__in=[message_id for message_id, _ in hits])
+        .values('room_name', *HISTORY_FIELDS)
+    }
+    results = []
+    for message_id, score in hits:
+        row = rows.get(message_id)
+        if row is None:
+            continue # 查詢之間被歸檔或刪除
+        results.append(dict(serialize_message(row), room=row['room_name'], score=score))
+    return {
+        'results': results,
+        'next': encode_search_cursor(hits[-1][1] or 0.0, hits[-1][0]) if has_more else None,
+    }
@@ -0,0 +1,1313 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import zlib
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import skipUnless
+
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from chat import cache, db, dedup, drain, ephemeral, history, metrics, outbound, pages, persistence
+from chat import presence, ratelimit, receipts, rooms, routers, wire
+from chat.fanout import LocalFanout
+from chat.layers import HashRing, ShardedRedisChannelLayer
+from chat.messaging import room_group_name
+from chat.models import ArchiveSegment, ChatMessage, ReadCursor, Room
+from chat.routing import websocket_urlpatterns
+
+try:
+    import fakeredis
+except ImportError: # 可選的測試依賴 (fakeredis[lua])，未安裝時略過需要 Redis 的測試
+    fakeredis = None
+
+APPLICATION = URLRouter(websocket_urlpatterns)
+
+# 測試不依賴 Redis：頻道層使用記憶體實作，其餘後端使用進程內實作。
+# 背景執行緒的寫入間隔設得很長，由測試明確呼叫 flush()
+CHAT_TEST_SETTINGS = {
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'CHAT_RATE_LIMIT_ENABLED': False,
+    'CHAT_RATE_LIMIT_BACKEND': 'local',
+    'CHAT_RECENT_CACHE_BACKEND': 'local',
+    'CHAT_DEDUP_BACKEND': 'local',
+    'CHAT_PRESENCE_BACKEND': 'none',
+    'CHAT_DB_STICKY_BACKEND': 'local',
+    'CHAT_DB_REPLICAS': [],
+    'CHAT_WRITE_BEHIND': False,
+    'CHAT_LOCAL_FANOUT_THRESHOLD': 0,
+    'CHAT_ROOM_STATS_FLUSH_INTERVAL': 3600,
+    'CHAT_READ_CURSOR_FLUSH_INTERVAL': 3600,
+    'CHAT_OUTBOUND_COALESCE_WINDOW_MS': 0,
+}
+
+
+def reset_chat_state():
+    """
+    重建各模組的進程內單例 (快取、緩衝區、背景任務)，避免狀態跨測試殘留。
+    """
+    for module in (rooms, receipts, persistence):
+        if module._buffer is not None:
+            module._buffer.stop()
+            module._buffer = None
+    cache._cache = None
+    dedup._cache = None
+    pages._cache = None
+    presence._tracker = None
+    ephemeral._relay = None
+    routers._sticky = None
+    ratelimit._local_limiter = ratelimit.LocalRateLimiter()
+    drain._draining = False
+
+
+def counter_value(metric, *labelvalues):
+    return metric._values.get(tuple(zip(metric.labelnames, labelvalues)), 0)
+
+
+class ChatTestMixin:
+    def setUp(self):
+        super().setUp()
+        reset_chat_state()
+        self.addCleanup(reset_chat_state)
+
+    async def connect(self, path, user=None, subprotocols=None):
+        communicator = WebsocketCommunicator(APPLICATION, path, subprotocols=subprotocols)
+        communicator.scope['user'] = user or AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+
+@override_settings(**CHAT_TEST_SETTINGS)
+class ChatTestCase(ChatTestMixin, TestCase):
+    """
+    只在測試執行緒中讀寫資料庫的測試。
+    """
+
+
+@override_settings(**CHAT_TEST_SETTINGS)
+class ChatTransactionTestCase(ChatTestMixin, TransactionTestCase):
+    """
+    經過 WebSocket consumer 或資料庫執行緒池的測試：寫入來自其他執行緒，不能包在測試的交易中。
+    """
+
+
+@override_settings(**CHAT_TEST_SETTINGS)
+class ChatSimpleTestCase(ChatTestMixin, SimpleTestCase):
+    """
+    不需要資料庫的測試。
+    """
+
+
+def create_messages(room_name, count, start=None, **kwargs):
+    start = start or timezone.now() - timedelta(hours=1)
+    return [
+        ChatMessage.objects.create(room_name=room_name, content=f'm{i}', timestamp=start + timedelta(seconds=i), **kwargs)
+        for i in range(count)
+    ]
+
+
+class WriteBehindTests(ChatTransactionTestCase):
+    """
+    寫後批次持久化 (user-001)。
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spill_path = os.path.join(directory.name, 'spill.jsonl')
+
+    def make_buffer(self, **kwargs):
+        buffer = persistence.WriteBehindBuffer(flush_interval=3600, spill_path=self.spill_path, **kwargs)
+        self.addCleanup(buffer.stop)
+        return buffer
+
+    def write_spill(self, path, contents):
+        with open(path, 'w', encoding='utf-8') as f:
+            for content in contents:
+                f.write(json.dumps({'room_name': 'wb', 'sender_id': None, 'content': content,
+                                    'timestamp': timezone.now().isoformat(), 'client_msg_id': None}) + '\n')
+
+    def contents(self):
+        return sorted(ChatMessage.objects.filter(room_name='wb').values_list('content', flat=True))
+
+    def test_flush_writes_buffered_messages_with_original_timestamps(self):
+        buffer = self.make_buffer()
+        timestamp = timezone.now() - timedelta(minutes=5)
+        for i in range(3):
+            buffer.enqueue('wb', None, f'm{i}', timestamp)
+        self.assertEqual(ChatMessage.objects.filter(room_name='wb').count(), 0)
+        buffer.flush()
+        self.assertEqual(self.contents(), ['m0', 'm1', 'm2'])
+        self.assertEqual(set(ChatMessage.objects.filter(room_name='wb').values_list('timestamp', flat=True)), {timestamp})
+
+    def test_overflow_spills_oldest_messages_and_replays_them(self):
+        buffer = self.make_buffer(max_queue=2)
+        for i in range(4):
+            buffer.enqueue('wb', None, f'm{i}', timezone.now())
+        buffer._spill_executor.shutdown(wait=True)
+        with open(self.spill_path, encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['content'] for line in f], ['m0', 'm1'])
+        buffer.flush()
+        self.assertEqual(self.contents(), ['m2', 'm3'])
+        buffer._replay_spill()
+        self.assertEqual(self.contents(), ['m0', 'm1', 'm2', 'm3'])
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_stale_replay_file_is_replayed_before_new_spill(self):
+        buffer = self.make_buffer()
+        self.write_spill(f'{self.spill_path}.replay', ['stale'])
+        self.write_spill(self.spill_path, ['new'])
+        buffer._replay_spill()
+        self.assertEqual(self.contents(), ['stale'])
+        self.assertTrue(os.path.exists(self.spill_path))
+        buffer._replay_spill()
+        self.assertEqual(self.contents(), ['new', 'stale'])
+
+    def test_replay_file_is_kept_until_written(self):
+        buffer = self.make_buffer()
+        self.write_spill(self.spill_path, ['kept'])
+        original = buffer._write_batch
+
+        def interrupted(batch):
+            raise KeyboardInterrupt # 模擬補寫途中進程結束
+
+        buffer._write_batch = interrupted
+        with self.assertRaises(KeyboardInterrupt):
+            buffer._replay_spill()
+        self.assertTrue(os.path.exists(f'{self.spill_path}.replay'))
+        buffer._write_batch = original
+        buffer._replay_spill()
+        self.assertEqual(self.contents(), ['kept'])
+        self.assertFalse(os.path.exists(f'{self.spill_path}.replay'))
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=3600)
+    async def test_consumer_broadcasts_before_write(self):
+        communicator = await self.connect('/ws/chat/wb/')
+        await communicator.send_json_to({'message': 'hello'})
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['id'], frame['message']), (None, 'hello'))
+        await communicator.disconnect()
+        self.assertEqual(await ChatMessage.objects.filter(room_name='wb').acount(), 0)
+        await sync_to_async(persistence.get_write_behind_buffer().flush)()
+        self.assertEqual(await ChatMessage.objects.filter(room_name='wb').acount(), 1)
+
+
+class HistoryPaginationTests(ChatTestCase):
+    """
+    鍵集分頁的歷史消息 (user-002)。
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.messages = create_messages('hist', 7)
+
+    def test_cursor_round_trip(self):
+        message = self.messages[3]
+        cursor = history.encode_cursor(message.timestamp, message.id)
+        self.assertEqual(history.decode_cursor(cursor), (message.timestamp, message.id))
+        with self.assertRaises(ValueError):
+            history.decode_cursor('not-a-cursor')
+
+    def test_pages_walk_backwards_and_forwards(self):
+        latest = history.fetch_page('hist', limit=3)
+        self.assertEqual([m['message'] for m in latest['messages']], ['m4', 'm5', 'm6'])
+        self.assertIsNone(latest['newer'])
+        older = history.fetch_page('hist', before=latest['older'], limit=3)
+        self.assertEqual([m['message'] for m in older['messages']], ['m1', 'm2', 'm3'])
+        oldest = history.fetch_page('hist', before=older['older'], limit=3)
+        self.assertEqual([m['message'] for m in oldest['messages']], ['m0'])
+        self.assertIsNone(oldest['older'])
+        newer = history.fetch_page('hist', after=older['newer'], limit=3)
+        self.assertEqual([m['message'] for m in newer['messages']], ['m4', 'm5', 'm6'])
+        self.assertIsNone(newer['newer'])
+
+    def test_query_uses_composite_index(self):
+        plan = ChatMessage.objects.filter(room_name='hist').order_by('-timestamp', '-id')[:3].explain()
+        self.assertIn('chat_room_ts_id_idx', plan)
+
+    def test_history_api(self):
+        response = self.client.get('/chat/api/history/hist/', {'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([m['message'] for m in page['messages']], ['m5', 'm6'])
+        response = self.client.get('/chat/api/history/hist/', {'limit': 2, 'before': page['older']})
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['m3', 'm4'])
+        self.assertEqual(self.client.get('/chat/api/history/hist/', {'before': 'zzz'}).status_code, 400)
+        both = {'before': page['older'], 'after': page['older']}
+        self.assertEqual(self.client.get('/chat/api/history/hist/', both).status_code, 400)
+
+
+class RecentMessageCacheTests(ChatTestCase):
+    """
+    每個聊天室的最近消息快取 (user-003)。
+    """
+
+    @staticmethod
+    def message(message_id):
+        return {'id': message_id, 'message': f'm{message_id}', 'user': 'u', 'timestamp': timezone.now().isoformat()}
+
+    def test_fill_append_and_size_bound(self):
+        recent = cache.LocalRecentMessageCache(size=3)
+        self.assertIsNone(recent.get('r'))
+        self.assertTrue(recent.fill('r', [self.message(1), self.message(2)], recent.fill_token('r')))
+        recent.append('r', self.message(3))
+        recent.append('r', self.message(4))
+        self.assertEqual([m['id'] for m in recent.get('r')], [2, 3, 4])
+        self.assertEqual(recent.stats(), {'hits': 1, 'misses': 1, 'rooms': 1})
+
+    def test_append_is_ignored_for_rooms_not_in_cache(self):
+        recent = cache.LocalRecentMessageCache()
+        recent.append('r', self.message(1))
+        self.assertIsNone(recent.get('r'))
+
+    def test_fill_is_rejected_after_concurrent_append(self):
+        recent = cache.LocalRecentMessageCache()
+        token = recent.fill_token('r')
+        recent.append('r', self.message(2))
+        self.assertFalse(recent.fill('r', [self.message(1)], token))
+        self.assertIsNone(recent.get('r'))
+
+    def test_fill_does_not_overwrite_existing_entry(self):
+        recent = cache.LocalRecentMessageCache()
+        self.assertTrue(recent.fill('r', [self.message(1)], recent.fill_token('r')))
+        self.assertFalse(recent.fill('r', [self.message(0)], recent.fill_token('r')))
+        self.assertEqual([m['id'] for m in recent.get('r')], [1])
+
+    def test_ttl_and_room_eviction(self):
+        expired = cache.LocalRecentMessageCache(ttl=-1)
+        expired.fill('r', [self.message(1)], expired.fill_token('r'))
+        self.assertIsNone(expired.get('r'))
+        recent = cache.LocalRecentMessageCache(max_rooms=2)
+        for room_name in ('a', 'b', 'c'):
+            recent.fill(room_name, [self.message(1)], recent.fill_token(room_name))
+        self.assertIsNone(recent.get('a'))
+        self.assertIsNotNone(recent.get('c'))
+
+    def test_latest_page_is_served_from_cache(self):
+        create_messages('cached', 5)
+        first = history.fetch_page('cached', limit=3)
+        with self.assertNumQueries(0):
+            second = history.fetch_page('cached', limit=3)
+        self.assertEqual(first, second)
+
+    def test_send_appends_to_cache(self):
+        user = User.objects.create_user('sender')
+        self.client.force_login(user)
+        create_messages('cached', 2)
+        history.fetch_page('cached')
+        self.client.post('/chat/api/send_message/cached/', {'message': 'fresh'}, content_type='application/json')
+        with self.assertNumQueries(0):
+            page = history.fetch_page('cached')
+        self.assertEqual([m['message'] for m in page['messages']], ['m0', 'm1', 'fresh'])
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=3600, CHAT_WRITE_BEHIND_SPILL_PATH='')
+    def test_no_fill_while_write_behind_has_pending_rows(self):
+        create_messages('cached', 2)
+        persistence.save_message('cached', None, 'pending', timezone.now())
+        history.fetch_page('cached')
+        self.assertIsNone(cache.get_recent_cache().get('cached'))
+        persistence.get_write_behind_buffer().flush()
+        history.fetch_page('cached')
+        self.assertEqual([m['message'] for m in cache.get_recent_cache().get('cached')], ['m0', 'm1', 'pending'])
+
+
+class SerializeOnceFanoutTests(ChatTransactionTestCase):
+    """
+    發送端只編碼一次的群發 (user-004)。
+    """
+
+    async def test_frame_is_forwarded_unchanged(self):
+        first = await self.connect('/ws/chat/fan/')
+        second = await self.connect('/ws/chat/fan/')
+        frame = wire.build_chat_frame('hello', 'u', '2026-01-01T00:00:00+00:00', 1)
+        await get_channel_layer().group_send(room_group_name('fan'), wire.chat_message_event(frame, 'fan'))
+        self.assertEqual(await first.receive_from(), frame)
+        self.assertEqual(await second.receive_from(), frame)
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_all_receivers_get_identical_frames(self):
+        sender = await self.connect('/ws/chat/fan/')
+        receiver = await self.connect('/ws/chat/fan/')
+        await sender.send_json_to({'message': 'hi'})
+        self.assertEqual(await sender.receive_from(), await receiver.receive_from())
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    async def test_legacy_event_format(self):
+        communicator = await self.connect('/ws/chat/fan/')
+        await get_channel_layer().group_send(room_group_name('fan'), {
+            'type': 'chat_message', 'message': 'old', 'user': 'u', 'timestamp': 't', 'id': 3,
+        })
+        self.assertEqual(await communicator.receive_json_from(), {'id': 3, 'message': 'old', 'user': 'u', 'timestamp': 't'})
+        await communicator.disconnect()
+
+
+class OutboundQueueTests(ChatSimpleTestCase):
+    """
+    每個連線的發送佇列與慢速客戶端策略 (user-005)。
+    """
+
+    def make_queue(self, send_error=None, **kwargs):
+        sent, closed = [], []
+
+        async def send(text_data=None, bytes_data=None):
+            if send_error is not None:
+                raise send_error
+            sent.append(text_data)
+
+        async def close(code=None):
+            closed.append(code)
+
+        queue = outbound.OutboundQueue(send, close, **kwargs)
+        queue.start()
+        return queue, sent, closed
+
+    async def test_frames_within_window_are_coalesced(self):
+        queue, sent, _ = self.make_queue(window=0.05)
+        for i in range(3):
+            queue.put(wire.dumps({'id': i}))
+        await asyncio.sleep(0.1)
+        await queue.stop()
+        self.assertEqual(sent, ['{"type":"batch","messages":[{"id":0},{"id":1},{"id":2}]}'])
+
+    async def test_drop_oldest_policy(self):
+        queue, sent, _ = self.make_queue(max_depth=2)
+        for i in range(4):
+            queue.put(str(i))
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        self.assertEqual(sent, ['2', '3'])
+
+    async def test_summary_policy(self):
+        queue, sent, _ = self.make_queue(max_depth=2, policy=outbound.POLICY_SUMMARY)
+        for i in range(3):
+            queue.put(str(i))
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        self.assertEqual(sent, ['{"type":"summary","skipped":2}', '2'])
+
+    async def test_disconnect_policy(self):
+        queue, sent, closed = self.make_queue(max_depth=1, policy=outbound.POLICY_DISCONNECT)
+        queue.put('0')
+        queue.put('1')
+        await asyncio.sleep(0.05)
+        self.assertEqual((sent, closed), ([], [4008]))
+
+    async def test_policy_applies_while_send_is_blocked(self):
+        released = asyncio.Event()
+        sent = []
+
+        async def send(text_data=None, bytes_data=None):
+            await released.wait() # 模擬客戶端讀取緩慢，send 尚未返回
+            sent.append(text_data)
+
+        async def close(code=None):
+            pass
+
+        queue = outbound.OutboundQueue(send, close, max_depth=2)
+        queue.start()
+        queue.put('0')
+        await asyncio.sleep(0.01)
+        for i in range(1, 5):
+            queue.put(str(i))
+        self.assertEqual(list(queue._frames), ['3', '4'])
+        released.set()
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        self.assertEqual(sent, ['0', '3', '4'])
+
+    async def test_send_failure_closes_connection(self):
+        errors = counter_value(metrics.errors_total, 'outbound')
+        queue, _, closed = self.make_queue(send_error=RuntimeError('connection lost'))
+        queue.put('0')
+        await asyncio.sleep(0.05)
+        self.assertEqual(closed, [1011])
+        self.assertEqual(counter_value(metrics.errors_total, 'outbound'), errors + 1)
+        queue.put('1')
+        self.assertEqual(len(queue._frames), 0)
+
+
+class MultiplexConsumerTests(ChatTransactionTestCase):
+    """
+    一條 WebSocket 訂閱多個聊天室與個人通知 (user-006)。
+    """
+
+    async def test_subscribe_send_and_unsubscribe(self):
+        mux = await self.connect('/ws/multiplex/')
+        chat = await self.connect('/ws/chat/mxa/')
+        await mux.send_json_to({'action': 'subscribe', 'room': 'mxa'})
+        self.assertEqual(await mux.receive_json_from(), {'stream': 'control', 'payload': {'type': 'subscribed', 'room': 'mxa'}})
+
+        await chat.send_json_to({'message': 'from chat'})
+        frame = await mux.receive_json_from()
+        self.assertEqual((frame['stream'], frame['payload']['message']), ('chat:mxa', 'from chat'))
+        await chat.receive_from()
+
+        await mux.send_json_to({'action': 'send', 'room': 'mxa', 'message': 'from mux'})
+        self.assertEqual((await chat.receive_json_from())['message'], 'from mux')
+        await mux.receive_from()
+
+        await mux.send_json_to({'action': 'send', 'room': 'mxb', 'message': 'x'})
+        self.assertIn('error', (await mux.receive_json_from())['payload'])
+
+        await mux.send_json_to({'action': 'unsubscribe', 'room': 'mxa'})
+        await mux.receive_from()
+        await chat.send_json_to({'message': 'after'})
+        await chat.receive_from()
+        self.assertTrue(await mux.receive_nothing(0.1))
+        await mux.disconnect()
+        await chat.disconnect()
+
+    async def test_binary_frame_gets_error_reply(self):
+        mux = await self.connect('/ws/multiplex/')
+        await mux.send_to(bytes_data=b'\x00' + msgpack.packb({'action': 'subscribe', 'room': 'mxa'}))
+        self.assertEqual(await mux.receive_json_from(), {'stream': 'control', 'payload': {'error': 'Invalid binary frame.'}})
+        await mux.send_json_to({'action': 'subscribe', 'room': 'mxa'})
+        self.assertEqual((await mux.receive_json_from())['payload']['type'], 'subscribed')
+        await mux.disconnect()
+
+    async def test_notifications_require_login(self):
+        anonymous = await self.connect('/ws/multiplex/')
+        await anonymous.send_json_to({'action': 'subscribe', 'stream': 'notifications'})
+        self.assertIn('error', (await anonymous.receive_json_from())['payload'])
+        await anonymous.disconnect()
+
+        user = await User.objects.acreate(username='mux')
+        mux = await self.connect('/ws/multiplex/', user=user)
+        await mux.send_json_to({'action': 'subscribe', 'stream': 'notifications'})
+        await mux.receive_from()
+        await get_channel_layer().group_send(f'user_notifications_{user.id}', {'type': 'send_notification', 'message': 'hey'})
+        frame = await mux.receive_json_from()
+        self.assertEqual((frame['stream'], frame['payload']['message']), ('notifications', 'hey'))
+        await mux.disconnect()
+
+
+class ResumeTests(ChatTransactionTestCase):
+    """
+    依 last_seen_id 補發斷線期間的消息 (user-007)。
+    """
+
+    async def send_messages(self, count):
+        communicator = await self.connect('/ws/chat/res/')
+        ids = []
+        for i in range(count):
+            await communicator.send_json_to({'message': f'm{i}'})
+            ids.append((await communicator.receive_json_from())['id'])
+        await communicator.disconnect()
+        return ids
+
+    async def test_reconnect_replays_missed_messages(self):
+        ids = await self.send_messages(3)
+        communicator = await self.connect(f'/ws/chat/res/?last_seen_id={ids[0]}')
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'replay')
+        self.assertEqual([m['id'] for m in frame['messages']], ids[1:])
+        await communicator.send_json_to({'action': 'resume', 'last_seen_id': ids[-1]})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'replay', 'messages': []})
+        await communicator.disconnect()
+
+    @override_settings(CHAT_RESUME_MAX_MESSAGES=1)
+    async def test_large_gap_asks_client_to_reload(self):
+        ids = await self.send_messages(3)
+        communicator = await self.connect(f'/ws/chat/res/?last_seen_id={ids[0]}')
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'reload'})
+        await communicator.disconnect()
+
+    def test_process_local_cache_is_not_used_for_resume(self):
+        ids = [m.id for m in create_messages('res', 2)]
+        history.fetch_page('res')
+        # 其他 worker 寫入的消息不在本進程的快取中
+        other = ChatMessage.objects.create(room_name='res', content='other worker')
+        messages, complete = history.fetch_since('res', ids[-1], 10)
+        self.assertTrue(complete)
+        self.assertEqual([m['id'] for m in messages], [other.id])
+
+
+class LoadTestCommandTests(ChatTransactionTestCase):
+    """
+    進程內壓力測試命令 (user-008)。
+    """
+
+    def test_inprocess_run_reports_latencies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'result.json')
+            call_command('loadtest', rooms=1, clients=2, senders=1, rate=20, duration=0.2, drain=1,
+                         output=output, stderr=io.StringIO())
+            with open(output, encoding='utf-8') as f:
+                result = json.load(f)
+        self.assertEqual(result['mode'], 'inprocess')
+        self.assertGreater(result['sent'], 0)
+        self.assertEqual(result['received'], result['expected_deliveries'])
+        self.assertIn('p99', result['latency_ms'])
+        self.assertFalse(ChatMessage.objects.filter(room_name__startswith='loadtest_').exists())
+
+    # 基準測試矩陣：(名稱, 設定)，每組以相同負載執行一次
+    BENCHMARK_MATRIX = [
+        ('baseline', {}),
+        ('coalesce_50ms', {'CHAT_OUTBOUND_COALESCE_WINDOW_MS': 50}),
+        ('write_behind', {'CHAT_WRITE_BEHIND': True, 'CHAT_WRITE_BEHIND_SPILL_PATH': ''}),
+    ]
+
+    def test_benchmark_matrix_report(self):
+        """
+        以同一個進程內壓力測試驅動各組設定，合併為一份 JSON 報告；
+        設定環境變數 CHAT_BENCHMARK_OUTPUT 時寫入該路徑，方便比對不同版本。
+        """
+        report = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, overrides in self.BENCHMARK_MATRIX:
+                output = os.path.join(directory, f'{name}.json')
+                with self.subTest(name), override_settings(**overrides):
+                    call_command('loadtest', rooms=2, clients=3, senders=1, rate=20, duration=0.3, drain=1,
+                                 output=output, stderr=io.StringIO())
+                    reset_chat_state()
+                    with open(output, encoding='utf-8') as f:
+                        report[name] = json.load(f)
+                    self.assertEqual(report[name]['received'], report[name]['expected_deliveries'])
+        path = os.environ.get('CHAT_BENCHMARK_OUTPUT')
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        self.assertEqual(set(report), {name for name, _ in self.BENCHMARK_MATRIX})
+
+
+class MetricsTests(ChatTestCase):
+    """
+    Prometheus 指標端點 (user-009)。
+    """
+
+    def test_metrics_endpoint(self):
+        user = User.objects.create_user('metrics')
+        self.client.force_login(user)
+        self.client.post('/chat/api/send_message/met/', {'message': 'x'}, content_type='application/json')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('chat_messages_in_total{source="api"}', body)
+        self.assertIn('# TYPE chat_api_send_seconds histogram', body)
+
+    @override_settings(CHAT_METRICS_ENABLED=False)
+    def test_metrics_can_be_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class RateLimitTests(ChatTestCase):
+    """
+    令牌桶速率限制 (user-010)。
+    """
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(rate=1, burst=2)
+        now = bucket.updated
+        for _ in range(2):
+            self.assertEqual(bucket.wait_time(now), 0)
+            bucket.consume()
+        self.assertAlmostEqual(bucket.wait_time(now), 1.0)
+        self.assertEqual(bucket.wait_time(now + 1), 0)
+
+    def test_rejected_hit_does_not_consume_other_limits(self):
+        limiter = ratelimit.LocalRateLimiter()
+        limits = [('user', 'user:1', 0.001, 5), ('room', 'room:r', 0.001, 1)]
+        self.assertTrue(limiter.hit(limits)[0])
+        allowed, wait, scope = limiter.hit(limits)
+        self.assertEqual((allowed, scope), (False, 'room'))
+        self.assertGreater(wait, 0)
+        self.assertTrue(limiter.hit([('user', 'user:1', 0.001, 5)])[0])
+        self.assertAlmostEqual(limiter._buckets['user:1'].tokens, 3, places=3)
+
+    @override_settings(CHAT_RATE_LIMIT_ENABLED=True, CHAT_RATE_LIMIT_USER_RATE=0.01, CHAT_RATE_LIMIT_USER_BURST=2)
+    def test_api_returns_429_with_retry_after(self):
+        self.client.force_login(User.objects.create_user('limited'))
+        codes = [
+            self.client.post('/chat/api/send_message/rl/', {'message': 'x'}, content_type='application/json')
+            for _ in range(3)
+        ]
+        self.assertEqual([r.status_code for r in codes], [200, 200, 429])
+        self.assertGreater(int(codes[-1]['Retry-After']), 0)
+        self.assertEqual(ChatMessage.objects.filter(room_name='rl').count(), 2)
+
+
+class WebsocketRateLimitTests(ChatTransactionTestCase):
+    @override_settings(CHAT_RATE_LIMIT_ENABLED=True, CHAT_RATE_LIMIT_CONNECTION_RATE=0.01, CHAT_RATE_LIMIT_CONNECTION_BURST=1)
+    async def test_connection_limit_rejects_before_write(self):
+        communicator = await self.connect('/ws/chat/rlws/')
+        await communicator.send_json_to({'message': 'first'})
+        self.assertEqual((await communicator.receive_json_from())['message'], 'first')
+        await communicator.send_json_to({'message': 'second'})
+        frame = await communicator.receive_json_from()
+        self.assertIn('error', frame)
+        self.assertGreater(frame['retry_after'], 0)
+        await communicator.disconnect()
+        self.assertEqual(await ChatMessage.objects.filter(room_name='rlws').acount(), 1)
+
+
+class ShardedLayerTests(SimpleTestCase):
+    """
+    一致性雜湊分片的頻道層 (user-011)。
+    """
+
+    def test_adding_a_host_moves_few_rooms(self):
+        keys = [f'chat_room{i}' for i in range(2000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        self.assertEqual([before.node(key) for key in keys], [HashRing(['a', 'b', 'c']).node(key) for key in keys])
+        moved = sum(before.node(key) != after.node(key) for key in keys)
+        self.assertLess(moved / len(keys), 0.4)
+        self.assertEqual({after.node(key) for key in keys}, {0, 1, 2, 3})
+
+    def test_layer_routes_groups_by_ring(self):
+        hosts = ['redis://127.0.0.1:6379', 'redis://127.0.0.1:6380', 'redis://127.0.0.1:6381']
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+        reordered = ShardedRedisChannelLayer(hosts=list(reversed(hosts)))
+        for group in ('chat_lobby', 'chat_random', 'chat_news'):
+            index = layer.consistent_hash(group)
+            self.assertEqual(hosts[index], list(reversed(hosts))[reordered.consistent_hash(group)])
+        self.assertEqual(ShardedRedisChannelLayer(hosts=hosts[:1]).consistent_hash('chat_lobby'), 0)
+
+
+class LocalFanoutTests(ChatSimpleTestCase):
+    """
+    大型聊天室的進程內群發 (user-012)。
+    """
+
+    class FakePubSub:
+        def __init__(self, messages):
+            self.messages = list(messages)
+
+        async def get_message(self, timeout=None):
+            if self.messages:
+                return self.messages.pop(0)
+            await asyncio.sleep(timeout)
+            return None
+
+    class Consumer:
+        def __init__(self, error=None):
+            self.error = error
+            self.events = []
+
+        async def chat_message(self, event):
+            if self.error is not None:
+                raise self.error
+            self.events.append(event)
+
+    @override_settings(CHAT_LOCAL_FANOUT_THRESHOLD=10)
+    def test_only_enabled_for_redis_layers(self):
+        self.assertFalse(LocalFanout.enabled(get_channel_layer()))
+
+    async def test_one_failing_consumer_does_not_stop_delivery(self):
+        fanout = LocalFanout()
+        layer = SimpleNamespace(prefix='asgi')
+        broken, healthy = self.Consumer(error=RuntimeError('closed')), self.Consumer()
+        fanout._members['big'] = {broken, healthy}
+        pubsub = self.FakePubSub([
+            {'type': 'message', 'channel': b'asgi:fanout:big', 'data': b'{"id":1}'},
+            {'type': 'message', 'channel': b'asgi:fanout:big', 'data': b'{"id":2}'},
+        ])
+        errors = counter_value(metrics.errors_total, 'local_fanout')
+        task = asyncio.create_task(fanout._listen(layer, pubsub))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        self.assertEqual([event['frame'] for event in healthy.events], ['{"id":1}', '{"id":2}'])
+        self.assertEqual(healthy.events[0]['room'], 'big')
+        self.assertEqual(counter_value(metrics.errors_total, 'local_fanout'), errors + 2)
+
+
+class RunWorkersTests(ChatTransactionTestCase):
+    """
+    多進程 worker 與連線排空 (user-013)。
+    """
+
+    def test_refuses_process_local_state_with_multiple_workers(self):
+        with self.assertRaisesMessage(CommandError, 'CHAT_RECENT_CACHE_BACKEND'):
+            call_command('runworkers', workers=2)
+
+    @override_settings(CHAT_DRAIN_RECONNECT_JITTER=2.0)
+    def test_reconnect_hint_is_jittered(self):
+        hints = [drain.reconnect_hint() for _ in range(20)]
+        self.assertTrue(all(hint['type'] == 'reconnect' and 0 <= hint['retry_after'] <= 2.0 for hint in hints))
+
+    async def test_draining_worker_rejects_and_closes_connections(self):
+        communicator = await self.connect('/ws/chat/drn/')
+        drain._draining = True
+        rejected = WebsocketCommunicator(APPLICATION, '/ws/chat/drn/')
+        rejected.scope['user'] = AnonymousUser()
+        self.assertEqual(await rejected.connect(), (False, drain.CLOSE_SERVICE_RESTART))
+        consumer = next(iter(drain._connections))
+        await consumer.drain_connection()
+        self.assertEqual((await communicator.receive_json_from())['type'], 'reconnect')
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': drain.CLOSE_SERVICE_RESTART})
+
+
+class AsyncPersistenceTests(ChatTransactionTestCase):
+    """
+    Consumer 的寫入不經過 sync_to_async 的單一執行緒 (user-014)。
+    """
+
+    async def test_save_runs_on_db_pool(self):
+        threads = []
+        original = ChatMessage.objects.create
+
+        def create(**kwargs):
+            threads.append(threading.current_thread().name)
+            return original(**kwargs)
+
+        message = await db.db_sync_to_async(create)(room_name='pool', content='x')
+        self.assertTrue(threads[0].startswith('chat-db'))
+        saved = await persistence.asave_message('pool', None, 'y', timezone.now())
+        self.assertIsNotNone(saved.id)
+        self.assertEqual(await ChatMessage.objects.filter(room_name='pool').acount(), 2)
+        self.assertNotEqual(message.id, saved.id)
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=3600)
+    async def test_write_behind_returns_without_thread_hop(self):
+        self.assertIsNone(await persistence.asave_message('pool', None, 'z', timezone.now()))
+        self.assertEqual(len(persistence.get_write_behind_buffer()._queue), 1)
+
+
+class DedupTests(ChatTransactionTestCase):
+    """
+    以 client_msg_id 冪等發送 (user-015)。
+    """
+
+    async def test_websocket_retry_is_not_rebroadcast(self):
+        communicator = await self.connect('/ws/chat/dup/')
+        await communicator.send_json_to({'message': 'a', 'client_msg_id': 'c1'})
+        first = await communicator.receive_json_from()
+        self.assertEqual(first['client_msg_id'], 'c1')
+        await communicator.send_json_to({'message': 'a', 'client_msg_id': 'c1'})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'duplicate', 'client_msg_id': 'c1', 'id': first['id']})
+
+        # 去重快取過期後由資料庫的唯一約束擋下
+        dedup._cache = None
+        await communicator.send_json_to({'message': 'a', 'client_msg_id': 'c1'})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'duplicate', 'client_msg_id': 'c1', 'id': first['id']})
+
+        await communicator.send_json_to({'message': 'a', 'client_msg_id': 'x' * 65})
+        self.assertIn('error', await communicator.receive_json_from())
+        await communicator.disconnect()
+        self.assertEqual(await ChatMessage.objects.filter(room_name='dup').acount(), 1)
+
+    def test_api_retry_returns_original_id(self):
+        self.client.force_login(User.objects.create_user('dedup'))
+        data = {'message': 'a', 'client_msg_id': 'a1'}
+        first = self.client.post('/chat/api/send_message/dup/', data, content_type='application/json').json()
+        second = self.client.post('/chat/api/send_message/dup/', data, content_type='application/json').json()
+        self.assertEqual(second, {'status': '消息已處理過。', 'duplicate': True, 'id': first['id']})
+        self.assertEqual(ChatMessage.objects.filter(room_name='dup').count(), 1)
+
+
+class RoomStatsTests(ChatTestCase):
+    """
+    聊天室統計與活躍聊天室列表 (user-016)。
+    """
+
+    def record(self, room_name, count, start):
+        buffer = rooms.get_room_stats_buffer()
+        for i in range(count):
+            buffer.record_message(room_name, i + 1, 'u', f'{room_name} {i}', start + timedelta(seconds=i))
+
+    def test_flush_applies_one_update_per_room(self):
+        now = timezone.now()
+        Room.objects.create(name='ra')
+        self.record('ra', 5, now)
+        with self.assertNumQueries(1):
+            rooms.get_room_stats_buffer().flush()
+        room = Room.objects.get(name='ra')
+        self.assertEqual((room.message_count, room.last_message_id, room.last_message_preview), (5, 5, 'ra 4'))
+
+    def test_older_batch_does_not_overwrite_last_message(self):
+        now = timezone.now()
+        self.record('ra', 1, now)
+        rooms.get_room_stats_buffer().flush()
+        self.record('ra', 1, now - timedelta(minutes=1))
+        rooms.get_room_stats_buffer().flush()
+        room = Room.objects.get(name='ra')
+        self.assertEqual((room.message_count, room.last_message_at), (2, now))
+
+    def test_active_rooms_api_pages_by_activity(self):
+        now = timezone.now()
+        for offset, room_name in enumerate(['old', 'mid', 'new']):
+            self.record(room_name, 1, now + timedelta(minutes=offset))
+        rooms.get_room_stats_buffer().flush()
+        with self.assertNumQueries(1):
+            page = self.client.get('/chat/api/rooms/', {'limit': 2}).json()
+        self.assertEqual([room['name'] for room in page['rooms']], ['new', 'mid'])
+        self.assertEqual(page['rooms'][0]['member_count'], 0)
+        rest = self.client.get('/chat/api/rooms/', {'limit': 2, 'before': page['next']}).json()
+        self.assertEqual(([room['name'] for room in rest['rooms']], rest['next']), (['old'], None))
+        self.assertEqual(self.client.get('/chat/api/rooms/', {'before': 'zzz'}).status_code, 400)
+
+    @override_settings(CHAT_PRESENCE_BACKEND='local', CHAT_PRESENCE_DEBOUNCE=3600)
+    async def test_member_counts_come_from_presence(self):
+        presence.join(get_channel_layer(), 'ra', 'u:alice')
+        presence.join(get_channel_layer(), 'ra', 'u:alice')
+        presence.join(get_channel_layer(), 'ra', 'u:bob')
+        presence.leave('ra', 'u:bob')
+        self.assertEqual(presence.room_member_counts(['ra', 'rb']), {'ra': 1, 'rb': 0})
+        presence.get_presence()._task.cancel()
+
+
+class ArchiveTests(ChatTestCase):
+    """
+    冷資料歸檔 (user-017)。
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_override = override_settings(CHAT_ARCHIVE_DIR=directory.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        create_messages('arc', 6, start=timezone.now() - timedelta(days=100))
+        create_messages('arc', 3)
+
+    def walk(self):
+        backwards, page = [], history._query_page('arc', None, None, 4)
+        backwards[:0] = page['messages']
+        while page['older']:
+            page = history._query_page('arc', page['older'], None, 4)
+            backwards[:0] = page['messages']
+        first = backwards[0]
+        forwards, cursor = [first], history.encode_cursor(first['timestamp'], first['id'])
+        while cursor:
+            page = history._query_page('arc', None, cursor, 4)
+            forwards += page['messages']
+            cursor = page['newer']
+        return backwards, forwards
+
+    def test_archived_messages_stay_readable(self):
+        before = self.walk()
+        call_command('archive_messages', room=['arc'], sleep=0, batch_size=4, stdout=io.StringIO())
+        self.assertEqual(ChatMessage.objects.filter(room_name='arc').count(), 3)
+        self.assertEqual(sum(segment.message_count for segment in ArchiveSegment.objects.filter(room_name='arc')), 6)
+        self.assertEqual(self.walk(), before)
+        self.assertEqual(len(before[0]), 9)
+        self.assertEqual(before[0], before[1])
+
+    def test_rerun_is_idempotent(self):
+        call_command('archive_messages', room=['arc'], sleep=0, stdout=io.StringIO())
+        call_command('archive_messages', room=['arc'], sleep=0, stdout=io.StringIO())
+        self.assertEqual(sum(segment.message_count for segment in ArchiveSegment.objects.filter(room_name='arc')), 6)
+
+
+class SearchTests(ChatTestCase):
+    """
+    全文搜尋 (user-018)。
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('searcher')
+        for i in range(6):
+            ChatMessage.objects.create(room_name='sa' if i % 2 else 'sb', sender=self.user if i < 3 else None,
+                                       content=f'apple pie {i}' if i % 3 else f'banana bread {i}')
+
+    def search(self, **params):
+        return self.client.get('/chat/api/search/', params)
+
+    def test_search_pages_through_all_matches(self):
+        page = self.search(q='apple', limit=2).json()
+        ids = [result['id'] for result in page['results']]
+        while page['next']:
+            page = self.search(q='apple', limit=2, cursor=page['next']).json()
+            ids += [result['id'] for result in page['results']]
+        expected = ChatMessage.objects.filter(content__contains='apple').values_list('id', flat=True)
+        self.assertEqual(sorted(ids), sorted(expected))
+
+    def test_filters_and_recent_order(self):
+        self.assertEqual(len(self.search(q='apple', room='sa').json()['results']), 2)
+        self.assertEqual(len(self.search(q='apple', user='searcher').json()['results']), 2)
+        results = self.search(q='apple', order='recent').json()['results']
+        self.assertEqual([r['id'] for r in results], sorted((r['id'] for r in results), reverse=True))
+
+    def test_index_follows_updates_and_deletes(self):
+        ChatMessage.objects.filter(content__contains='banana').update(content='cherry tart')
+        self.assertEqual(len(self.search(q='banana').json()['results']), 0)
+        self.assertEqual(len(self.search(q='cherry').json()['results']), 2)
+        ChatMessage.objects.filter(room_name='sa').delete()
+        self.assertEqual(len(self.search(q='apple').json()['results']), 2)
+
+    def test_short_terms_fall_back_to_substring_match(self):
+        greeting = ChatMessage.objects.create(room_name='sa', content='大家你好，歡迎')
+        mixed = ChatMessage.objects.create(room_name='sb', content='apple 你好')
+        ChatMessage.objects.create(room_name='sa', content='100% sure')
+        results = self.search(q='你好').json()['results']
+        self.assertEqual([r['id'] for r in results], [mixed.id, greeting.id])
+        self.assertEqual([r['id'] for r in self.search(q='你好', room='sa').json()['results']], [greeting.id])
+        self.assertEqual([r['id'] for r in self.search(q='apple 你好').json()['results']], [mixed.id])
+        self.assertEqual([r['id'] for r in self.search(q='% 歡迎').json()['results']], [])
+        self.assertEqual(len(self.search(q='0%').json()['results']), 1)
+        page = self.search(q='你好', limit=1).json()
+        self.assertEqual([r['id'] for r in page['results']], [mixed.id])
+        rest = self.search(q='你好', limit=1, cursor=page['next']).json()
+        self.assertEqual(([r['id'] for r in rest['results']], rest['next']), ([greeting.id], None))
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.search(q='').status_code, 400)
+        self.assertEqual(self.search(q='apple', order='x').status_code, 400)
+        self.assertEqual(self.search(q='apple', cursor='!!').status_code, 400)
+        self.assertEqual(self.search(q='apple', since='yesterday').status_code, 400)
+
+
+class WireProtocolTests(ChatSimpleTestCase):
+    """
+    以子協定協商的二進位幀 (user-019)。
+    """
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(zlib.decompress(data[1:]) if data[0] == wire.FLAG_ZLIB else data[1:])
+
+    def test_negotiation_follows_client_preference(self):
+        self.assertIs(wire.negotiate(None), wire.JSON_CODEC)
+        self.assertEqual(wire.negotiate(['x', wire.SUBPROTOCOL_MSGPACK]).subprotocol, wire.SUBPROTOCOL_MSGPACK)
+        self.assertEqual(wire.negotiate([wire.SUBPROTOCOL_JSON, wire.SUBPROTOCOL_MSGPACK]).subprotocol, wire.SUBPROTOCOL_JSON)
+        with self.settings(CHAT_WIRE_MSGPACK_ENABLED=False):
+            self.assertIs(wire.negotiate([wire.SUBPROTOCOL_MSGPACK]), wire.JSON_CODEC)
+
+    def test_chat_messages_are_positional_arrays(self):
+        frame = wire.build_chat_frame('hi', 'u', 't', 1, 'c1')
+        self.assertEqual(self.decode(wire.encode_binary_broadcast(frame)), [1, 'hi', 'u', 't', 'c1'])
+        batch = wire.encode_binary_batch([frame, wire.build_chat_frame('x', 'u', 't', 2)])
+        self.assertEqual(self.decode(batch), {'type': 'batch', 'messages': [[1, 'hi', 'u', 't', 'c1'], [2, 'x', 'u', 't']]})
+        replay = wire.dumps({'type': 'replay', 'messages': [{'id': 1, 'message': 'a', 'user': 'u', 'timestamp': 't'}]})
+        self.assertEqual(self.decode(wire.encode_binary(replay)), {'type': 'replay', 'messages': [[1, 'a', 'u', 't']]})
+        presence_frame = wire.dumps({'type': 'presence', 'count': 2, 'joined': ['a'], 'left': []})
+        self.assertEqual(self.decode(wire.encode_binary(presence_frame)), wire.loads(presence_frame))
+
+    def test_large_frames_are_compressed(self):
+        frame = wire.build_chat_frame('長' * 2000, 'u', 't', 1)
+        compressed = wire.encode_binary_broadcast(frame, compress_min_bytes=512)
+        self.assertEqual(compressed[0], wire.FLAG_ZLIB)
+        self.assertLess(len(compressed), len(frame.encode('utf-8')) // 10)
+        self.assertEqual(self.decode(compressed)[1], '長' * 2000)
+        self.assertEqual(wire.encode_binary_broadcast(wire.build_chat_frame('hi', 'u', 't', 1), 512)[0], wire.FLAG_PLAIN)
+
+    def test_decode_rejects_invalid_frames(self):
+        self.assertEqual(wire.decode_binary(b'\x00' + msgpack.packb({'message': 'hi'})), {'message': 'hi'})
+        for data in (b'', b'\x07abc', b'\x00\xc1', b'\x01' + zlib.compress(b'\x00' * (wire.MAX_FRAME_BYTES + 1))):
+            with self.assertRaises(wire.FrameDecodeError):
+                wire.decode_binary(data)
+
+    def test_binary_frame_cache_is_bounded_by_bytes(self):
+        frame_cache = wire._BinaryFrameCache(max_bytes=100)
+        for i in range(20):
+            frame_cache.get_or_create((None, f'frame{i:02d}'), lambda: b'x' * 10)
+        self.assertLessEqual(frame_cache.bytes, 100)
+        self.assertEqual(len(frame_cache._entries), 5)
+        self.assertIn((None, 'frame19'), frame_cache._entries)
+        frame_cache.get_or_create((None, 'y' * 200), lambda: b'big')
+        self.assertNotIn((None, 'y' * 200), frame_cache._entries)
+
+
+class WireConsumerTests(ChatTransactionTestCase):
+    async def test_msgpack_client_round_trip(self):
+        json_client = await self.connect('/ws/chat/bin/')
+        binary = await self.connect('/ws/chat/bin/', subprotocols=[wire.SUBPROTOCOL_MSGPACK])
+        await binary.send_to(bytes_data=b'\x00' + msgpack.packb({'message': 'from msgpack'}))
+        frame = await json_client.receive_json_from()
+        received = await binary.receive_output()
+        self.assertEqual(WireProtocolTests.decode(received['bytes']),
+                         [frame['id'], 'from msgpack', frame['user'], frame['timestamp']])
+        await binary.send_to(bytes_data=b'\x07')
+        self.assertEqual(WireProtocolTests.decode((await binary.receive_output())['bytes']), {'error': 'Invalid binary frame.'})
+        await json_client.disconnect()
+        await binary.disconnect()
+
+
+@override_settings(CHAT_DB_REPLICAS=['replica_0'], CHAT_DB_STICKY_SECONDS=60)
+class ReplicaRouterTests(ChatTestCase):
+    """
+    歷史讀取走唯讀副本的路由 (user-020)。
+    """
+
+    def test_reads_use_replica_only_inside_block(self):
+        router = routers.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(ChatMessage))
+        with routers.replica_reads():
+            self.assertEqual(router.db_for_read(ChatMessage), 'replica_0')
+            self.assertEqual(router.db_for_write(ChatMessage), 'default')
+            self.assertTrue(routers.reading_from_replica())
+        self.assertFalse(routers.reading_from_replica())
+        self.assertTrue(routers.on_replica(routers.reading_from_replica)())
+
+    def test_recent_writer_reads_primary(self):
+        routers.mark_written('user:1')
+        with routers.replica_reads('user:1'):
+            self.assertFalse(routers.reading_from_replica())
+        with routers.replica_reads('user:2'):
+            self.assertTrue(routers.reading_from_replica())
+
+    def test_cache_is_not_filled_from_replica(self):
+        with routers.replica_reads():
+            self.assertIsNone(history.fill_token('rep'))
+        self.assertIsNotNone(history.fill_token('rep'))
+
+    @override_settings(CHAT_DB_REPLICAS=[])
+    def test_without_replicas_reads_primary(self):
+        with routers.replica_reads():
+            self.assertFalse(routers.reading_from_replica())
+
+
+class PresenceTests(ChatSimpleTestCase):
+    """
+    在線狀態與成員數 (user-021)。
+    """
+
+    async def test_flush_sends_one_debounced_frame(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(room_group_name('pr'), channel)
+        tracker = presence.PresenceTracker(debounce=3600)
+        tracker.join(layer, 'pr', 'u:alice')
+        tracker.join(layer, 'pr', 'u:alice')
+        tracker.join(layer, 'pr', 'u:bob')
+        tracker.join(layer, 'pr', 'a:x')
+        tracker.leave('pr', 'a:x') # 同一批次內加入又離開，互相抵銷
+        await tracker.flush()
+        event = await layer.receive(channel)
+        self.assertEqual(wire.loads(event['frame']), {'type': 'presence', 'count': 2, 'joined': ['alice', 'bob'], 'left': []})
+        self.assertEqual(tracker.counts(['pr']), {'pr': 2})
+        tracker.leave('pr', 'u:alice')
+        self.assertEqual(tracker.counts(['pr']), {'pr': 2})
+        tracker.leave('pr', 'u:alice')
+        self.assertEqual(tracker.counts(['pr']), {'pr': 1})
+        tracker._task.cancel()
+
+    async def test_members_are_paged(self):
+        tracker = presence.PresenceTracker(debounce=3600)
+        for key in ('u:a', 'u:b', 'u:c'):
+            tracker.join(get_channel_layer(), 'pr', key)
+        first = tracker.members('pr', limit=2)
+        self.assertEqual((first['count'], len(first['members'])), (3, 2))
+        rest = tracker.members('pr', after=first['next'], limit=2)
+        self.assertEqual((len(rest['members']), rest['next']), (1, None))
+        tracker._task.cancel()
+
+
+@skipUnless(fakeredis is not None, '需要 fakeredis[lua]')
+class RedisPresenceStoreTests(ChatSimpleTestCase):
+    """
+    多個 worker 共用的在線成員集合。
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.server = fakeredis.FakeServer()
+
+    def make_store(self, ttl=45.0):
+        # 模擬另一個 worker：各自的 worker id，連到同一個 Redis
+        store = presence.RedisPresenceStore('redis://localhost', ttl=ttl)
+        store._client = fakeredis.FakeRedis(server=self.server)
+        store._script = store._client.register_script(presence._APPLY_SCRIPT)
+        async_client = fakeredis.FakeAsyncRedis(server=self.server)
+        store._async_client = lambda: (async_client, async_client.register_script(presence._APPLY_SCRIPT))
+        return store
+
+    async def test_member_leaves_only_when_no_worker_holds_it(self):
+        first, second = self.make_store(), self.make_store()
+        self.assertEqual(await first.aapply([('pr', ['u:alice'], [])]), {'pr': (1, ['u:alice'], [])})
+        self.assertEqual(await second.aapply([('pr', ['u:alice', 'u:bob'], [])]), {'pr': (2, ['u:bob'], [])})
+        self.assertEqual(await first.aapply([('pr', [], ['u:alice'])]), {'pr': (2, [], [])})
+        self.assertEqual(first.counts(['pr', 'empty']), {'pr': 2, 'empty': 0})
+        self.assertEqual(first.members('pr')['members'], ['alice', 'bob'])
+        self.assertEqual(await second.aapply([('pr', [], ['u:alice'])]), {'pr': (1, [], ['u:alice'])})
+
+    async def test_crashed_worker_entries_expire(self):
+        crashed, alive = self.make_store(ttl=0.05), self.make_store()
+        await crashed.aapply([('pr', ['u:alice', 'u:bob'], [])])
+        await alive.aapply([('pr', ['u:alice'], [])])
+        await asyncio.sleep(0.1)
+        self.assertEqual(await alive.aapply([('pr', [], [])]), {'pr': (1, [], ['u:bob'])})
+        self.assertEqual(alive.members('pr')['members'], ['alice'])
+
+    async def test_tracker_skips_frames_without_global_change(self):
+        first, second = self.make_store(), self.make_store()
+        await second.aapply([('pr', ['u:alice'], [])])
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(room_group_name('pr'), channel)
+        tracker = presence.PresenceTracker(first, debounce=3600)
+        tracker.join(layer, 'pr', 'u:alice')
+        await tracker.flush()
+        tracker.leave('pr', 'u:alice')
+        await tracker.flush()
+        tracker._task.cancel()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.05)
+
+
+class PresenceConsumerTests(ChatTransactionTestCase):
+    @override_settings(CHAT_PRESENCE_BACKEND='local', CHAT_PRESENCE_DEBOUNCE=0.05)
+    async def test_clients_receive_presence_and_members_api(self):
+        user = await User.objects.acreate(username='alice')
+        communicator = await self.connect('/ws/chat/prc/', user=user)
+        frame = await communicator.receive_json_from(timeout=2)
+        self.assertEqual((frame['type'], frame['count'], frame['joined']), ('presence', 1, ['alice']))
+        response = await self.async_client.get('/chat/api/rooms/prc/members/')
+        self.assertEqual(response.json()['count'], 1)
+        await communicator.disconnect()
+
+    async def test_members_api_without_presence(self):
+        response = await self.async_client.get('/chat/api/rooms/prc/members/')
+        self.assertEqual(response.status_code, 501)
+
+
+class EphemeralTests(ChatTransactionTestCase):
+    """
+    輸入中提示與已讀回執 (user-022)。
+    """
+
+    @override_settings(CHAT_EPHEMERAL_WINDOW_MS=50)
+    async def test_typing_events_are_coalesced(self):
+        alice = await User.objects.acreate(username='alice')
+        sender = await self.connect('/ws/chat/eph/', user=alice)
+        anonymous = await self.connect('/ws/chat/eph/')
+        for _ in range(5):
+            await sender.send_json_to({'action': 'typing', 'typing': True})
+        await sender.send_json_to({'action': 'typing', 'typing': False})
+        self.assertEqual(await anonymous.receive_json_from(timeout=2), {'type': 'ephemeral', 'typing': {'alice': False}})
+        self.assertTrue(await anonymous.receive_nothing(0.2))
+        await anonymous.send_json_to({'action': 'typing'})
+        self.assertIn('error', await anonymous.receive_json_from())
+        await sender.disconnect()
+        await anonymous.disconnect()
+
+    def test_read_cursors_and_unread_counts(self):
+        alice = User.objects.create_user('alice')
+        ids = [m.id for m in create_messages('eph', 5)]
+        Room.objects.create(name='eph', message_count=5, last_message_id=ids[-1], last_message_at=timezone.now())
+        buffer = receipts.get_read_cursor_buffer()
+        buffer.record(alice.id, 'eph', ids[1])
+        buffer.record(alice.id, 'eph', ids[0]) # 亂序到達的舊回執
+        buffer.flush()
+        cursor = ReadCursor.objects.get(user=alice, room_name='eph')
+        self.assertEqual((cursor.last_read_id, cursor.read_message_count), (ids[1], 2))
+        buffer.record(alice.id, 'eph', ids[0])
+        buffer.flush()
+        self.assertEqual(ReadCursor.objects.get(user=alice, room_name='eph').last_read_id, ids[1])
+
+        self.client.force_login(alice)
+        unread = self.client.get('/chat/api/unread/').json()['rooms']
+        self.assertEqual([(room['room'], room['unread']) for room in unread], [('eph', 3)])
+        self.client.logout()
+        self.assertEqual(self.client.get('/chat/api/unread/').status_code, 403)
+
+
+class RoomPageTests(ChatTransactionTestCase):
+    """
+    聊天室頁面的條件請求與串流輸出 (user-023)。
+    """
+
+    def send(self, content):
+        self.client.post('/chat/api/send_message/page/', {'message': content}, content_type='application/json')
+        rooms.get_room_stats_buffer().flush()
+
+    async def get(self, **headers):
+        response = await self.async_client.get('/chat/page/', headers=headers)
+        body = b''
+        if response.status_code == 200:
+            self.assertTrue(response.streaming)
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        return response, body.decode()
+
+    async def test_etag_and_streamed_history(self):
+        user = await User.objects.acreate(username='carol')
+        await sync_to_async(self.client.force_login)(user)
+        await sync_to_async(self.send)('<b>hi</b>')
+        response, body = await self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('&lt;b&gt;hi&lt;/b&gt;', body)
+        self.assertIn('data-last-seen-id', body)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        not_modified, _ = await self.get(if_none_match=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        await sync_to_async(self.send)('new one')
+        changed, body = await self.get(if_none_match=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertIn('new one', body)
+
+    def test_fragment_cache_follows_room_version(self):
+        self.client.force_login(User.objects.create_user('dave'))
+        self.send('first')
+        state = pages.room_state('page')
+        first = pages.history_fragment('page', state)
+        with self.assertNumQueries(0):
+            self.assertEqual(pages.history_fragment('page', state), first)
+        self.send('later')
+        self.assertIn('later', pages.history_fragment('page', pages.room_state('page')))
+
+
+class BulkSendTests(ChatTestCase):
+    """
+    批次與跨聊天室發送 API (user-024)。
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+
+    def post(self, data):
+        return self.client.post('/chat/api/send_messages/', json.dumps(data), content_type='application/json')
+
+    def test_requires_staff(self):
+        self.client.force_login(User.objects.create_user('plain'))
+        self.assertEqual(self.post([{'room': 'ba', 'message': 'x'}]).status_code, 403)
+
+    def test_per_item_results_and_single_insert(self):
+        self.client.force_login(self.admin)
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(room_group_name('ba'), channel)
+        items = [
+            {'room': 'ba', 'message': 'm0', 'client_msg_id': 'c0'},
+            {'room': 'ba', 'message': 'm1'},
+            {'room': 'bb', 'message': 'other'},
+            {'room': 'bad-room', 'message': 'x'},
+            {'room': 'ba', 'message': ''},
+            {'room': 'ba', 'message': 'again', 'client_msg_id': 'c0'},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post({'messages': items})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['sent'], 3)
+        self.assertEqual([result['status'] for result in body['results']], ['sent', 'sent', 'sent', 'invalid', 'invalid', 'invalid'])
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "chat_chatmessage"')]
+        self.assertEqual(len(inserts), 1)
+
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual([wire.loads(frame)['message'] for frame in event['frames']], ['m0', 'm1'])
+
+        retry = self.post(items[:1]).json()
+        self.assertEqual(retry['results'][0]['status'], 'duplicate')
+        self.assertEqual(retry['results'][0]['id'], body['results'][0]['id'])
+        self.assertEqual(ChatMessage.objects.filter(room_name__in=['ba', 'bb']).count(), 3)
+
+    def test_rejects_invalid_payloads(self):
+        self.client.force_login(self.admin)
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertEqual(self.post({'messages': 'x'}).status_code, 400)
+        self.assertEqual(self.post([{'room': 'ba'}]).status_code, 400)
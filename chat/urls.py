@@ -8,5 +8,12 @@ urlpatterns = [
 
     # DRF API 路由
     path('api/send_message/<str:room_name>/', views.SendMessageAPI.as_view(), name='send_message_api'),
+    path('api/send_messages/', views.SendBulkMessagesAPI.as_view(), name='send_bulk_messages_api'),
+    path('api/history/<str:room_name>/', views.MessageHistoryAPI.as_view(), name='message_history_api'),
+    path('api/rooms/', views.ActiveRoomsAPI.as_view(), name='active_rooms_api'),
+    path('api/rooms/<str:room_name>/members/', views.RoomMembersAPI.as_view(), name='room_members_api'),
+    path('api/unread/', views.UnreadCountsAPI.as_view(), name='unread_counts_api'),
+    path('api/search/', views.SearchMessagesAPI.as_view(), name='search_messages_api'),
+    path('api/cache_stats/', views.RecentCacheStatsAPI.as_view(), name='recent_cache_stats_api'),
     # path('api/send_notification/<int:user_id>/', views.SendNotificationAPI.as_view(), name='send_notification_api'),
 ]
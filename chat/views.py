@@ -1,65 +1,277 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated # 引入認證相關類
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated # 引入認證相關類
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-import json
 import logging # 導入 logging 模組
-import re # 導入正則表達式模組
 from django.utils import timezone # 導入時區感知時間
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import condition # ETag / Last-Modified 條件請求
 
 # 導入模型和用戶模型
-from .models import ChatMessage 
+from . import metrics # Prometheus 指標
+from . import pages # 聊天室頁面的快取與串流輸出
+from .cache import get_recent_cache # 每個聊天室的最近消息快取
+from .dedup import DuplicateMessage, is_valid_client_msg_id # client_msg_id 去重
+from .history import DEFAULT_PAGE_SIZE, fetch_page # 鍵集分頁歷史查詢
+from .messaging import is_valid_room_name, publish_message, publish_messages # 與 ChatConsumer 共用的消息發送流程
+from .presence import DEFAULT_MEMBERS_PAGE_SIZE, room_member_counts, room_members # 在線狀態
+from .ratelimit import MessageRateThrottle # 令牌桶速率限制
+from .receipts import fetch_unread_counts # 已讀游標與未讀數
+from .rooms import DEFAULT_ROOMS_PAGE_SIZE, fetch_active_rooms # 活躍聊天室列表
+from .routers import mark_written, replica_reads, sticky_key # 讀寫分離
+from .search import DEFAULT_SEARCH_PAGE_SIZE, ORDER_RANK, SearchNotSupported, search_messages # 全文搜尋
 from django.contrib.auth.models import User
 
 # 配置日誌記錄器
 logger = logging.getLogger(__name__)
 
+def request_sticky_key(request):
+    """
+    請求者的讀己之寫識別；最近發送過消息的用戶讀取主庫。
+    """
+    return sticky_key(request.user, request.META.get('REMOTE_ADDR'))
+
+def _with_member_counts(active_rooms):
+    """
+    為聊天室列表加上在線人數。人數來自帶到期時間的在線成員集合，不持久化，
+    worker 崩潰或漏掉斷線時也不會持續偏差。
+    """
+    counts = room_member_counts([room['name'] for room in active_rooms])
+    for room in active_rooms:
+        room['member_count'] = counts.get(room['name'], 0)
+    return active_rooms
+
 # Django 傳統視圖，用於渲染 HTML 頁面
 def index(request):
     """
-    渲染聊天室選擇頁面。
+    渲染聊天室選擇頁面，並列出最近活躍的聊天室。
     """
-    return render(request, 'chat/index.html')
+    active_rooms = []
+    try:
+        with replica_reads(request_sticky_key(request)):
+            active_rooms = fetch_active_rooms(limit=10)['rooms']
+        _with_member_counts(active_rooms)
+    except Exception as e:
+        logger.error(f"加載活躍聊天室時發生錯誤: {e}")
+    return render(request, 'chat/index.html', {'active_rooms': active_rooms})
 
+def _room_state(request, room_name):
+    """
+    聊天室頁面的版本資訊 (只讀取 Room 表)，同一請求內的 ETag、Last-Modified 與視圖共用一次查詢。
+    """
+    if not hasattr(request, '_chat_room_state'):
+        state = None
+        if is_valid_room_name(room_name):
+            try:
+                with replica_reads(request_sticky_key(request)):
+                    state = pages.room_state(room_name)
+            except Exception as e:
+                logger.error(f"讀取聊天室 {room_name} 的統計時發生錯誤: {e}")
+        request._chat_room_state = state
+    return request._chat_room_state
+
+def _room_etag(request, room_name):
+    state = _room_state(request, room_name)
+    return pages.room_etag(state, request.user) if state is not None else None
+
+def _room_last_modified(request, room_name):
+    state = _room_state(request, room_name)
+    return state['last_message_at'] if state is not None else None
+
+# 聊天室沒有新消息時，帶 If-None-Match / If-Modified-Since 的請求直接返回 304，不查詢消息表
+@condition(etag_func=_room_etag, last_modified_func=_room_last_modified)
 def room(request, room_name):
     """
     渲染特定聊天室頁面，並加載歷史消息。
     """
     # 後端驗證房間名稱格式
-    valid_room_pattern = re.compile(r'^[a-zA-Z0-9_]+$') # 允許字母、數字、底線
-    if not valid_room_pattern.match(room_name):
+    if not is_valid_room_name(room_name): # 允許字母、數字、底線
         logger.warning(f"View: 檢測到無效房間名稱格式: {room_name}，顯示錯誤頁面。")
         # 可以建立一個專門的錯誤頁面或重定向
         return render(request, 'chat/invalid_room.html', {'error_message': '聊天室名稱格式無效。'}) 
 
-    messages = []
-    try:
-        # 加載歷史消息 (已在 models.py 中啟用 ChatMessage)
-        # 獲取最近的 100 條消息
-        messages = ChatMessage.objects.filter(room_name=room_name).order_by('timestamp').select_related('sender')[:100]
-    except Exception as e:
-        logger.error(f"加載歷史消息時發生錯誤: {e}")
-            
-    return render(request, 'chat/room.html', {
-        'room_name': room_name,
-        'messages': messages, # 將消息傳遞給模板
-    })
+    # 頁首先輸出，最近的 CHAT_ROOM_PAGE_HISTORY 條消息 (鍵集分頁的最新一頁) 以快取的片段隨後串流輸出
+    response = StreamingHttpResponse(
+        pages.stream_room_page(request, room_name, _room_state(request, room_name), request_sticky_key(request)),
+        content_type='text/html; charset=utf-8',
+    )
+    # 每次都向伺服器確認，內容未變時由 ETag 得到 304
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def prometheus_metrics(request):
+    """
+    以 Prometheus 文字格式輸出本進程的指標，供 Prometheus 抓取。
+    """
+    if not settings.CHAT_METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Django REST Framework API 視圖：以游標分頁讀取歷史消息
+class MessageHistoryAPI(APIView):
+    # 歷史消息與聊天室頁面一樣公開可讀
+    permission_classes = [AllowAny]
+
+    def get(self, request, room_name, *args, **kwargs):
+        """
+        返回聊天室的一頁歷史消息。可用 before / after 游標向前或向後翻頁，limit 控制每頁數量。
+        """
+        # 後端驗證房間名稱格式
+        if not is_valid_room_name(room_name): # 允許字母、數字、底線
+            logger.warning(f"History API: 檢測到無效房間名稱格式: {room_name}。")
+            return Response({"error": "房間名稱格式無效。"}, status=status.HTTP_400_BAD_REQUEST)
+
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        if before and after:
+            return Response({"error": "before 與 after 不能同時指定。"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', DEFAULT_PAGE_SIZE))
+            with replica_reads(request_sticky_key(request)):
+                page = fetch_page(room_name, before=before or None, after=after or None, limit=limit)
+        except ValueError as e:
+            logger.warning(f"History API 收到無效參數: {e}")
+            return Response({"error": "分頁參數無效。"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page, status=status.HTTP_200_OK)
+
+# Django REST Framework API 視圖：依最近活動排序的聊天室列表
+class ActiveRoomsAPI(APIView):
+    # 與聊天室頁面一樣公開可讀
+    permission_classes = [AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        """
+        返回一頁聊天室 (最近有消息的在前)，附消息數、在線人數與最後消息預覽；以 next 游標翻頁。
+        只讀取 Room 表，不掃描消息表。
+        """
+        try:
+            limit = int(request.query_params.get('limit', DEFAULT_ROOMS_PAGE_SIZE))
+            with replica_reads(request_sticky_key(request)):
+                page = fetch_active_rooms(before=request.query_params.get('before') or None, limit=limit)
+            _with_member_counts(page['rooms'])
+        except ValueError as e:
+            logger.warning(f"Rooms API 收到無效參數: {e}")
+            return Response({"error": "分頁參數無效。"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page, status=status.HTTP_200_OK)
+
+# Django REST Framework API 視圖：聊天室的在線成員
+class RoomMembersAPI(APIView):
+    # 與聊天室頁面一樣公開可讀
+    permission_classes = [AllowAny]
+
+    def get(self, request, room_name, *args, **kwargs):
+        """
+        返回聊天室的在線人數與一頁成員名稱 (依用戶名稱排列)，以 next 作為下一頁的 after 參數；
+        limit=0 時只返回人數。
+        """
+        if not is_valid_room_name(room_name):
+            return Response({"error": "房間名稱格式無效。"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', DEFAULT_MEMBERS_PAGE_SIZE))
+        except ValueError:
+            return Response({"error": "分頁參數無效。"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page = room_members(room_name, after=request.query_params.get('after') or None, limit=limit)
+        except Exception as e:
+            metrics.errors_total.inc('presence')
+            logger.error(f"讀取聊天室 {room_name} 的在線成員時發生錯誤: {e}")
+            return Response({"error": "暫時無法取得在線成員。"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if page is None:
+            return Response({"error": "在線狀態未啟用。"}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        return Response(page, status=status.HTTP_200_OK)
+
+# Django REST Framework API 視圖：目前用戶各聊天室的未讀數
+class UnreadCountsAPI(APIView):
+    # 已讀游標屬於個人資料
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        """
+        返回用戶有已讀游標的聊天室及其未讀數，以 Room.message_count 與游標記下的消息數相減，
+        不計算消息表的行數。
+        """
+        with replica_reads(request_sticky_key(request)):
+            return Response(fetch_unread_counts(request.user), status=status.HTTP_200_OK)
+
+# Django REST Framework API 視圖：以全文索引搜尋消息
+class SearchMessagesAPI(APIView):
+    # 與歷史消息一樣公開可讀
+    permission_classes = [AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        """
+        返回一頁符合 q 的消息，order=rank (預設，依相關度) 或 recent (由新到舊)。
+        可用 room、user、since、until (ISO 8601) 篩選，以 next 游標翻頁。
+        """
+        params = request.query_params
+        room_name = params.get('room') or None
+        if room_name is not None and not is_valid_room_name(room_name):
+            return Response({"error": "房間名稱格式無效。"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            since, until = (self._parse_time(params.get(name)) for name in ('since', 'until'))
+            with replica_reads(request_sticky_key(request)):
+                page = search_messages(
+                    params.get('q'),
+                    room_name=room_name,
+                    username=params.get('user') or None,
+                    since=since,
+                    until=until,
+                    cursor=params.get('cursor') or None,
+                    limit=int(params.get('limit', DEFAULT_SEARCH_PAGE_SIZE)),
+                    order=params.get('order') or ORDER_RANK,
+                )
+        except ValueError as e:
+            logger.warning(f"Search API 收到無效參數: {e}")
+            return Response({"error": f"搜尋參數無效: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+        except SearchNotSupported as e:
+            logger.error(f"資料庫後端 {e} 不支援全文搜尋。")
+            return Response({"error": "目前的資料庫不支援搜尋。"}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        return Response(page, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def _parse_time(value):
+        if not value:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(f'無效的時間: {value}')
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+# Django REST Framework API 視圖：最近消息快取的命中統計
+class RecentCacheStatsAPI(APIView):
+    # 僅限管理員查看
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        """
+        返回本進程最近消息快取的命中 / 未命中次數。
+        """
+        cache = get_recent_cache()
+        if cache is None:
+            return Response({"enabled": False}, status=status.HTTP_200_OK)
+        return Response(dict(cache.stats(), enabled=True, backend=type(cache).__name__), status=status.HTTP_200_OK)
 
 # Django REST Framework API 視圖：透過 HTTP 發送消息到 WebSocket 頻道
 class SendMessageAPI(APIView):
     # 預設需要認證用戶才能透過 API 發送訊息，提高安全性
     permission_classes = [IsAuthenticated] 
+    throttle_classes = [MessageRateThrottle] # 每個用戶與聊天室的發送頻率限制，跨 worker 共用
 
+    @metrics.timed(metrics.api_send_seconds)
     def post(self, request, room_name, *args, **kwargs):
         """
         接收 HTTP POST 請求，將消息發送到指定房間的 WebSocket 頻道層。
         """
         # 後端驗證房間名稱格式
-        valid_room_pattern = re.compile(r'^[a-zA-Z0-9_]+$') # 允許字母、數字、底線
-        if not valid_room_pattern.match(room_name):
+        if not is_valid_room_name(room_name): # 允許字母、數字、底線
             logger.warning(f"API: 檢測到無效房間名稱格式: {room_name}。")
             return Response({"error": "房間名稱格式無效。"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -68,39 +280,83 @@ class SendMessageAPI(APIView):
             logger.warning("API 收到空消息或無效消息。")
             return Response({"error": "消息內容為必填項且不能為空。"}, status=status.HTTP_400_BAD_REQUEST)
 
+        # 可選的客戶端消息 id：逾時重試時沿用同一個 id，伺服器只處理一次
+        client_msg_id = request.data.get('client_msg_id')
+        if client_msg_id is not None and not is_valid_client_msg_id(client_msg_id):
+            return Response({"error": "client_msg_id 格式無效。"}, status=status.HTTP_400_BAD_REQUEST)
+
         channel_layer = get_channel_layer()
-        room_group_name = f'chat_{room_name}'
-        
         user_display_name = request.user.username if request.user.is_authenticated else "API 發送者"
 
-        current_timestamp = timezone.now()
-
-        # 將消息存儲到數據庫 (ChatMessage 模型已啟用)
+        # 與 ChatConsumer 共用發送流程：寫入、更新快取、編碼一次並廣播
         try:
-            ChatMessage.objects.create(
-                room_name=room_name, 
-                sender=request.user, # sender 欄位現在要求登入用戶
-                content=message_content, 
-                timestamp=current_timestamp
-            )
-            logger.debug(f"API 發送消息 '{message_content}' 已儲存到資料庫。")
-        except Exception as e:
-            logger.error(f"API 保存消息到數據庫時發生錯誤: {e}")
-            # 即使資料庫儲存失敗，仍嘗試發送到 WebSocket，保證即時性
-            # 但生產環境應有更完善的錯誤處理和重試機制
-
-        # 使用 async_to_sync 將異步的 channel_layer.group_send 轉為同步執行
-        # 這會觸發 ChatConsumer 中的 chat_message 方法
-        async_to_sync(channel_layer.group_send)(
-            room_group_name,
-            {
-                'type': 'chat_message', 
-                'message': message_content,
-                'user': user_display_name,
-                'timestamp': current_timestamp.isoformat(), # 使用 ISO 格式方便前端解析
-            }
-        )
-        return Response({"status": "消息已成功發送到 WebSocket 頻道。"}, status=status.HTTP_200_OK)
+            saved = publish_message(channel_layer, room_name, request.user, user_display_name, message_content, client_msg_id) # sender 欄位現在要求登入用戶
+        except DuplicateMessage as e:
+            # 重試的請求與第一次一樣返回成功，不再寫入與廣播
+            return Response({"status": "消息已處理過。", "duplicate": True, "id": e.message_id}, status=status.HTTP_200_OK)
+        mark_written(request_sticky_key(request))
+        return Response({"status": "消息已成功發送到 WebSocket 頻道。", "id": saved.id if saved else None}, status=status.HTTP_200_OK)
+
+
+def _parse_bulk_item(item):
+    """
+    驗證批次發送的一個項目，返回 ((聊天室, 內容, client_msg_id), None) 或 (None, 錯誤訊息)。
+    """
+    if not isinstance(item, dict):
+        return None, "項目必須是物件。"
+    room_name = item.get('room')
+    if not is_valid_room_name(room_name):
+        return None, "房間名稱格式無效。"
+    message_content = item.get('message')
+    if not message_content or not isinstance(message_content, str) or not message_content.strip():
+        return None, "消息內容為必填項且不能為空。"
+    client_msg_id = item.get('client_msg_id')
+    if client_msg_id is not None and not is_valid_client_msg_id(client_msg_id):
+        return None, "client_msg_id 格式無效。"
+    return (room_name, message_content, client_msg_id), None
+
+
+class SendBulkMessagesAPI(APIView):
+    """
+    一次發送多條消息 (可跨聊天室)，供後端整合推送系統消息：
+    所有項目一次驗證，在一個交易中以一次 bulk_create 寫入，
+    再依聊天室合併，在一次 async_to_sync 內並行群發。每個項目各自返回結果。
+    """
+    permission_classes = [IsAdminUser] # 系統消息不經過每個聊天室的發送頻率限制，只開放給管理員
+
+    @metrics.timed(metrics.api_send_bulk_seconds)
+    def post(self, request, *args, **kwargs):
+        items = request.data.get('messages') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return Response({"error": "messages 必須是非空的陣列。"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.CHAT_BULK_SEND_MAX_ITEMS:
+            return Response({"error": f"每次最多發送 {settings.CHAT_BULK_SEND_MAX_ITEMS} 條消息。"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        valid = [] # (序號, (聊天室, 內容, client_msg_id))
+        seen = set()
+        for index, item in enumerate(items):
+            parsed, error = _parse_bulk_item(item)
+            if parsed is not None and parsed[2] is not None:
+                key = (parsed[0], parsed[2])
+                if key in seen:
+                    parsed, error = None, "同一批次中重複的 client_msg_id。"
+                seen.add(key)
+            if parsed is None:
+                results[index] = {'index': index, 'status': 'invalid', 'error': error}
+            else:
+                valid.append((index, parsed))
+        if not valid:
+            logger.warning(f"批次發送 API 收到 {len(items)} 個無效項目。")
+            return Response({"sent": 0, "results": results}, status=status.HTTP_400_BAD_REQUEST)
+
+        published = publish_messages(get_channel_layer(), request.user, request.user.username, [parsed for _, parsed in valid])
+        for (index, _), result in zip(valid, published):
+            results[index] = dict(result, index=index)
+        sent = sum(1 for result in published if result['status'] == 'sent')
+        if sent:
+            mark_written(request_sticky_key(request))
+        return Response({"sent": sent, "results": results}, status=status.HTTP_200_OK)
 
 # 範例：透過 HTTP API 發送個人通知
 # class SendNotificationAPI(APIView):
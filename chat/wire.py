@@ -0,0 +1,309 @@
+import json
+import logging # 導入 logging 模組
+import zlib
+from collections import OrderedDict
+
+import msgpack # channels_redis 的依賴，已隨 requirements.txt 安裝
+from django.conf import settings
+
+# 配置日誌記錄器
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson # 可選依賴：安裝後自動使用更快的 JSON 編碼器
+except ImportError:
+    orjson = None
+
+
+def _use_orjson():
+    backend = getattr(settings, 'CHAT_JSON_BACKEND', 'auto')
+    if backend == 'json':
+        return False
+    if backend == 'orjson' and orjson is None:
+        logger.warning("CHAT_JSON_BACKEND 設為 orjson 但未安裝 orjson，改用標準庫 json。")
+    return orjson is not None
+
+
+_USE_ORJSON = _use_orjson()
+
+if _USE_ORJSON:
+    def dumps(obj):
+        """
+        將物件編碼為 JSON 字串 (orjson)。
+        """
+        return orjson.dumps(obj).decode('utf-8')
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        """
+        將物件編碼為 JSON 字串 (標準庫 json)。
+        """
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    loads = json.loads
+
+# 兩種實作對無效輸入拋出的例外都是 ValueError 的子類別
+JSONDecodeError = orjson.JSONDecodeError if _USE_ORJSON else json.JSONDecodeError
+
+
+def build_chat_frame(message, user, timestamp, message_id=None, client_msg_id=None):
+    """
+    產生 chat_message 的最終 WebSocket 文字幀。
+
+    由發送端 (ChatConsumer.receive / SendMessageAPI.post) 只編碼一次並放入群組事件，
+    每個接收者的 chat_message 直接轉發，不再逐一重複 json.dumps。
+    id 在同一聊天室內單調遞增，客戶端據此去重並在重連時要求補發；寫後模式下為 null。
+    發送者帶了 client_msg_id 時一併廣播，發送端據此確認消息已送達、停止重試。
+    """
+    frame = {
+        'id': message_id,
+        'message': message,
+        'user': user,
+        'timestamp': timestamp,
+    }
+    if client_msg_id is not None:
+        frame['client_msg_id'] = client_msg_id
+    return dumps(frame)
+
+
+def chat_message_event(frame, room_name):
+    """
+    產生送往群組的 chat_message 事件。room 供同時訂閱多個聊天室的連線辨識來源。
+    """
+    return {
+        'type': 'chat_message',
+        'room': room_name,
+        'frame': frame,
+    }
+
+
+def chat_messages_event(frames, room_name):
+    """
+    一次送往群組的多個 chat_message 幀 (批次發送 API)，群組成員只需讀取一次。
+    """
+    return {
+        'type': 'chat_message',
+        'room': room_name,
+        'frames': frames,
+    }
+
+
+def tag_frame(stream, frame):
+    """
+    為多工連線的幀加上串流標籤：{"stream": ..., "payload": <原始幀>}。
+    frame 已是編碼好的 JSON，直接拼接不重新編碼；stream 只包含字母、數字、底線與冒號。
+    """
+    return '{"stream":"' + stream + '","payload":' + frame + '}'
+
+
+def encode_json_batch(frames):
+    """
+    將多個已編碼的 JSON 幀合併為 {"type": "batch", "messages": [...]}，直接拼接不重新編碼。
+    """
+    return '{"type":"batch","messages":[' + ','.join(frames) + ']}'
+
+
+# 二進位子協定：每個幀的第一個位元組是旗標，其後是 msgpack 編碼的物件。
+# 聊天消息以位置陣列編碼，不重複傳送欄位名稱：[id, message, user, timestamp] 或
+# [id, message, user, timestamp, client_msg_id]；batch / replay / history 幀的 messages 中的消息亦同。
+# 其他幀 (presence、ephemeral、錯誤等) 的欄位與 JSON 幀相同
+SUBPROTOCOL_JSON = 'chat.json'
+SUBPROTOCOL_MSGPACK = 'chat.msgpack'
+SUBPROTOCOL_MSGPACK_ZLIB = 'chat.msgpack.zlib' # 超過門檻的幀以 zlib 壓縮
+FLAG_PLAIN = 0x00
+FLAG_ZLIB = 0x01
+MAX_FRAME_BYTES = 1024 * 1024 # 解壓後的上限，避免壓縮炸彈
+
+# {"type": "batch", "messages": [...]} 中陣列之前的固定部分
+_BATCH_PREFIX = (msgpack.Packer().pack_map_header(2) + msgpack.packb('type') + msgpack.packb('batch')
+                 + msgpack.packb('messages'))
+
+
+MESSAGE_FIELDS = ('id', 'message', 'user', 'timestamp', 'client_msg_id')
+_MESSAGE_KEYS = frozenset(MESSAGE_FIELDS)
+_REQUIRED_MESSAGE_KEYS = frozenset(MESSAGE_FIELDS[:4])
+
+
+class FrameDecodeError(ValueError):
+    """
+    無法解碼的二進位幀。
+    """
+
+
+def _pack_binary(payload, compress_min_bytes):
+    if compress_min_bytes and len(payload) >= compress_min_bytes:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            return bytes((FLAG_ZLIB,)) + compressed
+    return bytes((FLAG_PLAIN,)) + payload
+
+
+def _compact(obj):
+    """
+    將聊天消息轉為位置陣列 (見 MESSAGE_FIELDS)，並轉換 messages 陣列中的消息；其他物件不變。
+    """
+    if not isinstance(obj, dict):
+        return obj
+    keys = obj.keys()
+    if keys <= _MESSAGE_KEYS and keys >= _REQUIRED_MESSAGE_KEYS:
+        row = [obj.get(field) for field in MESSAGE_FIELDS]
+        if row[-1] is None:
+            row.pop()
+        return row
+    messages = obj.get('messages')
+    if isinstance(messages, list):
+        return dict(obj, messages=[_compact(message) for message in messages])
+    return obj
+
+
+def _msgpack_payload(frame):
+    return msgpack.packb(_compact(loads(frame)))
+
+
+class _BinaryFrameCache:
+    """
+    群發幀轉換結果的 LRU 快取，以位元組數 (JSON 幀與二進位幀的長度) 為上限。
+    只在事件循環的執行緒中使用，不需要加鎖。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict() # (壓縮門檻或 None, JSON 幀) -> 二進位內容
+
+    def get_or_create(self, key, create):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+        value = create()
+        size = len(key[1]) + len(value)
+        if size <= self.max_bytes:
+            self._entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                (_, old_frame), old_value = self._entries.popitem(last=False)
+                self.bytes -= len(old_frame) + len(old_value)
+        return value
+
+
+_binary_cache = None
+
+
+def _get_binary_cache():
+    global _binary_cache
+    if _binary_cache is None:
+        _binary_cache = _BinaryFrameCache(settings.CHAT_WIRE_BINARY_CACHE_BYTES)
+    return _binary_cache
+
+
+def _msgpack_from_json(frame):
+    return _get_binary_cache().get_or_create((None, frame), lambda: _msgpack_payload(frame))
+
+
+def encode_binary_broadcast(frame, compress_min_bytes=0):
+    """
+    將群發的 JSON 幀轉為二進位幀。同一條消息送給本進程所有使用 msgpack 的連線，
+    以快取讓每條消息每種格式只轉換、壓縮一次。
+    """
+    return _get_binary_cache().get_or_create(
+        (compress_min_bytes, frame), lambda: _pack_binary(_msgpack_from_json(frame), compress_min_bytes))
+
+
+def encode_binary(frame, compress_min_bytes=0):
+    """
+    將只發給單一連線的 JSON 幀 (錯誤、歷史、補發等) 轉為二進位幀，不經過快取。
+    """
+    return _pack_binary(_msgpack_payload(frame), compress_min_bytes)
+
+
+def encode_binary_batch(frames, compress_min_bytes=0):
+    """
+    合併多個群發幀為一個二進位 batch 幀；與 JSON 一樣直接拼接各幀的 msgpack 編碼。
+    """
+    payload = b''.join([
+        _BATCH_PREFIX, msgpack.Packer().pack_array_header(len(frames)),
+        *(_msgpack_from_json(frame) for frame in frames),
+    ])
+    return _pack_binary(payload, compress_min_bytes)
+
+
+def decode_binary(data):
+    """
+    解碼客戶端送來的二進位幀，返回 msgpack 物件。格式無效時拋出 FrameDecodeError。
+    """
+    if not data:
+        raise FrameDecodeError('空的二進位幀')
+    flag, payload = data[0], data[1:]
+    try:
+        if flag == FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(payload, MAX_FRAME_BYTES)
+            if decompressor.unconsumed_tail:
+                raise FrameDecodeError(f'解壓後超過 {MAX_FRAME_BYTES} 位元組')
+        elif flag != FLAG_PLAIN:
+            raise FrameDecodeError(f'未知的幀旗標: {flag}')
+        return msgpack.unpackb(payload)
+    except (zlib.error, ValueError) as e:
+        # msgpack 的解碼錯誤都是 ValueError 的子類別
+        if isinstance(e, FrameDecodeError):
+            raise
+        raise FrameDecodeError(str(e)) from e
+
+
+class JsonCodec:
+    """
+    預設的 JSON 文字幀。
+    """
+
+    binary = False
+
+    def __init__(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    def frame_kwargs(self, frame):
+        return {'text_data': frame}
+
+    def batch_kwargs(self, frames):
+        return {'text_data': encode_json_batch(frames)}
+
+
+class MsgpackCodec:
+    """
+    msgpack 二進位幀；compress_min_bytes 大於 0 時，超過此大小的幀以 zlib 壓縮。
+    """
+
+    binary = True
+
+    def __init__(self, subprotocol, compress_min_bytes=0):
+        self.subprotocol = subprotocol
+        self.compress_min_bytes = compress_min_bytes
+
+    def encode(self, frame):
+        return encode_binary(frame, self.compress_min_bytes)
+
+    def frame_kwargs(self, frame):
+        return {'bytes_data': encode_binary_broadcast(frame, self.compress_min_bytes)}
+
+    def batch_kwargs(self, frames):
+        return {'bytes_data': encode_binary_batch(frames, self.compress_min_bytes)}
+
+
+JSON_CODEC = JsonCodec()
+
+
+def negotiate(subprotocols):
+    """
+    依客戶端在 Sec-WebSocket-Protocol 中的偏好順序選擇編碼；沒有可用的子協定時使用 JSON。
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol == SUBPROTOCOL_JSON:
+            return JsonCodec(SUBPROTOCOL_JSON)
+        if not settings.CHAT_WIRE_MSGPACK_ENABLED:
+            continue
+        if subprotocol == SUBPROTOCOL_MSGPACK:
+            return MsgpackCodec(SUBPROTOCOL_MSGPACK)
+        if subprotocol == SUBPROTOCOL_MSGPACK_ZLIB:
+            return MsgpackCodec(SUBPROTOCOL_MSGPACK_ZLIB, settings.CHAT_WIRE_COMPRESS_MIN_BYTES)
+    return JSON_CODEC
@@ -10,7 +10,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 import os
 from pathlib import Path
-from decouple import config # 導入 'python-decouple' 套件，用於管理環境變數
+from decouple import Csv, config # 導入 'python-decouple' 套件，用於管理環境變數
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -69,7 +69,7 @@ TEMPLATES = [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
-                'django.template.context_processors.messages',
+                'django.contrib.messages.context_processors.messages',
             ],
         },
     },
@@ -80,12 +80,16 @@ ASGI_APPLICATION = 'realtime_chat_project.asgi.application'
 
 # Channel Layers 配置 (Channels 的訊息中介層)
 # REDIS_URL 必須從環境變數讀取。本地開發可設定預設值。
+REDIS_URL = config('REDIS_URL', default='redis://redis:6379')
+# 頻道層可分片到多個 Redis 主機 (以逗號分隔)；所有進程必須使用相同的列表
+REDIS_URLS = [url.strip() for url in config('REDIS_URLS', default=REDIS_URL).split(',') if url.strip()]
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer', 
+        # 多個主機時依聊天室群組名稱一致性雜湊分片，同一個聊天室的成員都在同一個分片
+        'BACKEND': 'chat.layers.ShardedRedisChannelLayer' if len(REDIS_URLS) > 1 else 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             # 在 Docker Compose 環境中，直接使用服務名稱 'redis' 作為主機名
-            "hosts": [config('REDIS_URL', default='redis://redis:6379')],
+            "hosts": REDIS_URLS,
             # "password": config('REDIS_PASSWORD', default=None), # 如果 Redis 有密碼
         },
     },
@@ -108,6 +112,146 @@ DATABASES = {
     # }
 }
 
+# 持久連線：每個連線保留的秒數 (0 表示每個請求結束後關閉，None 表示不限)，SQLite 不需要
+DATABASES['default']['CONN_MAX_AGE'] = config('DB_CONN_MAX_AGE', default=0, cast=int)
+DATABASES['default']['CONN_HEALTH_CHECKS'] = config('DB_CONN_HEALTH_CHECKS', default=True, cast=bool)
+
+# 唯讀副本：以逗號分隔，SQLite 為資料庫檔案路徑，PostgreSQL 為 host[:port] (其餘設定與主庫相同)。
+# 歷史分頁、搜尋與聊天室列表改讀副本，寫入與其他讀取仍走主庫 (見 chat/routers.py)
+DB_REPLICAS = config('DB_REPLICAS', default='', cast=Csv())
+CHAT_DB_REPLICAS = []
+for index, replica in enumerate(DB_REPLICAS):
+    replica_settings = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        replica_settings['NAME'] = replica
+    else:
+        host, _, port = replica.partition(':')
+        replica_settings.update(HOST=host, PORT=port or DATABASES['default'].get('PORT', ''))
+    DATABASES[f'replica_{index}'] = replica_settings
+    CHAT_DB_REPLICAS.append(f'replica_{index}')
+
+DATABASE_ROUTERS = ['chat.routers.ReplicaRouter']
+# 讀己之寫：用戶發送消息後此秒數內，其歷史與搜尋讀取仍走主庫；0 表示停用
+CHAT_DB_STICKY_SECONDS = config('CHAT_DB_STICKY_SECONDS', default=5.0, cast=float)
+# 'local'：進程內記錄；'redis'：多個 worker 共用
+CHAT_DB_STICKY_BACKEND = config('CHAT_DB_STICKY_BACKEND', default='local')
+CHAT_DB_STICKY_REDIS_URL = config('CHAT_DB_STICKY_REDIS_URL', default=REDIS_URL)
+
+
+# 消息寫後 (write-behind) 模式
+# 啟用後消息會先廣播，再由每個進程的緩衝區以 bulk_create 批次寫入資料庫
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=100, cast=int) # 達到此數量立即寫入
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = config('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', default=0.5, cast=float) # 最長等待秒數
+CHAT_WRITE_BEHIND_MAX_QUEUE = config('CHAT_WRITE_BEHIND_MAX_QUEUE', default=10000, cast=int) # 緩衝區上限
+CHAT_WRITE_BEHIND_MAX_RETRIES = config('CHAT_WRITE_BEHIND_MAX_RETRIES', default=3, cast=int) # 資料庫不可用時的重試次數
+# 重試耗盡或緩衝區溢出時，消息寫入此 JSONL 檔，資料庫恢復後自動補寫
+CHAT_WRITE_BEHIND_SPILL_PATH = config('CHAT_WRITE_BEHIND_SPILL_PATH', default=str(BASE_DIR / 'chat_spill.jsonl'))
+
+# Consumer 資料庫操作 (直接寫入、歷史與補發查詢) 使用的執行緒池大小，也是每個進程的資料庫連線上限
+# 0 表示使用 Django 預設的 sync_to_async (所有操作排進單一執行緒)。SQLite 同一時間只允許一個寫入者，預設只用 1 條執行緒
+CHAT_DB_EXECUTOR_WORKERS = config(
+    'CHAT_DB_EXECUTOR_WORKERS',
+    default=1 if DATABASES['default']['ENGINE'].endswith('sqlite3') else 4,
+    cast=int,
+)
+
+# 每個聊天室的最近消息快取，位於歷史查詢之前
+# 'local'：進程內 LRU；'redis'：Redis list，多個 daphne worker 共用；'none'：停用
+CHAT_RECENT_CACHE_BACKEND = config('CHAT_RECENT_CACHE_BACKEND', default='local')
+CHAT_RECENT_CACHE_SIZE = config('CHAT_RECENT_CACHE_SIZE', default=100, cast=int) # 每個聊天室保留的消息數
+CHAT_RECENT_CACHE_MAX_ROOMS = config('CHAT_RECENT_CACHE_MAX_ROOMS', default=1000, cast=int) # 進程內快取的聊天室上限
+CHAT_RECENT_CACHE_TTL = config('CHAT_RECENT_CACHE_TTL', default=3600, cast=int) # 快取過期秒數
+CHAT_RECENT_CACHE_REDIS_URL = config('CHAT_RECENT_CACHE_REDIS_URL', default=REDIS_URL)
+
+# 聊天室統計 (Room 表的消息數、在線人數與最後消息)：寫入路徑只累加在記憶體中，每隔此秒數批次寫入
+CHAT_ROOM_STATS_ENABLED = config('CHAT_ROOM_STATS_ENABLED', default=True, cast=bool)
+CHAT_ROOM_STATS_FLUSH_INTERVAL = config('CHAT_ROOM_STATS_FLUSH_INTERVAL', default=1.0, cast=float)
+
+# client_msg_id 去重快取：'local'：進程內 TTL + LRU；'redis'：多個 worker 共用；'none'：只依賴資料庫唯一約束
+CHAT_DEDUP_BACKEND = config('CHAT_DEDUP_BACKEND', default='local')
+CHAT_DEDUP_TTL = config('CHAT_DEDUP_TTL', default=300, cast=int) # 客戶端重試的有效秒數
+CHAT_DEDUP_MAX_KEYS = config('CHAT_DEDUP_MAX_KEYS', default=100000, cast=int) # 進程內快取保留的 id 上限
+CHAT_DEDUP_REDIS_URL = config('CHAT_DEDUP_REDIS_URL', default=REDIS_URL)
+
+# 在線狀態：'local'：只統計本進程的連線；'redis'：各 worker 彙總到 Redis，成員數與成員列表涵蓋所有 worker；'none'：停用
+CHAT_PRESENCE_BACKEND = config('CHAT_PRESENCE_BACKEND', default='local')
+CHAT_PRESENCE_DEBOUNCE = config('CHAT_PRESENCE_DEBOUNCE', default=1.0, cast=float) # 加入 / 離開合併推送的間隔秒數
+CHAT_PRESENCE_HEARTBEAT = config('CHAT_PRESENCE_HEARTBEAT', default=15.0, cast=float) # worker 延長成員到期時間的間隔秒數
+CHAT_PRESENCE_TTL = config('CHAT_PRESENCE_TTL', default=45.0, cast=float) # 停止心跳 (worker 崩潰) 後成員保留的秒數
+CHAT_PRESENCE_MAX_DELTA = config('CHAT_PRESENCE_MAX_DELTA', default=100, cast=int) # 單一幀列出的加入 / 離開人數上限
+CHAT_PRESENCE_REDIS_URL = config('CHAT_PRESENCE_REDIS_URL', default=REDIS_URL)
+
+# 輸入中提示與已讀回執：不寫入消息表，每個聊天室每隔此毫秒數合併群發一次 (每個用戶只保留最新狀態)
+CHAT_EPHEMERAL_WINDOW_MS = config('CHAT_EPHEMERAL_WINDOW_MS', default=250, cast=int)
+# 已讀游標 (ReadCursor) 每隔此秒數批次寫入；未讀數以 Room.message_count 計算，
+# 游標與聊天室統計相差超過 MAX_GAP 條消息時只精確到此值
+CHAT_READ_CURSOR_FLUSH_INTERVAL = config('CHAT_READ_CURSOR_FLUSH_INTERVAL', default=2.0, cast=float)
+CHAT_UNREAD_MAX_GAP = config('CHAT_UNREAD_MAX_GAP', default=1000, cast=int)
+
+# 聊天室頁面：載入的歷史消息數，以及快取已渲染歷史片段的聊天室數上限 (0 表示不快取)
+CHAT_ROOM_PAGE_HISTORY = config('CHAT_ROOM_PAGE_HISTORY', default=100, cast=int)
+CHAT_ROOM_PAGE_CACHE_ROOMS = config('CHAT_ROOM_PAGE_CACHE_ROOMS', default=1000, cast=int)
+
+# 批次發送 API (api/send_messages/)：每次請求的消息數上限，以及同時進行的聊天室群發數
+CHAT_BULK_SEND_MAX_ITEMS = config('CHAT_BULK_SEND_MAX_ITEMS', default=500, cast=int)
+CHAT_BULK_SEND_CONCURRENCY = config('CHAT_BULK_SEND_CONCURRENCY', default=50, cast=int)
+
+# WebSocket 幀與快取使用的 JSON 編碼器：'auto' (已安裝 orjson 時使用 orjson)、'orjson'、'json'
+CHAT_JSON_BACKEND = config('CHAT_JSON_BACKEND', default='auto')
+
+# ChatConsumer 的二進位子協定：客戶端要求 chat.msgpack 或 chat.msgpack.zlib 時改送 msgpack 幀，
+# 後者對不小於 COMPRESS_MIN_BYTES 的幀以 zlib 壓縮；未要求子協定的客戶端沿用 JSON
+CHAT_WIRE_MSGPACK_ENABLED = config('CHAT_WIRE_MSGPACK_ENABLED', default=True, cast=bool)
+CHAT_WIRE_COMPRESS_MIN_BYTES = config('CHAT_WIRE_COMPRESS_MIN_BYTES', default=512, cast=int)
+# 群發幀轉為二進位幀的快取上限 (位元組)，每條消息每種格式只轉換一次
+CHAT_WIRE_BINARY_CACHE_BYTES = config('CHAT_WIRE_BINARY_CACHE_BYTES', default=4 * 1024 * 1024, cast=int)
+
+# 每個 WebSocket 連線的發送佇列
+# 距離上次發送不足此毫秒數時，期間到達的消息合併為一個批次幀；0 表示不合併
+CHAT_OUTBOUND_COALESCE_WINDOW_MS = config('CHAT_OUTBOUND_COALESCE_WINDOW_MS', default=0, cast=int)
+CHAT_OUTBOUND_MAX_QUEUE = config('CHAT_OUTBOUND_MAX_QUEUE', default=1000, cast=int) # 每個連線最多待發送的幀數
+# 佇列滿時的處理策略：'drop_oldest'、'disconnect' 或 'summary'
+CHAT_SLOW_CONSUMER_POLICY = config('CHAT_SLOW_CONSUMER_POLICY', default='drop_oldest')
+
+# 多工連線 (ws/multiplex/) 最多可同時訂閱的聊天室數
+CHAT_MULTIPLEX_MAX_ROOMS = config('CHAT_MULTIPLEX_MAX_ROOMS', default=50, cast=int)
+
+# 斷線重連時最多補發的消息數，超過時通知客戶端重新載入頁面
+CHAT_RESUME_MAX_MESSAGES = config('CHAT_RESUME_MAX_MESSAGES', default=200, cast=int)
+
+# Prometheus 指標端點 /metrics (每個進程各自計數)；對外部署時應只允許內網抓取
+CHAT_METRICS_ENABLED = config('CHAT_METRICS_ENABLED', default=True, cast=bool)
+
+# 大型聊天室的進程內群發：成員數達到此門檻的聊天室改以 Redis pub/sub 每個 worker 接收一次，
+# 再在進程內分發給本地連線；0 表示停用，一律使用 group_send (僅 Redis 頻道層有效)
+CHAT_LOCAL_FANOUT_THRESHOLD = config('CHAT_LOCAL_FANOUT_THRESHOLD', default=0, cast=int)
+CHAT_LOCAL_FANOUT_CHECK_INTERVAL = config('CHAT_LOCAL_FANOUT_CHECK_INTERVAL', default=5.0, cast=float) # 成員數快取秒數
+
+# runworkers 結束 worker 時排空 WebSocket 連線的最長秒數，以及客戶端重連時間的隨機分散範圍 (秒)
+CHAT_DRAIN_TIMEOUT = config('CHAT_DRAIN_TIMEOUT', default=30.0, cast=float)
+CHAT_DRAIN_RECONNECT_JITTER = config('CHAT_DRAIN_RECONNECT_JITTER', default=10.0, cast=float)
+
+# 消息發送的令牌桶速率限制：RATE 為每秒補充的令牌數 (0 表示停用該項)，BURST 為可累積的上限
+CHAT_RATE_LIMIT_ENABLED = config('CHAT_RATE_LIMIT_ENABLED', default=True, cast=bool)
+CHAT_RATE_LIMIT_CONNECTION_RATE = config('CHAT_RATE_LIMIT_CONNECTION_RATE', default=5.0, cast=float) # 每個 WebSocket 連線
+CHAT_RATE_LIMIT_CONNECTION_BURST = config('CHAT_RATE_LIMIT_CONNECTION_BURST', default=10, cast=int)
+CHAT_RATE_LIMIT_USER_RATE = config('CHAT_RATE_LIMIT_USER_RATE', default=10.0, cast=float) # 每個用戶 (未登入用戶以 IP 計)
+CHAT_RATE_LIMIT_USER_BURST = config('CHAT_RATE_LIMIT_USER_BURST', default=20, cast=int)
+CHAT_RATE_LIMIT_ROOM_RATE = config('CHAT_RATE_LIMIT_ROOM_RATE', default=100.0, cast=float) # 每個聊天室
+CHAT_RATE_LIMIT_ROOM_BURST = config('CHAT_RATE_LIMIT_ROOM_BURST', default=200, cast=int)
+CHAT_RATE_LIMIT_EPHEMERAL_RATE = config('CHAT_RATE_LIMIT_EPHEMERAL_RATE', default=2.0, cast=float) # 每個連線的輸入中提示 / 已讀回執
+CHAT_RATE_LIMIT_EPHEMERAL_BURST = config('CHAT_RATE_LIMIT_EPHEMERAL_BURST', default=5, cast=int)
+# HTTP API 的限制存放位置：'redis' 在所有 worker 之間共用；'local' 為進程內 (WebSocket 路徑固定為進程內)
+CHAT_RATE_LIMIT_BACKEND = config('CHAT_RATE_LIMIT_BACKEND', default='redis')
+CHAT_RATE_LIMIT_REDIS_URL = config('CHAT_RATE_LIMIT_REDIS_URL', default=REDIS_URL)
+
+
+# 冷資料歸檔 (manage.py archive_messages)：早於保留天數的消息移入每個聊天室、每天一個的 gzip JSONL 檔，
+# 歷史分頁捲動超過資料庫中的消息時自動讀取歸檔
+CHAT_ARCHIVE_DIR = config('CHAT_ARCHIVE_DIR', default=str(BASE_DIR / 'archive'))
+CHAT_ARCHIVE_RETENTION_DAYS = config('CHAT_ARCHIVE_RETENTION_DAYS', default=90, cast=int)
+CHAT_ARCHIVE_BATCH_SIZE = config('CHAT_ARCHIVE_BATCH_SIZE', default=1000, cast=int) # 每批搬移並刪除的行數
 
 # 密碼驗證器
 AUTH_PASSWORD_VALIDATORS = [